@@ -0,0 +1,7 @@
+"""
+Building blocks of the AxiosChat proxy (api/replicate_py.py): configuration, upstream
+clients, resilience, caching, admission control, the per-provider request code and the
+framework-agnostic request handling shared by the Flask app and the aiohttp app
+(SERVER_MODE=async). The leading underscore keeps Vercel from deploying these modules
+as serverless functions of their own.
+"""
@@ -0,0 +1,250 @@
+"""Admission control: per-key rate limits and per-route concurrency limits with load shedding"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from .gemini import GeminiClientRegistry
+from .logs import logger
+from .metrics import metrics
+from .settings import (
+    GUNICORN_THREADS, RATE_LIMIT_BURST, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_RPS, ROUTE_CONCURRENCY,
+    ROUTE_CONCURRENCY_LIMITS, ROUTE_QUEUE_SIZE, ROUTE_QUEUE_TIMEOUT, SHED_RETRY_AFTER, TRUSTED_PROXY_HOPS,
+    parse_pool_sizes
+)
+
+
+class RateLimiter:
+    """
+    Token bucket per API key (or client address): each key earns `rate` tokens a second up to `burst`,
+    and a request spends one (a batch spends one per query). A batch larger than the
+    bucket is let through once the bucket is full and leaves it in debt, so the key
+    still pays the whole cost before its next request.
+    Buckets are kept in LRU order and the least recently seen are dropped past max_keys.
+    """
+
+    def __init__(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key id -> (tokens, last refill)
+        self._limited = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, key, cost=1):
+        """Spend cost tokens from key's bucket, returning 0, or the seconds until the request would fit"""
+        if self.rate <= 0:
+            return 0
+        # What must be in the bucket: all of cost, or a full bucket for a larger batch
+        required = min(cost, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= required:
+                tokens -= cost
+                wait = 0
+            else:
+                wait = (required - tokens) / self.rate
+                self._limited += 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._buckets), "rate": self.rate, "burst": self.burst, "limited": self._limited}
+
+
+class ConcurrencyLimiter:
+    """
+    Caps requests in flight on one route. Requests over the limit wait, at most
+    queue_size of them and for at most queue_timeout seconds; the rest are shed
+    so latency stays predictable instead of every request slowing down.
+    """
+
+    def __init__(self, route, limit, queue_size, queue_timeout):
+        self.route = route
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed; returns None, or the reason the request was shed"""
+        with self._condition:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return None
+            if self.waiting >= self.queue_size:
+                self.shed += 1
+                return "queue_full"
+            self.waiting += 1
+            metrics.inc('proxy_queued_requests', route=self.route)
+            try:
+                if not self._condition.wait_for(lambda: self.active < self.limit, timeout=self.queue_timeout):
+                    self.shed += 1
+                    return "queue_timeout"
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+                metrics.dec('proxy_queued_requests', route=self.route)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {"limit": self.limit, "active": self.active, "waiting": self.waiting, "shed": self.shed}
+
+
+class AsyncConcurrencyLimiter:
+    """ConcurrencyLimiter for the async serving mode: queued requests wait on the event loop, not a thread"""
+
+    def __init__(self, route, limit, queue_size, queue_timeout):
+        self.route = route
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.shed = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        """Take a slot, waiting in the queue if needed; returns None, or the reason the request was shed"""
+        if not self._semaphore.locked() and not self.waiting:
+            await self._semaphore.acquire()
+            self.active += 1
+            return None
+        if self.waiting >= self.queue_size:
+            self.shed += 1
+            return "queue_full"
+        self.waiting += 1
+        metrics.inc('proxy_queued_requests', route=self.route)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            self.active += 1
+            return None
+        except asyncio.TimeoutError:
+            self.shed += 1
+            return "queue_timeout"
+        finally:
+            self.waiting -= 1
+            metrics.dec('proxy_queued_requests', route=self.route)
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting, "shed": self.shed}
+
+
+# Routes that call upstreams; health, stats and job status lookups are never limited
+ADMISSION_ROUTES = ('/api/replicate', '/api/gemini_functions', '/api/gemini_functions/batch', '/api/chat', '/api/ollama')
+
+
+def route_admission_limits(threads=None):
+    """
+    (concurrency limit, queue size) per admission route, or {} when limits are disabled.
+    Pass the worker's thread count in Flask mode: there a running or queued request each
+    hold a thread, so a route is capped at half of them and one busy route cannot starve
+    the others (or /api/health) of threads. Waiting costs no thread in async mode.
+    """
+    default_limit = int(ROUTE_CONCURRENCY) if ROUTE_CONCURRENCY else (max(threads // 4, 1) if threads else 32)
+    if default_limit <= 0:
+        return {}
+    overrides = parse_pool_sizes(ROUTE_CONCURRENCY_LIMITS)
+    limits = {}
+    for route in ADMISSION_ROUTES:
+        limit = overrides.get(route, default_limit)
+        queue_size = int(ROUTE_QUEUE_SIZE) if ROUTE_QUEUE_SIZE else (limit if threads else 64)
+        if threads:
+            share = max(threads // 2, 1)
+            if limit + queue_size > share:
+                logger.warning("Route %s: limit %d plus queue %d exceeds half of the %d worker threads, capping them at %d",
+                               route, limit, queue_size, threads, share)
+                limit = min(limit, share)
+                queue_size = share - limit
+        limits[route] = (limit, queue_size)
+    return limits
+
+
+# The header each route takes the caller's own credential from
+ADMISSION_CREDENTIALS = {
+    '/api/replicate': 'X-Replicate-API-Token',
+    '/api/gemini_functions': 'X-Gemini-API-Key',
+    '/api/gemini_functions/batch': 'X-Gemini-API-Key'
+}
+
+
+def client_address(headers, remote_addr):
+    """The caller's address: the peer, or the X-Forwarded-For entry added by the outermost trusted proxy"""
+    if TRUSTED_PROXY_HOPS > 0:
+        forwarded = [entry.strip() for entry in headers.get('X-Forwarded-For', '').split(',') if entry.strip()]
+        if forwarded:
+            return forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+    return remote_addr or "unknown"
+
+
+def admission_key(route, headers, remote_addr):
+    """
+    Rate limit identity: a hash of the credential the route actually uses, or the client
+    address for requests without one (which are served with the server's own key)
+    """
+    header = ADMISSION_CREDENTIALS.get(route)
+    api_key = headers.get(header) if header else None
+    if api_key:
+        return "key:" + GeminiClientRegistry.key_id(api_key)
+    return "addr:" + client_address(headers, remote_addr)
+
+
+def admission_cost(route, request_data):
+    # A batch costs what its queries would cost sent one by one
+    if route == '/api/gemini_functions/batch' and isinstance(request_data, dict) and isinstance(request_data.get('queries'), list):
+        return max(len(request_data['queries']), 1)
+    return 1
+
+
+def rejected_body(route, reason, retry_after):
+    """(body, status, headers) for a request refused by admission control"""
+    metrics.inc('proxy_rejected_requests_total', route=route, reason=reason)
+    retry_after = max(math.ceil(retry_after), 1)
+    if reason == "rate_limited":
+        body, status = {"error": "Rate limit exceeded for this API key or address, please slow down", "retry_after": retry_after}, 429
+    else:
+        body, status = {"error": "Server is busy, please retry shortly", "retry_after": retry_after}, 503
+    return body, status, {"Retry-After": str(retry_after)}
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_RPS, RATE_LIMIT_BURST, RATE_LIMIT_MAX_KEYS)
+# Flask mode's limiters; the async app creates AsyncConcurrencyLimiters for its event loop
+route_limiters = {
+    route: ConcurrencyLimiter(route, limit, queue_size, ROUTE_QUEUE_TIMEOUT)
+    for route, (limit, queue_size) in route_admission_limits(GUNICORN_THREADS).items()
+}
+
+
+def admitted_route(route, method):
+    """Whether a request goes through admission control: POSTs to the routes that call upstreams"""
+    return route in ADMISSION_ROUTES and method == 'POST'
+
+
+def rate_limit(route, headers, remote_addr, request_data):
+    """Spend the request's cost from its key's bucket; returns the 429 reply when it is over its rate, else None"""
+    wait = rate_limiter.acquire(admission_key(route, headers, remote_addr), admission_cost(route, request_data))
+    return rejected_body(route, "rate_limited", wait) if wait else None
+
+
+def shed_body(route, reason):
+    """(body, status, headers) for a request that found no concurrency slot"""
+    return rejected_body(route, reason, SHED_RETRY_AFTER)
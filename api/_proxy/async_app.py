@@ -0,0 +1,239 @@
+"""
+The aiohttp application used when SERVER_MODE=async.
+It serves the same routes as the Flask app through the same handlers, but upstream calls
+and retry backoff are awaited, so requests waiting on slow upstreams hold no worker thread.
+"""
+import asyncio
+import time
+
+from aiohttp import web
+
+from .admission import AsyncConcurrencyLimiter, admitted_route, rate_limit, route_admission_limits, shed_body
+from .caching import async_coalescer
+from .chat_sessions import chat_session_reply
+from .gemini import answer_gemini_batch_async, answer_gemini_request_async, gemini_events_async
+from .handlers import (
+    cache_stats_body, chat_failed, gemini_health_reply, gemini_reply, ollama_failed, prepare_chat_request,
+    prepare_gemini_batch, prepare_gemini_request, prepare_ollama_request, prepare_replicate_request,
+    replicate_job_reply, upstream_stats_body
+)
+from .http_clients import async_upstream
+from .metrics import METRICS_CONTENT_TYPE, begin_request_metrics, end_request_metrics, metrics
+from .ollama_backends import OllamaStream, format_ollama_generate_chunk, generate_coalesced_async, relay_ollama_stream_async
+from .providers import pick_provider, provider_health, provider_router
+from .replicate_api import answer_replicate_request_async, create_replicate_job_async, structured_reply, wants_async_job
+from .settings import GEMINI_BATCH_WORKERS, ROUTE_QUEUE_TIMEOUT
+from .streaming import SSE_HEADERS, wants_stream
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "*"
+}
+
+ROUTE_LIMITERS = web.AppKey("route_limiters", dict)
+# Shared by every batch so concurrent batches can't exceed GEMINI_BATCH_WORKERS upstream calls
+BATCH_SLOTS = web.AppKey("batch_slots", asyncio.Semaphore)
+
+
+def matched_route(request):
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    if not response.prepared:
+        response.headers.update(CORS_HEADERS)
+    return response
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = matched_route(request)
+    start = begin_request_metrics(route, request.content_length)
+    status, response_size = 500, None
+    try:
+        response = await handler(request)
+        status, response_size = response.status, response.content_length
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        end_request_metrics(route, start, status, response_size)
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """Per-key rate limit, then a concurrency slot for the route, held until the handler returns"""
+    route = matched_route(request)
+    if not admitted_route(route, request.method):
+        return await handler(request)
+    request_data = await read_json(request) if route == '/api/gemini_functions/batch' else None
+    rejected = rate_limit(route, request.headers, request.remote, request_data)
+    if rejected:
+        return json_reply(*rejected)
+    limiter = request.app[ROUTE_LIMITERS].get(route)
+    if limiter is None:
+        return await handler(request)
+    reason = await limiter.acquire()
+    if reason:
+        return json_reply(*shed_body(route, reason))
+    try:
+        # Streamed responses have been written out by the time the handler returns
+        return await handler(request)
+    finally:
+        limiter.release()
+
+
+def json_reply(body, status=200, headers=None):
+    return web.json_response(body, status=status, headers=headers)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+async def open_sse(request):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **SSE_HEADERS, **CORS_HEADERS})
+    await response.prepare(request)
+    return response
+
+
+async def relay_ollama(request, stream):
+    error, sse = await relay_ollama_stream_async(stream, lambda: open_sse(request))
+    return json_reply(*error) if error else sse
+
+
+async def proxy_replicate(request):
+    request_data = await read_json(request)
+    error, api_token = prepare_replicate_request(request_data, request.headers)
+    if error:
+        return json_reply(*error)
+    if wants_async_job(request.query):
+        return json_reply(*await create_replicate_job_async(request_data, api_token))
+    return json_reply(*structured_reply(await answer_replicate_request_async(request_data, api_token), request.query))
+
+
+async def replicate_job_status(request):
+    return json_reply(*replicate_job_reply(request.match_info['job_id'], request.headers))
+
+
+async def gemini_functions_proxy(request):
+    request_data = await read_json(request) or {}
+    error, gemini_request = prepare_gemini_request(request_data, request.headers, asynchronous=True)
+    if error:
+        return json_reply(*error)
+    
+    if wants_stream(request_data, request.query):
+        error, provider = pick_provider("gemini")
+        if error:
+            return json_reply(*error)
+        events = await gemini_events_async(gemini_request, provider)
+        sse = await open_sse(request)
+        async for event in events:
+            await sse.write(event.encode('utf-8'))
+        await sse.write_eof()
+        return sse
+    
+    start = time.perf_counter()
+    reply = await answer_gemini_request_async(gemini_request)
+    return json_reply(*gemini_reply(gemini_request, reply, time.perf_counter() - start))
+
+
+async def gemini_functions_batch(request):
+    error, gemini_requests = prepare_gemini_batch(await read_json(request) or {}, request.headers, asynchronous=True)
+    if error:
+        return json_reply(*error)
+    return json_reply(await answer_gemini_batch_async(gemini_requests, request.app[BATCH_SLOTS]))
+
+
+async def gemini_health_check(request):
+    return json_reply(*gemini_health_reply(request.headers, asynchronous=True))
+
+
+async def chat(request):
+    try:
+        error, turn = prepare_chat_request(await read_json(request), request.query)
+        if error:
+            return json_reply(*error)
+        if turn.ollama_request["stream"]:
+            return await relay_ollama(request, turn.stream())
+        return json_reply(*await turn.answer_async())
+    except Exception as e:
+        return json_reply(*chat_failed(e))
+
+
+async def chat_session(request):
+    return json_reply(*chat_session_reply(request.method, request.match_info['session_id']))
+
+
+async def ollama_proxy(request):
+    error, ollama_request = prepare_ollama_request(await read_json(request), request.query)
+    if error:
+        return json_reply(*error)
+    try:
+        if ollama_request["stream"]:
+            return await relay_ollama(request, OllamaStream("/api/generate", ollama_request, format_ollama_generate_chunk))
+        return json_reply(*await generate_coalesced_async(ollama_request, request.headers))
+    except Exception as e:
+        return json_reply(*ollama_failed(e))
+
+
+async def provider_health_check(request):
+    return json_reply(*provider_router.health_body())
+
+
+async def upstream_stats(request):
+    return json_reply(upstream_stats_body(async_upstream, request.app[ROUTE_LIMITERS]))
+
+
+async def cache_stats(request):
+    return json_reply(cache_stats_body(async_coalescer))
+
+
+async def prometheus_metrics(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+async def start_provider_prober(app):
+    provider_health.ensure_running()
+
+
+async def close_upstream(app):
+    await async_upstream.close()
+
+
+def create_async_app():
+    """Build the aiohttp application, with its own concurrency limiters and batch slots"""
+    # Outermost first: shed requests are still counted and still get CORS headers
+    async_app = web.Application(middlewares=[metrics_middleware, cors_middleware, admission_middleware])
+    async_app[ROUTE_LIMITERS] = {
+        route: AsyncConcurrencyLimiter(route, limit, queue_size, ROUTE_QUEUE_TIMEOUT)
+        for route, (limit, queue_size) in route_admission_limits().items()
+    }
+    async_app[BATCH_SLOTS] = asyncio.Semaphore(GEMINI_BATCH_WORKERS)
+    async_app.router.add_post('/api/replicate', proxy_replicate)
+    async_app.router.add_get('/api/replicate/{job_id}', replicate_job_status)
+    async_app.router.add_post('/api/gemini_functions', gemini_functions_proxy)
+    async_app.router.add_post('/api/gemini_functions/batch', gemini_functions_batch)
+    async_app.router.add_get('/api/gemini_health', gemini_health_check)
+    async_app.router.add_get('/api/health', provider_health_check)
+    async_app.router.add_post('/api/chat', chat)
+    async_app.router.add_get('/api/chat/sessions/{session_id}', chat_session)
+    async_app.router.add_delete('/api/chat/sessions/{session_id}', chat_session)
+    async_app.router.add_post('/api/ollama', ollama_proxy)
+    async_app.router.add_get('/api/upstream_stats', upstream_stats)
+    async_app.router.add_get('/api/cache_stats', cache_stats)
+    async_app.router.add_get('/metrics', prometheus_metrics)
+    async_app.on_startup.append(start_provider_prober)
+    async_app.on_cleanup.append(close_upstream)
+    return async_app
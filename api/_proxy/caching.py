@@ -0,0 +1,192 @@
+"""Response caching and single-flight coalescing of identical upstream calls"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .settings import CACHE_BYPASS_HEADER, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with hit/miss counters and an optional per-entry TTL"""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+def request_fingerprint(*parts):
+    """Stable hash of the request parameters that determine an upstream response"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def is_cacheable_result(result):
+    # Only successful upstream answers are worth replaying
+    body, status = result
+    return status == 200 and isinstance(body, dict) and body.get("status", "succeeded") == "succeeded"
+
+
+class RequestCoalescer:
+    """
+    Single-flight deduplication of identical upstream calls plus an optional response cache.
+    Concurrent callers with the same key wait for the first caller's result instead of
+    issuing their own upstream request. Results are (body, status) tuples.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._in_flight = {}  # key -> {"event", "result", "error"}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.bypassed = 0
+
+    def run(self, key, fn, cacheable=False, bypass=False):
+        """Return (result, source) where source is HIT, MISS, COALESCED or BYPASS"""
+        if bypass:
+            with self._lock:
+                self.bypassed += 1
+            return fn(), "BYPASS"
+        
+        if cacheable:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached, "HIT"
+        
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._in_flight[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], "COALESCED"
+        
+        try:
+            call["result"] = fn()
+            if cacheable and is_cacheable_result(call["result"]):
+                self.cache.put(key, call["result"])
+            return call["result"], "MISS"
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            call["event"].set()
+
+    def stats(self):
+        with self._lock:
+            upstream_calls = self.leaders + self.bypassed
+            return {
+                "in_flight": len(self._in_flight),
+                "upstream_calls": upstream_calls,
+                "coalesced": self.coalesced,
+                "bypassed": self.bypassed,
+                "coalesce_rate": round(self.coalesced / (self.coalesced + upstream_calls), 4) if self.coalesced + upstream_calls else 0.0,
+                "response_cache": self.cache.stats()
+            }
+
+
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+coalescer = RequestCoalescer(response_cache)
+
+
+def cache_bypassed(headers):
+    return headers.get(CACHE_BYPASS_HEADER, '').lower() in ('1', 'true', 'yes')
+
+
+class AsyncRequestCoalescer(RequestCoalescer):
+    """asyncio variant of RequestCoalescer for SERVER_MODE=async; fn is a coroutine function"""
+
+    async def run(self, key, fn, cacheable=False, bypass=False):
+        if bypass:
+            self.bypassed += 1
+            return await fn(), "BYPASS"
+        
+        if cacheable:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached, "HIT"
+        
+        # Everything below runs on the event loop thread, so no lock is needed
+        call = self._in_flight.get(key)
+        if call is not None:
+            self.coalesced += 1
+            return await asyncio.shield(call), "COALESCED"
+        
+        call = asyncio.get_running_loop().create_future()
+        # Retrieve the exception so a failed call without followers isn't reported as unhandled
+        call.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[key] = call
+        self.leaders += 1
+        try:
+            result = await fn()
+            if cacheable and is_cacheable_result(result):
+                self.cache.put(key, result)
+            call.set_result(result)
+            return result, "MISS"
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+
+# Shares the response cache with the Flask mode coalescer
+async_coalescer = AsyncRequestCoalescer(response_cache)
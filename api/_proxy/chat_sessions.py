@@ -0,0 +1,305 @@
+"""Server-side chat sessions for /api/chat and the token budget their history is trimmed to"""
+import contextlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from .logs import logger
+from .ollama_backends import (
+    OllamaStream, build_ollama_chat_request, call_ollama, call_ollama_async, format_chat_messages, format_ollama_chat_chunk,
+    format_ollama_chat_response
+)
+from .settings import CHAT_SESSION_DIR, CHAT_SESSION_MAX, CHAT_SESSION_TOKEN_BUDGET, CHAT_SESSION_TTL
+
+
+CHARS_PER_TOKEN = 4  # Rough estimate for trimming; close enough for Llama-family tokenizers on English text
+
+
+def estimate_tokens(message):
+    # A few tokens of per-message overhead for the role and chat template
+    return len(message["content"]) // CHARS_PER_TOKEN + 4
+
+
+def trim_to_token_budget(messages, budget):
+    """
+    Keep leading system messages and as many of the most recent messages as fit in budget
+    estimated tokens; the newest message is always kept
+    """
+    leading = 0
+    while leading < len(messages) and messages[leading]["role"] == "system":
+        leading += 1
+    system, rest = messages[:leading], messages[leading:]
+    remaining = budget - sum(estimate_tokens(m) for m in system)
+    kept = 0
+    for message in reversed(rest):
+        remaining -= estimate_tokens(message)
+        if remaining < 0 and kept:
+            break
+        kept += 1
+    return system + rest[len(rest) - kept:]
+
+
+class ChatSessionStore:
+    """
+    Server-side /api/chat histories, so clients send a session id and only their new messages.
+    Sessions are kept in LRU order up to max_sessions, dropped after ttl seconds idle, and
+    trimmed to token_budget on every update, which bounds both the context sent to Ollama
+    and each session's memory. With a directory, every session is also written there as
+    JSON: evicted sessions are reloaded from it, and workers sharing it see each other's turns.
+    """
+
+    def __init__(self, max_sessions, ttl, token_budget, directory=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.directory = directory
+        self._sessions = OrderedDict()  # id -> {"messages", "tokens", "bytes", "created_at", "last_used", "mtime"}
+        self._evictions = 0
+        self._expirations = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._remove_expired_files()
+
+    @staticmethod
+    def valid_id(session_id):
+        # Ids become file names, so only URL-safe characters are accepted
+        return isinstance(session_id, str) and 0 < len(session_id) <= 64 and session_id.isascii() \
+            and session_id.replace('-', '').replace('_', '').isalnum()
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def _entry(self, messages, created_at, mtime=0.0):
+        return {
+            "messages": messages,
+            "tokens": sum(estimate_tokens(m) for m in messages),
+            "bytes": sum(len(m["role"]) + len(m["content"].encode('utf-8')) for m in messages),
+            "created_at": created_at,
+            "last_used": time.monotonic(),
+            "mtime": mtime
+        }
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if now - entry["last_used"] < self.ttl:
+                break
+            del self._sessions[session_id]
+            self._expirations += 1
+            if self.directory:
+                # Idle here is not idle everywhere: another worker may have written the file since
+                with contextlib.suppress(OSError):
+                    path = self._path(session_id)
+                    if time.time() - os.path.getmtime(path) >= self.ttl:
+                        os.remove(path)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self._evictions += 1
+
+    def _remove_expired_files(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            with contextlib.suppress(OSError):
+                if name.endswith('.json') and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+
+    def _load(self, session_id, entry):
+        """The session from disk when it is newer than the cached entry (or there is none), else entry"""
+        if not self.directory:
+            return entry
+        path = self._path(session_id)
+        try:
+            mtime = os.path.getmtime(path)
+            if entry is not None and mtime <= entry["mtime"]:
+                return entry
+            if time.time() - mtime > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, encoding='utf-8') as f:
+                stored = json.load(f)
+            return self._entry(stored["messages"], stored["created_at"], mtime)
+        except (OSError, ValueError, KeyError):
+            return entry
+
+    def _save(self, session_id, entry):
+        if not self.directory:
+            return
+        path = self._path(session_id)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"messages": entry["messages"], "created_at": entry["created_at"]}, f)
+            os.replace(temp_path, path)
+            entry["mtime"] = os.path.getmtime(path)
+        except OSError as e:
+            logger.warning("Could not persist chat session %s: %s", session_id[:8], e)
+
+    def _get_entry(self, session_id):
+        with self._lock:
+            self._evict(time.monotonic())
+            entry = self._sessions.get(session_id)
+        loaded = self._load(session_id, entry)
+        if loaded is not entry and loaded is not None:
+            with self._lock:
+                self._sessions[session_id] = loaded
+                self._evict(time.monotonic())
+        return loaded
+
+    @staticmethod
+    def new_id():
+        """An id for a new session, which is only stored once append() records its first turn"""
+        return secrets.token_urlsafe(16)
+
+    def context(self, session_id, new_messages):
+        """History plus new_messages trimmed to the token budget, or None for an unknown or expired session"""
+        entry = self._get_entry(session_id) if self.valid_id(session_id) else None
+        if entry is None:
+            return None
+        with self._lock:
+            entry["last_used"] = time.monotonic()
+            if session_id in self._sessions:
+                self._sessions.move_to_end(session_id)
+            history = list(entry["messages"])
+        return trim_to_token_budget(history + new_messages, self.token_budget)
+
+    def append(self, session_id, messages, create=False):
+        """Record a completed turn, starting the session with create; the stored history is trimmed to the token budget"""
+        entry = self._get_entry(session_id)
+        if entry is None:
+            if not create:
+                return
+            entry = self._entry([], time.time())
+        with self._lock:
+            updated = self._entry(trim_to_token_budget(entry["messages"] + messages, self.token_budget), entry["created_at"])
+            self._sessions[session_id] = updated
+            self._sessions.move_to_end(session_id)
+            self._evict(time.monotonic())
+        self._save(session_id, updated)
+
+    def delete(self, session_id):
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+        if self.directory and self.valid_id(session_id):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(session_id))
+                found = True
+        return found
+
+    def info(self, session_id):
+        """Size of one session: messages, estimated tokens and bytes of message text held"""
+        entry = self._get_entry(session_id) if self.valid_id(session_id) else None
+        if entry is None:
+            return None
+        return {
+            "session_id": session_id,
+            "messages": len(entry["messages"]),
+            "tokens": entry["tokens"],
+            "bytes": entry["bytes"],
+            "token_budget": self.token_budget,
+            "created_at": entry["created_at"],
+            "idle_seconds": round(time.monotonic() - entry["last_used"], 1)
+        }
+
+    def stats(self):
+        with self._lock:
+            self._evict(time.monotonic())
+            sizes = sorted(((entry["bytes"], session_id) for session_id, entry in self._sessions.items()), reverse=True)
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "bytes": sum(size for size, _ in sizes),
+                # Ids are truncated: they are the only credential for a session
+                "largest": [{"session": session_id[:8], "bytes": size} for size, session_id in sizes[:5]],
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "persistent": bool(self.directory)
+            }
+
+
+chat_sessions = ChatSessionStore(CHAT_SESSION_MAX, CHAT_SESSION_TTL, CHAT_SESSION_TOKEN_BUDGET, CHAT_SESSION_DIR or None)
+UNKNOWN_CHAT_SESSION = {"error": "Unknown or expired chat session; start a new one and resend the conversation", "session_expired": True}
+
+
+class ChatTurn:
+    """
+    One validated /api/chat request: its Ollama request and, in session mode, the session it
+    continues. answer() sends a plain request and stream() relays a streamed one; either
+    records the completed turn in the session.
+    """
+
+    def __init__(self, ollama_request, session_id=None, new_messages=None, new_session=False):
+        self.ollama_request = ollama_request
+        self.session_id = session_id
+        self.new_messages = new_messages
+        self.new_session = new_session
+
+    def record(self, reply_message):
+        # Only called once the turn succeeded, so a failed request can simply be resent
+        chat_sessions.append(self.session_id, self.new_messages + [reply_message], create=self.new_session)
+
+    def reply(self, body, status):
+        """(body, status) for a plain request, with the session id once the turn is recorded"""
+        if self.session_id and status == 200:
+            self.record(body["message"])
+            body["session_id"] = self.session_id
+        return body, status
+
+    def answer(self):
+        return self.reply(*call_ollama("/api/chat", self.ollama_request, format_ollama_chat_response))
+
+    async def answer_async(self):
+        return self.reply(*await call_ollama_async("/api/chat", self.ollama_request, format_ollama_chat_response))
+
+    def format_chunk(self, chunk):
+        formatted = format_ollama_chat_chunk(chunk)
+        if self.session_id:
+            formatted["session_id"] = self.session_id
+        return formatted
+
+    def stream(self):
+        """The OllamaStream relaying this turn; reserves an Ollama backend"""
+        on_done = (lambda reply: self.record({"role": "assistant", "content": reply})) if self.session_id else None
+        return OllamaStream("/api/chat", self.ollama_request, self.format_chunk, on_done)
+
+
+def prepare_chat_turn(request_data, stream):
+    """
+    Validate a /api/chat body and build its ChatTurn.
+    Returns (error, turn): error is a (body, status) pair to send instead. "session": true
+    only reserves an id here, so a request that fails never leaves an empty session behind.
+    """
+    messages = request_data.get('messages')
+    if not messages:
+        return ({"error": "No messages provided"}, 400), None
+    if not isinstance(messages, list) or not all(isinstance(m, dict) and isinstance(m.get('content') or '', str) for m in messages):
+        return ({"error": "messages must be a list of objects with a string content"}, 400), None
+    
+    # Session mode: the server keeps the history and the client sends only new messages
+    session_id, new_session = request_data.get('session_id'), False
+    if not session_id and request_data.get('session') is True:
+        session_id, new_session = chat_sessions.new_id(), True
+    if not session_id:
+        return None, ChatTurn(build_ollama_chat_request(request_data, stream))
+    
+    new_messages = format_chat_messages(messages)
+    context = trim_to_token_budget(new_messages, CHAT_SESSION_TOKEN_BUDGET) if new_session else chat_sessions.context(session_id, new_messages)
+    if context is None:
+        return (UNKNOWN_CHAT_SESSION, 404), None
+    return None, ChatTurn(build_ollama_chat_request(request_data, stream, context), session_id, new_messages, new_session)
+
+
+def chat_session_reply(method, session_id):
+    """(body, status) for /api/chat/sessions/<id>: the session's size, or its end with DELETE"""
+    if method == 'DELETE':
+        if not chat_sessions.delete(session_id):
+            return UNKNOWN_CHAT_SESSION, 404
+        return {"session_id": session_id, "deleted": True}, 200
+    info = chat_sessions.info(session_id)
+    if info is None:
+        return UNKNOWN_CHAT_SESSION, 404
+    return info, 200
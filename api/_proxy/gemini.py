@@ -0,0 +1,754 @@
+"""Gemini function calling: per-key clients, compiled models, and plain, streamed and batch calls"""
+import asyncio
+import contextvars
+import copy
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .caching import LRUCache, async_coalescer, coalescer, request_fingerprint
+from .logs import logger, sample_bodies
+from .metrics import metrics
+from .ollama_backends import call_ollama, call_ollama_async
+from .providers import provider_health, provider_router, route_request, route_request_async
+from .resilience import UpstreamAttempts, hedged_call, hedged_call_async, timed_upstream
+from .settings import (
+    FALLBACK_OLLAMA_MODEL, GEMINI_API_ENDPOINT, GEMINI_BATCH_MAX_ITEMS, GEMINI_BATCH_WORKERS, GEMINI_CLIENT_IDLE_TTL,
+    GEMINI_CLIENT_MAX, GEMINI_MODEL_CACHE_SIZE, GEMINI_PROBE_MODEL, PRELOAD_PROVIDER_SDKS
+)
+from .streaming import sse_event
+
+
+class GeminiClientRegistry:
+    """
+    Thread-safe registry of Gemini API clients, one per API key.
+    Replaces genai.configure(), which mutates process-global SDK state and lets
+    concurrent requests with different keys overwrite each other's configuration.
+    """
+
+    def __init__(self, max_clients, idle_ttl):
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self._clients = OrderedDict()  # sha256(api_key) -> {"client", "async_client", "last_used"}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key_id(api_key):
+        # Keys are only held by the client objects themselves, never as dict keys
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def _evict_idle(self, now):
+        while self._clients:
+            key_id, entry = next(iter(self._clients.items()))
+            if now - entry["last_used"] < self.idle_ttl:
+                break
+            self._clients.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, api_key):
+        """Return the client for this API key, creating it on first use"""
+        return self._client(api_key, "client", asynchronous=False)
+
+    def get_async(self, api_key):
+        """Return the asyncio client for this API key (SERVER_MODE=async), creating it on first use"""
+        return self._client(api_key, "async_client", asynchronous=True)
+
+    def _client(self, api_key, kind, asynchronous):
+        # Each kind opens its own gRPC channel, so only the one the serving mode uses is created
+        entry = self._entry(api_key)
+        with self._lock:
+            if entry.get(kind) is None:
+                entry[kind] = new_gemini_client(api_key, asynchronous=asynchronous)
+            return entry[kind]
+
+    def _entry(self, api_key):
+        key_id = self.key_id(api_key)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key_id)
+            if entry is None:
+                # Evicted clients are not closed explicitly: a request may still hold
+                # one, and the gRPC channel is released once the last reference goes
+                entry = {}
+                self._clients[key_id] = entry
+                self.created += 1
+                while len(self._clients) > self.max_clients:
+                    self._clients.popitem(last=False)
+                    self.evicted += 1
+            entry["last_used"] = now
+            self._clients.move_to_end(key_id)
+            return entry
+
+    def stats(self):
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            return {
+                "size": len(self._clients),
+                "max_clients": self.max_clients,
+                "idle_ttl": self.idle_ttl,
+                "created": self.created,
+                "evicted": self.evicted
+            }
+
+
+_gemini_sdk = None
+_gemini_sdk_lock = threading.Lock()
+
+
+def gemini_sdk():
+    """
+    Import google.generativeai on first use and return it. With its gRPC and protobuf
+    stack it takes about a second to import, which workers that only serve Ollama or
+    Replicate routes never need to pay.
+    """
+    global _gemini_sdk
+    if _gemini_sdk is None:
+        with _gemini_sdk_lock:
+            if _gemini_sdk is None:
+                start = time.perf_counter()
+                import google.generativeai as genai
+                _gemini_sdk = genai
+                logger.info("Loaded Gemini SDK in %.0f ms", (time.perf_counter() - start) * 1000)
+    return _gemini_sdk
+
+
+def new_gemini_client(api_key, asynchronous=False):
+    """Create a Gemini client for api_key, or an unauthenticated one when GEMINI_API_ENDPOINT is set"""
+    gemini_sdk()
+    from google.ai import generativelanguage as glm
+    if not GEMINI_API_ENDPOINT:
+        client_class = glm.GenerativeServiceAsyncClient if asynchronous else glm.GenerativeServiceClient
+        return client_class(client_options={"api_key": api_key})
+    
+    import grpc
+    from google.ai.generativelanguage_v1beta.services.generative_service import transports
+    if asynchronous:
+        channel = grpc.aio.insecure_channel(GEMINI_API_ENDPOINT)
+        return glm.GenerativeServiceAsyncClient(transport=transports.GenerativeServiceGrpcAsyncIOTransport(channel=channel))
+    channel = grpc.insecure_channel(GEMINI_API_ENDPOINT)
+    return glm.GenerativeServiceClient(transport=transports.GenerativeServiceGrpcTransport(channel=channel))
+
+
+gemini_clients = GeminiClientRegistry(GEMINI_CLIENT_MAX, GEMINI_CLIENT_IDLE_TTL)
+
+
+gemini_model_cache = LRUCache(GEMINI_MODEL_CACHE_SIZE)
+
+
+def build_gemini_function_declarations(tools_json_string):
+    """Convert the OpenAI-style tools JSON string into Gemini FunctionDeclarations"""
+    parsed_tools_list = json.loads(tools_json_string)  # This is a list of OpenAI-like tool objects
+    genai = gemini_sdk()
+    function_declarations = []
+    
+    for tool_def in parsed_tools_list:
+        if tool_def.get("type") == "function" and "function" in tool_def:
+            func_details = tool_def["function"]
+            # Create a FunctionDeclaration for each tool
+            declaration = genai.types.FunctionDeclaration(
+                name=func_details["name"],
+                description=func_details.get("description", ""),
+                parameters=func_details.get("parameters")
+            )
+            function_declarations.append(declaration)
+            logger.debug("Added function declaration: %s", func_details['name'])
+    return function_declarations
+
+
+def get_compiled_gemini_model(tools_json_string, model_name, generation_config_params):
+    """
+    Return the parsed declarations and a ready GenerativeModel for this tools payload,
+    model name and generation config, building them only on a cache miss
+    """
+    tools_hash = hashlib.sha256(tools_json_string.encode('utf-8')).hexdigest()
+    cache_key = (tools_hash, model_name, json.dumps(generation_config_params, sort_keys=True))
+    compiled = gemini_model_cache.get(cache_key)
+    if compiled is not None:
+        return compiled
+    
+    function_declarations = build_gemini_function_declarations(tools_json_string)
+    genai = gemini_sdk()
+    # If no function declarations, proceed without tools (text-only)
+    if not function_declarations:
+        gemini_tool_config = []
+    else:
+        # Gemini expects a Tool object containing the list of function declarations
+        gemini_tool_config = [genai.types.Tool(function_declarations=function_declarations)]
+    logger.info("Created tool config with %d function declarations", len(function_declarations))
+    
+    # Initialize the Gemini model with tools
+    model = genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=genai.types.GenerationConfig(**generation_config_params),
+        tools=gemini_tool_config,
+        # Use a dictionary directly for the tool_config
+        tool_config={'function_calling_config': {'mode': 'ANY'}}
+    )
+    compiled = {
+        "tools_hash": tools_hash,
+        "function_declarations": function_declarations,
+        "tool_config": gemini_tool_config,
+        "model": model
+    }
+    gemini_model_cache.put(cache_key, compiled)
+    return compiled
+
+
+def function_call_to_dict(fc):
+    """Convert a Gemini FunctionCall into the {name, arguments} shape the frontend expects"""
+    return {
+        "name": fc.name,
+        "arguments": dict(fc.args) if hasattr(fc, 'args') else {}
+    }
+
+
+def gemini_request_params(request_data):
+    """
+    Read query, tools, model and generation config from a /api/gemini_functions body.
+    Raises ValueError with a client-facing message when a required parameter is missing.
+    """
+    query = request_data.get('query')
+    if not query:
+        raise ValueError("Parameter 'query' is required")
+    return (query,) + gemini_model_params(request_data)
+
+
+def gemini_model_params(request_data):
+    """Read tools, model and generation config, shared by the single and batch endpoints"""
+    tools_json_string = request_data.get('tools')  # Expected as JSON string from createDefaultWeb3Tools
+    
+    # main branch default model for function calling
+    model_name = request_data.get('model', 'gemini-3-flash-preview')
+    
+    temperature = request_data.get('temperature', 0.7)
+    top_p = request_data.get('top_p')  # Gemini supports top_p
+    max_output_tokens = request_data.get('max_output_tokens', request_data.get('max_new_tokens', 2048))
+    
+    if not tools_json_string:
+        raise ValueError("Parameter 'tools' (JSON string) is required")
+    
+    # Set up generation config parameters
+    generation_config_params = {
+        "temperature": float(temperature),
+        "max_output_tokens": int(max_output_tokens)
+    }
+    if top_p is not None:
+        generation_config_params["top_p"] = float(top_p)
+    
+    return tools_json_string, model_name, generation_config_params
+
+
+def gemini_batch_queries(request_data):
+    """
+    Read the "queries" list of a /api/gemini_functions/batch body.
+    Raises ValueError for a missing, empty or oversized list; invalid items are reported per item.
+    """
+    queries = request_data.get('queries')
+    if not isinstance(queries, list) or not queries:
+        raise ValueError("Parameter 'queries' must be a non-empty list")
+    if len(queries) > GEMINI_BATCH_MAX_ITEMS:
+        raise ValueError(f"At most {GEMINI_BATCH_MAX_ITEMS} queries are allowed per batch")
+    return queries
+
+
+def gemini_batch_item(index, result):
+    """One batch result: the single endpoint's body plus its index and HTTP status"""
+    body, status = result
+    return {"index": index, "status_code": status, **body}
+
+
+def gemini_batch_body(items):
+    return {
+        "id": f"gemini-batch-{int(time.time())}",
+        "results": items,
+        "succeeded": sum(1 for item in items if item["status_code"] < 400),
+        "failed": sum(1 for item in items if item["status_code"] >= 400)
+    }
+
+
+INVALID_BATCH_QUERY = ({"status": "error", "error": "Each query must be a non-empty string"}, 400)
+
+
+def extract_gemini_parts(response):
+    """Collect function calls and text from the first candidate of a Gemini response"""
+    function_calls_for_frontend = []
+    text_content = None
+    
+    # Process Gemini's response parts with better error handling
+    if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        logger.debug("Received %d response parts from Gemini", len(response.candidates[0].content.parts))
+        for part in response.candidates[0].content.parts:
+            # Handle function calls
+            if hasattr(part, 'function_call') and part.function_call:
+                function_call_data = function_call_to_dict(part.function_call)
+                function_calls_for_frontend.append(function_call_data)
+                logger.debug("Gemini requested function: %s with args: %s", function_call_data['name'], function_call_data['arguments'])
+            
+            # Handle text content
+            if hasattr(part, 'text') and part.text:
+                text_content = part.text
+                logger.debug("Gemini returned text: %.100s", text_content)
+    else:
+        logger.warning("No valid response content found in Gemini response")
+        if sample_bodies():
+            logger.debug("Response structure: %.500s", response)
+    
+    return function_calls_for_frontend, text_content
+
+
+def gemini_block_reason(response):
+    """Return the prompt block reason name, or None if the prompt was not blocked"""
+    if hasattr(response, 'prompt_feedback') and response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason') and response.prompt_feedback.block_reason:
+        block_reason = response.prompt_feedback.block_reason
+        return block_reason.name if hasattr(block_reason, 'name') else str(block_reason)
+    return None
+
+
+def gemini_blocked_body(response, reason):
+    return {
+        "error": f"Gemini request blocked due to: {reason}",
+        "details": str(response.prompt_feedback)
+    }
+
+
+def gemini_caller_error_status(e):
+    """
+    HTTP status of a 4xx-class Gemini API error (invalid argument or key, permission denied,
+    quota exhausted), or None for transport errors, timeouts and 5xx, which are Gemini's own
+    """
+    # Loaded by the SDK before it can raise any API error, so not imported here
+    exceptions = sys.modules.get('google.api_core.exceptions')
+    if exceptions is None or not isinstance(e, exceptions.ClientError):
+        return None
+    return int(e.code) if e.code and 400 <= e.code < 500 else 400
+
+
+def gemini_rejected_body(e):
+    return {
+        "status": "error",
+        "error": "Gemini rejected the request. Check the API key and request.",
+        "details": str(e)[:500]
+    }
+
+
+def gemini_empty_body(response_id=None):
+    # Returned with a 200 once retries are exhausted so the frontend shows a helpful message
+    return {
+        "id": response_id or f"gemini-func-{int(time.time())}",
+        "output": "I couldn't process your request properly. Please try rephrasing your question.",
+        "status": "partial_failure"
+    }
+
+
+class GeminiAttempts(UpstreamAttempts):
+    """
+    Outcomes of function calling attempts, shared by the plain and streamed, sync and
+    async paths; methods return (body, status), or None to retry after backoff()
+    """
+
+    def __init__(self, response_id=None):
+        super().__init__("gemini")
+        self.response_id = response_id
+
+    def completed(self, response, function_calls_for_frontend, text_content):
+        if function_calls_for_frontend or text_content:
+            provider_router.record("gemini", True)
+            return gemini_success_body(function_calls_for_frontend, text_content, self.response_id), 200
+        
+        reason = gemini_block_reason(response)
+        if reason:
+            metrics.inc('proxy_gemini_blocked_responses_total')
+            logger.warning("Gemini request blocked: %s", reason)
+            return gemini_blocked_body(response, reason), 400
+        
+        metrics.inc('proxy_gemini_empty_responses_total')
+        if self.retry("empty"):
+            logger.warning("Attempt %d: Gemini returned empty response. Retrying...", self.retry_count)
+            return None
+        # Out of retries: a null output with a more helpful message
+        logger.warning("Maximum retries exceeded with empty responses")
+        provider_router.record("gemini", True)
+        return gemini_empty_body(self.response_id), 200
+
+    def failed(self, e, retryable=True):
+        """Call from the except block; streams pass retryable=False once events were sent"""
+        status = gemini_caller_error_status(e)
+        if status:
+            # A bad key, request or quota says nothing about Gemini's health and fails again on retry
+            logger.warning("Gemini rejected the request (%d): %s", status, e)
+            provider_router.record("gemini", True)
+            return gemini_rejected_body(e), status
+        logger.exception("Error during Gemini API call: %s", e)
+        if retryable and self.retry("error"):
+            logger.warning("Retrying after error (attempt %d/%d)", self.retry_count, self.max_retries)
+            return None
+        provider_router.record("gemini", False)
+        return gemini_error_body(e), 502
+
+
+def gemini_success_body(function_calls_for_frontend, text_content, response_id=None):
+    # Prioritize function calls in the 'output' field for the frontend
+    # as this endpoint's primary purpose is function calling
+    output_data = None
+    if function_calls_for_frontend:
+        output_data = function_calls_for_frontend
+        logger.info("Returning %d function calls to frontend", len(function_calls_for_frontend))
+    elif text_content:  # Fallback to text if no function calls
+        output_data = text_content
+        logger.info("Returning text content to frontend (no function calls)")
+    
+    return {
+        "id": response_id or f"gemini-func-{int(time.time())}",
+        "status": "succeeded",
+        "output": output_data,  # This will be array of func_calls or text string
+        "text_if_any": text_content  # Explicitly provide text if it co-existed with function calls
+    }
+
+
+def gemini_error_body(e):
+    # Structured, friendly error response for frontend
+    return {
+        "status": "error",
+        "error": "AI backend error. Please try again shortly.",
+        "details": str(e)[:500]
+    }
+
+
+def gemini_chunk_events(chunk, response_id, function_calls_for_frontend, text_chunks):
+    """
+    Yield an SSE event for every function call and text part in a streamed Gemini chunk,
+    collecting them into the given lists for the final 'done' event
+    """
+    if not (chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts):
+        return
+    for part in chunk.candidates[0].content.parts:
+        if hasattr(part, 'function_call') and part.function_call:
+            function_call_data = function_call_to_dict(part.function_call)
+            function_calls_for_frontend.append(function_call_data)
+            logger.debug("Streaming Gemini function call: %s", function_call_data['name'])
+            yield sse_event({"id": response_id, "function_call": function_call_data}, event="function_call")
+        if hasattr(part, 'text') and part.text:
+            text_chunks.append(part.text)
+            yield sse_event({"id": response_id, "text": part.text}, event="text")
+
+
+def gemini_body_events(body, status):
+    """SSE events for a complete function calling body that did not come from a Gemini stream"""
+    if status >= 400:
+        yield sse_event(body, event="error")
+        return
+    if isinstance(body.get("output"), list):
+        for function_call_data in body["output"]:
+            yield sse_event({"id": body["id"], "function_call": function_call_data}, event="function_call")
+    if body.get("text_if_any"):
+        yield sse_event({"id": body["id"], "text": body["text_if_any"]}, event="text")
+    yield sse_event(body, event="done")
+
+
+def build_ollama_tools_request(query, tools_json_string, generation_config_params):
+    """Build the Ollama /api/chat payload used when function calling falls back from Gemini"""
+    return {
+        "model": FALLBACK_OLLAMA_MODEL,
+        "messages": [{"role": "user", "content": query}],
+        # Ollama takes the same OpenAI-style tool definitions the frontend sends
+        "tools": json.loads(tools_json_string),
+        "stream": False,
+        "options": {
+            "temperature": generation_config_params["temperature"]
+        }
+    }
+
+
+def format_ollama_tools_response(ollama_response):
+    # Same body shape as Gemini function calling, so the frontend can't tell the difference
+    message = ollama_response.get("message", {})
+    function_calls_for_frontend = [
+        {"name": call.get("function", {}).get("name"), "arguments": call.get("function", {}).get("arguments") or {}}
+        for call in message.get("tool_calls") or []
+    ]
+    text_content = message.get("content") or None
+    if not function_calls_for_frontend and not text_content:
+        return gemini_empty_body()
+    return gemini_success_body(function_calls_for_frontend, text_content)
+
+
+class GeminiRequest:
+    """
+    One function calling query, ready to send: the cached compiled model and the client for
+    the caller's API key, plus what coalescing and the Ollama fallback need. The serving
+    modes build one per request (or per batch query) and hand it to the calls below.
+    """
+
+    def __init__(self, api_key, client, compiled, query, tools_json_string, model_name, generation_config_params,
+                 bypass=False, asynchronous=False, tool_selection=None):
+        self.client = client
+        self.compiled = compiled
+        self.query = query
+        self.tools_json_string = tools_json_string
+        self.model_name = model_name
+        self.generation_config_params = generation_config_params
+        self.bypass = bypass
+        self.asynchronous = asynchronous
+        self.tool_selection = tool_selection
+        # Identical concurrent requests share one upstream call; temperature 0 answers are cached
+        self.coalesce_key = request_fingerprint(
+            "gemini", GeminiClientRegistry.key_id(api_key), query,
+            compiled["tools_hash"], model_name, generation_config_params
+        )
+        self.cacheable = generation_config_params["temperature"] == 0
+
+    def model(self):
+        # Shallow copy of the cached model bound to this request's API key client
+        model = copy.copy(self.compiled["model"])
+        if self.asynchronous:
+            model._async_client = self.client
+        else:
+            model._client = self.client
+        return model
+
+    def ollama_request(self):
+        return build_ollama_tools_request(self.query, self.tools_json_string, self.generation_config_params)
+
+
+def send_gemini_message(gemini_request):
+    """One function calling attempt against Gemini"""
+    # Using a chat session for function calling
+    chat = gemini_request.model().start_chat()
+    with timed_upstream("gemini"):
+        return chat.send_message(gemini_request.query)
+
+
+async def send_gemini_message_async(gemini_request):
+    chat = gemini_request.model().start_chat()
+    with timed_upstream("gemini"):
+        return await chat.send_message_async(gemini_request.query)
+
+
+def call_gemini_function_calling(gemini_request):
+    """
+    Run a non-streaming function calling request with budgeted retries, returning (body, status).
+    Attempts that outlast Gemini's usual latency are hedged.
+    """
+    attempts = GeminiAttempts()
+    while True:
+        try:
+            response = hedged_call("gemini", lambda: send_gemini_message(gemini_request))
+            result = attempts.completed(response, *extract_gemini_parts(response))
+        except Exception as e:
+            result = attempts.failed(e)
+        if result is not None:
+            return result
+        time.sleep(attempts.backoff())
+
+
+async def call_gemini_function_calling_async(gemini_request):
+    """Awaited counterpart of call_gemini_function_calling: the backoff holds no thread"""
+    attempts = GeminiAttempts()
+    while True:
+        try:
+            response = await hedged_call_async("gemini", lambda: send_gemini_message_async(gemini_request))
+            result = attempts.completed(response, *extract_gemini_parts(response))
+        except Exception as e:
+            result = attempts.failed(e)
+        if result is not None:
+            return result
+        await asyncio.sleep(attempts.backoff())
+
+
+def call_gemini(gemini_request):
+    """Function calling through the response coalescer, returning (body, status, headers) with X-Cache"""
+    result, cache_source = coalescer.run(
+        gemini_request.coalesce_key,
+        lambda: call_gemini_function_calling(gemini_request),
+        cacheable=gemini_request.cacheable,
+        bypass=gemini_request.bypass
+    )
+    return result + ({"X-Cache": cache_source},)
+
+
+async def call_gemini_async(gemini_request):
+    result, cache_source = await async_coalescer.run(
+        gemini_request.coalesce_key,
+        lambda: call_gemini_function_calling_async(gemini_request),
+        cacheable=gemini_request.cacheable,
+        bypass=gemini_request.bypass
+    )
+    return result + ({"X-Cache": cache_source},)
+
+
+def call_gemini_fallback(gemini_request):
+    """The same query answered by Ollama's tool calling, as (body, status) in Gemini's body shape"""
+    return call_ollama("/api/chat", gemini_request.ollama_request(), format_ollama_tools_response)
+
+
+async def call_gemini_fallback_async(gemini_request):
+    return await call_ollama_async("/api/chat", gemini_request.ollama_request(), format_ollama_tools_response)
+
+
+def answer_gemini_request(gemini_request):
+    """
+    (body, status, headers) for a non-streaming request: Gemini's answer or, while it is down,
+    Ollama's. Fallback answers come from another model, so they bypass the coalescer and are never cached.
+    """
+    return route_request("gemini", lambda: call_gemini(gemini_request), lambda: call_gemini_fallback(gemini_request))
+
+
+async def answer_gemini_request_async(gemini_request):
+    return await route_request_async(
+        "gemini", lambda: call_gemini_async(gemini_request), lambda: call_gemini_fallback_async(gemini_request)
+    )
+
+
+def stream_gemini_function_calls(gemini_request):
+    """
+    Streaming variant of /api/gemini_functions, a generator of SSE events.
+    Emits a 'function_call' or 'text' event for every part as soon as Gemini streams it,
+    then a final 'done' event with the same body the non-streaming endpoint returns.
+    Retries only happen while nothing has been sent to the client yet.
+    """
+    attempts = GeminiAttempts(f"gemini-func-{int(time.time())}")
+    while True:
+        function_calls_for_frontend = []
+        text_chunks = []
+        try:
+            chat = gemini_request.model().start_chat()
+            # Time to the first chunk, kept apart from full calls so it never lowers the hedge delay
+            with timed_upstream("gemini_stream"):
+                response = chat.send_message(gemini_request.query, stream=True)
+            
+            for chunk in response:
+                yield from gemini_chunk_events(chunk, attempts.response_id, function_calls_for_frontend, text_chunks)
+            result = attempts.completed(response, function_calls_for_frontend, "".join(text_chunks) or None)
+        except Exception as e:
+            # Once events have reached the client a retry would duplicate them
+            result = attempts.failed(e, retryable=not function_calls_for_frontend and not text_chunks)
+        if result is not None:
+            body, status = result
+            yield sse_event(body, event="error" if status >= 400 else "done")
+            return
+        time.sleep(attempts.backoff())
+
+
+async def stream_gemini_function_calls_async(gemini_request):
+    """Async generator counterpart of stream_gemini_function_calls"""
+    attempts = GeminiAttempts(f"gemini-func-{int(time.time())}")
+    while True:
+        function_calls_for_frontend = []
+        text_chunks = []
+        try:
+            chat = gemini_request.model().start_chat()
+            with timed_upstream("gemini_stream"):
+                response = await chat.send_message_async(gemini_request.query, stream=True)
+            
+            async for chunk in response:
+                for event in gemini_chunk_events(chunk, attempts.response_id, function_calls_for_frontend, text_chunks):
+                    yield event
+            result = attempts.completed(response, function_calls_for_frontend, "".join(text_chunks) or None)
+        except Exception as e:
+            result = attempts.failed(e, retryable=not function_calls_for_frontend and not text_chunks)
+        if result is not None:
+            body, status = result
+            yield sse_event(body, event="error" if status >= 400 else "done")
+            return
+        await asyncio.sleep(attempts.backoff())
+
+
+def gemini_events(gemini_request, provider):
+    """
+    SSE events for a streamed request routed to provider: Gemini's own stream, or the
+    fallback's complete answer replayed as the same events. Streams only fall back before
+    they start; nothing is retried once events were sent.
+    """
+    if provider == "gemini":
+        return stream_gemini_function_calls(gemini_request)
+    return gemini_body_events(*call_gemini_fallback(gemini_request))
+
+
+async def gemini_events_async(gemini_request, provider):
+    """Awaited counterpart of gemini_events, returning an async iterator of events"""
+    if provider == "gemini":
+        return stream_gemini_function_calls_async(gemini_request)
+    events = gemini_body_events(*await call_gemini_fallback_async(gemini_request))
+    
+    async def replay():
+        for event in events:
+            yield event
+    
+    return replay()
+
+
+# Shared by every batch so concurrent batches can't exceed GEMINI_BATCH_WORKERS upstream calls
+gemini_batch_pool = ThreadPoolExecutor(max_workers=GEMINI_BATCH_WORKERS, thread_name_prefix='gemini-batch')
+
+
+def answer_gemini_batch(gemini_requests):
+    """
+    Answer a batch's queries concurrently on the shared pool, with the single endpoint's
+    coalescing, caching and fallback. None entries are invalid queries. Returns the batch body,
+    results in order.
+    """
+    futures = [
+        gemini_batch_pool.submit(contextvars.copy_context().run, answer_gemini_request, gemini_request)
+        if gemini_request is not None else None
+        for gemini_request in gemini_requests
+    ]
+    items = []
+    for index, future in enumerate(futures):
+        if future is None:
+            items.append(gemini_batch_item(index, INVALID_BATCH_QUERY))
+            continue
+        try:
+            body, status, _ = future.result()
+            items.append(gemini_batch_item(index, (body, status)))
+        except Exception as e:
+            logger.error("Batch query %d failed: %s", index, e)
+            items.append(gemini_batch_item(index, (gemini_error_body(e), 502)))
+    return gemini_batch_body(items)
+
+
+async def answer_gemini_batch_async(gemini_requests, slots):
+    """Awaited counterpart of answer_gemini_batch; slots is the semaphore shared by every batch"""
+    async def answer(index, gemini_request):
+        if gemini_request is None:
+            return gemini_batch_item(index, INVALID_BATCH_QUERY)
+        try:
+            async with slots:
+                body, status, _ = await answer_gemini_request_async(gemini_request)
+            result = body, status
+        except Exception as e:
+            logger.error("Batch query %d failed: %s", index, e)
+            result = gemini_error_body(e), 502
+        return gemini_batch_item(index, result)
+    
+    items = await asyncio.gather(*(answer(index, gemini_request) for index, gemini_request in enumerate(gemini_requests)))
+    return gemini_batch_body(list(items))
+
+
+def probe_gemini(timeout):
+    # Only a server-owned key: a caller's key may be invalid or out of quota, which says nothing about Gemini
+    api_key = os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY')
+    if not api_key:
+        return {"status": "unconfigured"}
+    # Probing would import the SDK; wait until a Gemini request (or PRELOAD_PROVIDER_SDKS) has loaded it
+    if _gemini_sdk is None:
+        return {"status": "not_loaded"}
+    gemini_clients.get(api_key).count_tokens(
+        request={"model": f"models/{GEMINI_PROBE_MODEL}", "contents": [{"role": "user", "parts": [{"text": "ping"}]}]},
+        retry=None,  # The SDK's default retry would hold the probe for up to a minute
+        timeout=timeout
+    )
+    return {"status": "up"}
+
+
+provider_health.register("gemini", probe_gemini)
+
+if PRELOAD_PROVIDER_SDKS:
+    gemini_sdk()
@@ -0,0 +1,263 @@
+"""
+Request handling shared by the Flask app and the aiohttp app (SERVER_MODE=async).
+Each function takes the parsed body, headers and query args and returns either a
+(body, status[, headers]) reply or what the route needs to make its upstream call, so
+the two serving modes only differ in how they read requests and write responses.
+"""
+import json
+import logging
+import os
+
+from .admission import rate_limiter
+from .caching import cache_bypassed
+from .chat_sessions import chat_sessions, prepare_chat_turn
+from .gemini import (
+    GeminiRequest, gemini_batch_queries, gemini_clients, gemini_model_cache, gemini_model_params, gemini_request_params,
+    get_compiled_gemini_model
+)
+from .logs import logger, mask_secret, redacted_headers, sample_bodies
+from .ollama_backends import build_ollama_generate_request, ollama_pool
+from .providers import pick_provider, provider_health, provider_router
+from .replicate_api import replicate_jobs
+from .resilience import hedge_policy, retry_budget
+from .streaming import wants_stream
+from .tool_selection import is_uncached_gemini_answer, tool_selection_headers, tool_selector
+
+REQUEST_BODY_REQUIRED = ({"error": "Request body is required"}, 400)
+REPLICATE_TOKEN_REQUIRED = ({"error": "Replicate API token is required"}, 401)
+GEMINI_KEY_REQUIRED = ({"error": "Gemini API key is required to use the function calling feature"}, 401)
+
+
+def gemini_api_key(headers):
+    # Support both GEMINI_API_KEY and GOOGLE_API_KEY for Render/Google compatibility
+    return headers.get('X-Gemini-API-Key') or os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY')
+
+
+def prepare_replicate_request(request_data, headers):
+    """Validate a /api/replicate request, returning (error, api_token)"""
+    if not request_data:
+        return REQUEST_BODY_REQUIRED, None
+    
+    # Get the API token from the headers
+    api_token = headers.get('X-Replicate-API-Token')
+    if not api_token:
+        return REPLICATE_TOKEN_REQUIRED, None
+    
+    logger.info("Forwarding request to Replicate API")
+    if sample_bodies():
+        logger.debug("Replicate request body: %.500s", json.dumps(request_data))
+    return None, api_token
+
+
+def replicate_job_reply(job_id, headers):
+    """(body, status) with the last polled state of a prediction started with /api/replicate?async=1"""
+    api_token = headers.get('X-Replicate-API-Token')
+    if not api_token:
+        return REPLICATE_TOKEN_REQUIRED
+    
+    prediction = replicate_jobs.get(job_id, api_token)
+    if prediction is None:
+        return {"error": f"Unknown Replicate job: {job_id}"}, 404
+    return prediction, 200
+
+
+def gemini_client_for(api_key, asynchronous):
+    """(error, client): per-key client instead of genai.configure, which is process-global"""
+    try:
+        return None, gemini_clients.get_async(api_key) if asynchronous else gemini_clients.get(api_key)
+    except Exception as e:
+        logger.error("Failed to configure Gemini SDK: %s", e)
+        return ({"error": f"Failed to configure Gemini SDK: {str(e)}"}, 500), None
+
+
+def compile_gemini_model(tools_json_string, model_name, generation_config_params):
+    """
+    (error, compiled): convert OpenAI-style tools (from createDefaultWeb3Tools) to Gemini format,
+    reusing the compiled declarations and model when this combination was seen before
+    """
+    try:
+        return None, get_compiled_gemini_model(tools_json_string, model_name, generation_config_params)
+    except json.JSONDecodeError:
+        logger.warning("Invalid JSON string for 'tools': %.100s", tools_json_string)
+        return ({"error": "Invalid JSON string for 'tools'"}, 400), None
+    except Exception as e:
+        logger.error("Error processing tools for Gemini: %s", e)
+        return ({"error": f"Error processing tools for Gemini: {str(e)}"}, 500), None
+
+
+def prepare_gemini_request(request_data, headers, asynchronous=False):
+    """Validate a /api/gemini_functions request, returning (error, GeminiRequest)"""
+    api_key = gemini_api_key(headers)
+    if logger.isEnabledFor(logging.DEBUG):
+        # Keys are masked; the body is only logged for sampled requests
+        logger.debug("/api/gemini_functions headers: %s", redacted_headers(headers))
+        logger.debug("Gemini API key source: %s", "header" if headers.get('X-Gemini-API-Key') else "environment" if api_key else "none")
+        if sample_bodies():
+            logger.debug("Raw request body: %.500s", json.dumps(request_data))
+    
+    if not api_key:
+        logger.warning("No Gemini API key in X-Gemini-API-Key header or environment, sending 401")
+        return GEMINI_KEY_REQUIRED, None
+    error, client = gemini_client_for(api_key, asynchronous)
+    if error:
+        return error, None
+    
+    try:
+        query, tools_json_string, model_name, generation_config_params = gemini_request_params(request_data)
+        # Large tool sets are narrowed to the tools relevant to this query when enabled
+        tools_json_string, tool_selection = tool_selector.select(query, tools_json_string, request_data.get('tool_top_k'))
+    except ValueError as e:
+        return ({"error": str(e)}, 400), None
+    
+    error, compiled = compile_gemini_model(tools_json_string, model_name, generation_config_params)
+    if error:
+        return error, None
+    
+    logger.info("Requesting Gemini (%s) for function calling, query length %d", model_name, len(query))
+    return None, GeminiRequest(
+        api_key, client, compiled, query, tools_json_string, model_name, generation_config_params,
+        bypass=cache_bypassed(headers), asynchronous=asynchronous, tool_selection=tool_selection
+    )
+
+
+def gemini_reply(gemini_request, reply, seconds):
+    """Add the tool selection headers to a non-streaming reply and time it for the savings report"""
+    body, status, headers = reply
+    if is_uncached_gemini_answer(status, headers):
+        tool_selector.observe(gemini_request.tool_selection, seconds)
+    return body, status, dict(headers, **tool_selection_headers(gemini_request.tool_selection))
+
+
+def prepare_gemini_batch(request_data, headers, asynchronous=False):
+    """
+    Validate a /api/gemini_functions/batch request, returning (error, gemini_requests):
+    one GeminiRequest per query sharing the compiled tools, or None for an invalid query
+    """
+    api_key = gemini_api_key(headers)
+    if not api_key:
+        return GEMINI_KEY_REQUIRED, None
+    error, client = gemini_client_for(api_key, asynchronous)
+    if error:
+        return error, None
+    
+    try:
+        queries = gemini_batch_queries(request_data)
+        tools_json_string, model_name, generation_config_params = gemini_model_params(request_data)
+    except ValueError as e:
+        return ({"error": str(e)}, 400), None
+    
+    error, compiled = compile_gemini_model(tools_json_string, model_name, generation_config_params)
+    if error:
+        return error, None
+    
+    logger.info("Running a batch of %d Gemini (%s) function calling queries", len(queries), model_name)
+    bypass = cache_bypassed(headers)
+    return None, [
+        GeminiRequest(
+            api_key, client, compiled, query, tools_json_string, model_name, generation_config_params,
+            bypass=bypass, asynchronous=asynchronous
+        )
+        if isinstance(query, str) and query else None
+        for query in queries
+    ]
+
+
+def gemini_health_body():
+    # Reachability comes from the background prober's cache; the check itself calls nothing upstream
+    return {
+        "status": "success",
+        "message": "Gemini API key configured successfully.",
+        "provider": provider_health.status("gemini"),
+        "circuit": provider_router.breakers["gemini"].stats()
+    }
+
+
+def gemini_health_status():
+    return 503 if provider_health.status("gemini")["status"] == "down" or provider_router.breakers["gemini"].is_open() else 200
+
+
+def gemini_health_reply(headers, asynchronous=False):
+    """
+    (body, status) for /api/gemini_health: whether a Gemini API key is configured.
+    Upstream status is the background prober's cached result, so this never waits on Gemini.
+    """
+    logger.debug("Received request for /api/gemini_health")
+    api_key = gemini_api_key(headers)
+    
+    if not api_key:
+        logger.warning("Health check: No Gemini API key found in headers or environment.")
+        return {"status": "error", "message": "Gemini API key not found in X-Gemini-API-Key header or GEMINI_API_KEY environment variable."}, 401
+    
+    logger.debug("Health check: Attempting to configure Gemini with key: %s", mask_secret(api_key))
+    try:
+        gemini_clients.get_async(api_key) if asynchronous else gemini_clients.get(api_key)
+        logger.debug("Health check: Gemini SDK configured successfully.")
+        return gemini_health_body(), gemini_health_status()
+    except Exception as e:
+        logger.error("Health check: Failed to configure Gemini SDK: %s", e)
+        return {"status": "error", "message": "Failed to configure Gemini API key.", "details": str(e)}, 500
+
+
+def prepare_chat_request(request_data, args):
+    """Validate a /api/chat request, returning (error, ChatTurn)"""
+    if not request_data:
+        return REQUEST_BODY_REQUIRED, None
+    
+    error, turn = prepare_chat_turn(request_data, wants_stream(request_data, args))
+    if error:
+        return error, None
+    
+    ollama_request = turn.ollama_request
+    logger.info("Sending chat request to Ollama (model %s, %d messages)", ollama_request["model"], len(ollama_request["messages"]))
+    error, _ = pick_provider("ollama")
+    if error:
+        return error, None
+    return None, turn
+
+
+def chat_failed(e):
+    error_message = f"Error in chat endpoint: {str(e)}"
+    logger.error(error_message)
+    return {"error": error_message}, 500
+
+
+def prepare_ollama_request(request_data, args):
+    """Validate a /api/ollama request, returning (error, ollama_request)"""
+    if not request_data:
+        return REQUEST_BODY_REQUIRED, None
+    
+    ollama_request = build_ollama_generate_request(request_data, wants_stream(request_data, args))
+    logger.info("Forwarding request to Ollama, prompt length %d", len(ollama_request['prompt']))
+    error, _ = pick_provider("ollama")
+    if error:
+        return error, None
+    return None, ollama_request
+
+
+def ollama_failed(e):
+    error_message = f"Error communicating with Ollama: {str(e)}"
+    logger.error(error_message)
+    return {"error": error_message}, 500
+
+
+def upstream_stats_body(http_client, route_limiters):
+    """Connection pool usage and request counters for each upstream host, with the serving mode's client and limiters"""
+    return {
+        "upstreams": http_client.stats(),
+        "ollama_backends": ollama_pool.stats(),
+        "replicate_jobs": replicate_jobs.stats(),
+        "retry_budget": retry_budget.stats(),
+        "hedging": hedge_policy.stats(),
+        "admission": {"rate_limits": rate_limiter.stats(), "routes": {route: limiter.stats() for route, limiter in route_limiters.items()}}
+    }
+
+
+def cache_stats_body(responses_coalescer):
+    """Hit/miss counters for the in-process caches"""
+    return {
+        "gemini_models": gemini_model_cache.stats(),
+        "gemini_clients": gemini_clients.stats(),
+        "responses": responses_coalescer.stats(),
+        "chat_sessions": chat_sessions.stats(),
+        "tool_preselection": tool_selector.stats()
+    }
@@ -0,0 +1,219 @@
+"""Pooled HTTP clients for the upstream APIs, one per serving mode"""
+import contextlib
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import metrics
+from .resilience import record_upstream
+from .settings import (
+    REPLICATE_READ_TIMEOUT, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_POOL_CONNECTIONS, UPSTREAM_POOL_MAXSIZE,
+    UPSTREAM_POOL_SIZES, parse_pool_sizes
+)
+
+
+class UpstreamClient:
+    """
+    Shared HTTP client for upstream APIs.
+    Keeps one requests.Session per upstream host so TCP/TLS connections are reused
+    (keep-alive) instead of being re-established on every proxied request.
+    """
+
+    def __init__(self, pool_connections, pool_maxsize, pool_sizes=None, connect_timeout=5, read_timeout=30):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_sizes = pool_sizes or {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._sessions = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _session_for(self, url):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                maxsize = self.pool_sizes.get(parts.netloc, self.pool_maxsize)
+                adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=maxsize, max_retries=0)
+                session = requests.Session()
+                session.mount(origin, adapter)
+                self._sessions[origin] = session
+                self._stats[origin] = {
+                    "pool_maxsize": maxsize,
+                    "requests": 0,
+                    "errors": 0,
+                    "in_flight": 0,
+                    "total_time": 0.0
+                }
+            return session, self._stats[origin]
+
+    def request(self, method, url, connect_timeout=None, read_timeout=None, **kwargs):
+        session, stats = self._session_for(url)
+        timeout = (connect_timeout or self.connect_timeout, read_timeout or self.read_timeout)
+        name = urlsplit(url).netloc
+        with self._lock:
+            stats["requests"] += 1
+            stats["in_flight"] += 1
+        metrics.inc('proxy_upstream_in_flight', upstream=name)
+        start = time.monotonic()
+        failed = False
+        try:
+            return session.request(method, url, timeout=timeout, **kwargs)
+        except Exception:
+            failed = True
+            with self._lock:
+                stats["errors"] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                stats["in_flight"] -= 1
+                stats["total_time"] += elapsed
+            metrics.dec('proxy_upstream_in_flight', upstream=name)
+            record_upstream(name, elapsed, error=failed)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def stats(self):
+        """Snapshot of request counters and connection pool usage per upstream host"""
+        snapshot = {}
+        with self._lock:
+            sessions = dict(self._sessions)
+            counters = {origin: dict(stats) for origin, stats in self._stats.items()}
+        for origin, session in sessions.items():
+            host_stats = counters[origin]
+            finished = host_stats["requests"] - host_stats["in_flight"]
+            host_stats["avg_time"] = round(host_stats["total_time"] / finished, 4) if finished else 0.0
+            host_stats["total_time"] = round(host_stats["total_time"], 4)
+            pools = []
+            adapter = session.get_adapter(origin)
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+                pools.append({
+                    "host": pool.host,
+                    "port": pool.port,
+                    "connections_opened": pool.num_connections,
+                    "requests_sent": pool.num_requests,
+                    "idle_connections": idle
+                })
+            host_stats["pools"] = pools
+            snapshot[origin] = host_stats
+        return snapshot
+
+
+# Shared by every endpoint so connections are pooled across requests
+upstream = UpstreamClient(
+    pool_connections=UPSTREAM_POOL_CONNECTIONS,
+    pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+    pool_sizes=parse_pool_sizes(UPSTREAM_POOL_SIZES),
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    read_timeout=REPLICATE_READ_TIMEOUT
+)
+
+
+class AsyncUpstreamClient:
+    """
+    aiohttp counterpart of UpstreamClient for the async serving mode.
+    One ClientSession per upstream host, sized by the same pool configuration. Sessions
+    are opened on first use, inside the event loop, and closed when the app shuts down.
+    """
+
+    def __init__(self, pool_maxsize, pool_sizes=None, connect_timeout=5, read_timeout=30):
+        self.pool_maxsize = pool_maxsize
+        self.pool_sizes = pool_sizes or {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._sessions = {}
+        self._stats = {}
+
+    def _session_for(self, url):
+        # aiohttp is only needed when SERVER_MODE=async
+        import aiohttp
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        session = self._sessions.get(origin)
+        if session is None:
+            maxsize = self.pool_sizes.get(parts.netloc, self.pool_maxsize)
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=maxsize, limit_per_host=maxsize))
+            self._sessions[origin] = session
+            self._stats[origin] = {
+                "pool_maxsize": maxsize,
+                "requests": 0,
+                "errors": 0,
+                "in_flight": 0,
+                "total_time": 0.0
+            }
+        return session, self._stats[origin]
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, url, connect_timeout=None, read_timeout=None, **kwargs):
+        import aiohttp
+        session, stats = self._session_for(url)
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=connect_timeout or self.connect_timeout,
+            sock_read=read_timeout or self.read_timeout
+        )
+        name = urlsplit(url).netloc
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        metrics.inc('proxy_upstream_in_flight', upstream=name)
+        start = time.monotonic()
+        try:
+            response = await session.request(method, url, timeout=timeout, **kwargs)
+        except Exception:
+            elapsed = time.monotonic() - start
+            stats["errors"] += 1
+            stats["in_flight"] -= 1
+            stats["total_time"] += elapsed
+            metrics.dec('proxy_upstream_in_flight', upstream=name)
+            record_upstream(name, elapsed, error=True)
+            raise
+        # Headers are in: the rest of the time is spent relaying the body
+        metrics.dec('proxy_upstream_in_flight', upstream=name)
+        record_upstream(name, time.monotonic() - start)
+        try:
+            yield response
+        finally:
+            response.release()
+            stats["in_flight"] -= 1
+            stats["total_time"] += time.monotonic() - start
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        snapshot = {}
+        for origin, stats in self._stats.items():
+            host_stats = dict(stats)
+            finished = host_stats["requests"] - host_stats["in_flight"]
+            host_stats["avg_time"] = round(host_stats["total_time"] / finished, 4) if finished else 0.0
+            host_stats["total_time"] = round(host_stats["total_time"], 4)
+            snapshot[origin] = host_stats
+        return snapshot
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+
+# Sessions belong to the serving event loop, so the async app closes them on cleanup
+async_upstream = AsyncUpstreamClient(
+    pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+    pool_sizes=parse_pool_sizes(UPSTREAM_POOL_SIZES),
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    read_timeout=REPLICATE_READ_TIMEOUT
+)
@@ -0,0 +1,89 @@
+"""Logging setup and helpers that keep secrets and sampled bodies out of the logs"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from .settings import LOG_BODY_SAMPLE_RATE, LOG_FORMAT, LOG_LEVEL
+
+logger = logging.getLogger("axioschat.proxy")
+
+SENSITIVE_HEADERS = ('x-gemini-api-key', 'x-replicate-api-token', 'authorization', 'cookie')
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line for log aggregators"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+_log_listener = None
+
+
+def setup_logging():
+    """
+    Send proxy logs through a queue so formatting output and stdout writes happen on a
+    background listener thread instead of the request thread
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+    
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    logger.handlers = [QueueHandler(log_queue)]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    _log_listener = QueueListener(log_queue, handler)
+    _log_listener.start()
+
+
+def _restart_logging_after_fork():
+    # The listener thread does not survive fork(); forked workers need their own
+    global _log_listener
+    _log_listener = None
+    setup_logging()
+
+
+def _stop_logging():
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+setup_logging()
+atexit.register(_stop_logging)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_logging_after_fork)
+
+
+def sample_bodies():
+    """Whether this request's bodies should be logged: DEBUG must be on and the request sampled"""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_BODY_SAMPLE_RATE
+
+
+def mask_secret(value):
+    if not value:
+        return value
+    return f"{value[:5]}...{value[-4:]}" if len(value) > 9 else "***"
+
+
+def redacted_headers(headers):
+    return {key: mask_secret(value) if key.lower() in SENSITIVE_HEADERS else value for key, value in headers.items()}
@@ -0,0 +1,159 @@
+"""Prometheus metrics and the per-request timing behind them"""
+import bisect
+import contextvars
+import threading
+import time
+from collections import deque
+
+class MetricsRegistry:
+    """
+    Prometheus-style counters, gauges and histograms served from /metrics.
+    Recording only appends to a deque, which is thread-safe without a lock in CPython;
+    events are folded into the totals under the lock when /metrics is scraped or when
+    more than max_pending are waiting, so request threads never wait on each other to record.
+    """
+
+    def __init__(self, max_pending=10000):
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._families = {}  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> value, or [per-bucket counts..., +Inf count, sum] for histograms
+
+    def counter(self, name, help_text):
+        self._families[name] = ("counter", help_text, None)
+
+    def gauge(self, name, help_text):
+        self._families[name] = ("gauge", help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._families[name] = ("histogram", help_text, tuple(sorted(buckets)))
+
+    def inc(self, name, value=1, **labels):
+        self._record(name, labels, value)
+
+    def dec(self, name, value=1, **labels):
+        self._record(name, labels, -value)
+
+    def observe(self, name, value, **labels):
+        self._record(name, labels, value)
+
+    def _record(self, name, labels, value):
+        self._pending.append((name, tuple(sorted(labels.items())), value))
+        if len(self._pending) > self.max_pending:
+            self._fold()
+
+    def _fold(self):
+        with self._lock:
+            while True:
+                try:
+                    name, labels, value = self._pending.popleft()
+                except IndexError:
+                    return
+                kind, _, buckets = self._families[name]
+                key = (name, labels)
+                if kind == "histogram":
+                    entry = self._values.get(key)
+                    if entry is None:
+                        entry = self._values[key] = [0] * (len(buckets) + 1) + [0.0]
+                    entry[bisect.bisect_left(buckets, value)] += 1
+                    entry[-1] += value
+                else:
+                    self._values[key] = self._values.get(key, 0) + value
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        pairs = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self):
+        """Text exposition format (version 0.0.4)"""
+        self._fold()
+        by_family = {}
+        with self._lock:
+            for (name, labels), value in self._values.items():
+                by_family.setdefault(name, []).append((labels, list(value) if isinstance(value, list) else value))
+        
+        lines = []
+        for name, (kind, help_text, buckets) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_family.get(name, [])):
+                if kind != "histogram":
+                    lines.append(f"{name}{self._format_labels(labels)} {float(value)!r}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{name}_bucket{self._format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {value[-1]!r}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+metrics = MetricsRegistry()
+metrics.counter('proxy_requests_total', "Requests handled, by route and response status")
+metrics.gauge('proxy_requests_in_flight', "Requests currently being handled, by route")
+metrics.histogram('proxy_request_duration_seconds', "Total time to handle a request, including streamed bodies", LATENCY_BUCKETS)
+metrics.histogram('proxy_overhead_seconds', "Request time not spent waiting for upstream responses to start (includes relaying streamed bodies)", LATENCY_BUCKETS)
+metrics.histogram('proxy_request_size_bytes', "Request body size", SIZE_BUCKETS)
+metrics.histogram('proxy_response_size_bytes', "Response body size (streamed responses are not counted)", SIZE_BUCKETS)
+metrics.histogram('proxy_upstream_duration_seconds', "Upstream call time until the response starts, by upstream", LATENCY_BUCKETS)
+metrics.gauge('proxy_upstream_in_flight', "Upstream calls currently waiting for a response")
+metrics.counter('proxy_upstream_errors_total', "Upstream calls that failed without a response")
+metrics.counter('proxy_retries_total', "Upstream retries, by reason (error, cold_start, empty)")
+metrics.counter('proxy_retries_denied_total', "Retries and hedges skipped because the retry budget was spent")
+metrics.counter('proxy_hedged_requests_total', "Upstream calls that got a duplicate after outlasting the hedge delay")
+metrics.counter('proxy_hedge_wins_total', "Hedged calls where the duplicate answered first")
+metrics.counter('proxy_ollama_ejections_total', "Times an Ollama backend was taken out of rotation after repeated failures")
+metrics.counter('proxy_circuit_opens_total', "Times a provider's circuit breaker opened")
+metrics.counter('proxy_fallbacks_total', "Requests served by a fallback provider, by primary, fallback and reason")
+metrics.counter('proxy_rejected_requests_total', "Requests refused by admission control, by route and reason (rate_limited, queue_full, queue_timeout)")
+metrics.gauge('proxy_queued_requests', "Requests waiting for a concurrency slot, by route")
+metrics.histogram('proxy_tool_selection_seconds', "Time to pick the tools sent with a function calling request", LATENCY_BUCKETS)
+metrics.counter('proxy_tool_tokens_saved_total', "Estimated prompt tokens of tool declarations left out by pre-selection")
+metrics.histogram('proxy_gemini_tools_latency_seconds', "Uncached Gemini function calling time for requests eligible for pre-selection, by tools (preselected, all)", LATENCY_BUCKETS)
+metrics.counter('proxy_replicate_structured_outputs_total', "Replicate outputs decoded for ?structured=1, by result (function_calls, text, json, too_large, too_many_calls, too_deep)")
+metrics.counter('proxy_gemini_empty_responses_total', "Gemini responses with neither function calls nor text")
+metrics.counter('proxy_gemini_blocked_responses_total', "Gemini responses whose prompt was blocked")
+
+# Seconds this request has spent in upstream calls, so proxy overhead can be split out
+request_upstream_seconds = contextvars.ContextVar('request_upstream_seconds', default=None)
+
+
+def add_request_upstream(seconds):
+    spent = request_upstream_seconds.get()
+    if spent is not None:
+        spent[0] += seconds
+
+
+def begin_request_metrics(route, request_size):
+    metrics.inc('proxy_requests_in_flight', route=route)
+    if request_size:
+        metrics.observe('proxy_request_size_bytes', request_size, route=route)
+    request_upstream_seconds.set([0.0])
+    return time.monotonic()
+
+
+def end_request_metrics(route, start, status, response_size=None):
+    duration = time.monotonic() - start
+    spent = request_upstream_seconds.get()
+    metrics.dec('proxy_requests_in_flight', route=route)
+    metrics.inc('proxy_requests_total', route=route, status=str(status))
+    metrics.observe('proxy_request_duration_seconds', duration, route=route)
+    metrics.observe('proxy_overhead_seconds', max(duration - (spent[0] if spent else 0.0), 0.0), route=route)
+    if response_size is not None:
+        metrics.observe('proxy_response_size_bytes', response_size, route=route)
+    request_upstream_seconds.set(None)
+
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
@@ -0,0 +1,436 @@
+"""Ollama: the backend pool, request and response formats, and plain and streamed calls"""
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .caching import async_coalescer, cache_bypassed, coalescer, request_fingerprint
+from .http_clients import async_upstream, upstream
+from .logs import logger
+from .metrics import metrics
+from .providers import provider_health, provider_router
+from .settings import (
+    OLLAMA_BACKENDS, OLLAMA_EJECT_COOLDOWN, OLLAMA_FAILURE_THRESHOLD, OLLAMA_MODEL_TTL, OLLAMA_READ_TIMEOUT,
+    OLLAMA_SPILL_OUTSTANDING
+)
+from .streaming import sse_event
+
+
+class OllamaBackendPool:
+    """
+    Routes Ollama requests across several backends.
+    acquire() picks the healthy backend with the fewest outstanding requests, preferring
+    backends that served the same model within model_ttl, since Ollama keeps it loaded.
+    Health is checked passively: failure_threshold consecutive failures (connection
+    errors or 5xx) eject a backend for cooldown seconds, after which a single further
+    failure ejects it again until a request succeeds.
+    """
+
+    def __init__(self, urls, failure_threshold=3, cooldown=30, model_ttl=300, spill_outstanding=8):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.model_ttl = model_ttl
+        self.spill_outstanding = spill_outstanding
+        self._backends = OrderedDict()  # url -> state
+        for url in urls:
+            self._backends[url.rstrip('/')] = {
+                "outstanding": 0,
+                "failures": 0,
+                "ejected_until": 0.0,
+                "models": {},  # model -> last served (monotonic)
+                "requests": 0,
+                "errors": 0,
+                "ejections": 0
+            }
+        self._lock = threading.Lock()
+        self._turn = 0  # Rotates ties so equally loaded backends share traffic
+
+    def acquire(self, model=None):
+        """Reserve a backend for one request and return its base URL; pair with release()"""
+        now = time.monotonic()
+        with self._lock:
+            healthy = [(url, state) for url, state in self._backends.items() if state["ejected_until"] <= now]
+            if not healthy:
+                # Everything is ejected: fail open to the backend closest to rejoining
+                healthy = [min(self._backends.items(), key=lambda item: item[1]["ejected_until"])]
+            
+            warm = [(url, state) for url, state in healthy if now - state["models"].get(model, float('-inf')) < self.model_ttl]
+            candidates = healthy
+            if warm and min(state["outstanding"] for _, state in warm) < self.spill_outstanding:
+                candidates = warm
+            
+            self._turn = (self._turn + 1) % len(candidates)
+            rotated = candidates[self._turn:] + candidates[:self._turn]
+            url, state = min(rotated, key=lambda item: item[1]["outstanding"])
+            state["outstanding"] += 1
+            state["requests"] += 1
+            return url
+
+    def release(self, url, ok, served_model=None):
+        """
+        Record the outcome of a request started with acquire(): ok when the backend answered
+        without a connection error or 5xx, None when the client went away first (no verdict),
+        served_model only when it answered with a 2xx, since a 404 for an unknown model says
+        the backend is healthy but not that it is warm
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._backends.get(url)
+            if state is None:
+                return
+            state["outstanding"] -= 1
+            if served_model:
+                state["models"][served_model] = now
+            if ok:
+                state["failures"] = 0
+                return
+            if ok is None:
+                return
+            state["errors"] += 1
+            state["failures"] += 1
+            if state["failures"] < self.failure_threshold or state["ejected_until"] > now:
+                return
+            state["ejected_until"] = now + self.cooldown
+            state["failures"] = self.failure_threshold - 1
+            state["ejections"] += 1
+        logger.warning("Ejecting Ollama backend %s for %.0fs after repeated failures", url, self.cooldown)
+        metrics.inc('proxy_ollama_ejections_total', backend=url)
+
+    def urls(self):
+        return list(self._backends)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                url: {
+                    "healthy": state["ejected_until"] <= now,
+                    "ejected_for": round(max(state["ejected_until"] - now, 0.0), 1),
+                    "outstanding": state["outstanding"],
+                    "requests": state["requests"],
+                    "errors": state["errors"],
+                    "ejections": state["ejections"],
+                    "loaded_models": sorted(model for model, served in state["models"].items() if now - served < self.model_ttl)
+                }
+                for url, state in self._backends.items()
+            }
+
+
+ollama_pool = OllamaBackendPool(
+    [url.strip() for url in OLLAMA_BACKENDS.split(',') if url.strip()],
+    failure_threshold=OLLAMA_FAILURE_THRESHOLD,
+    cooldown=OLLAMA_EJECT_COOLDOWN,
+    model_ttl=OLLAMA_MODEL_TTL,
+    spill_outstanding=OLLAMA_SPILL_OUTSTANDING
+)
+
+
+def format_chat_messages(messages):
+    # Format messages for Ollama
+    formatted_messages = []
+    for msg in messages:
+        role = msg.get('role') or 'user'
+        content = msg.get('content') or ''
+        formatted_messages.append({"role": role, "content": content})
+    return formatted_messages
+
+
+def build_ollama_chat_request(request_data, stream, messages=None):
+    """
+    Build the Ollama /api/chat payload from a /api/chat request body,
+    or from an already formatted session context when messages is given
+    """
+    return {
+        "model": request_data.get('model', 'llama3'),
+        "messages": format_chat_messages(request_data.get('messages', [])) if messages is None else messages,
+        "stream": stream,
+        "options": {
+            "temperature": request_data.get('temperature', 0.7)
+        }
+    }
+
+
+def format_ollama_chat_response(ollama_response):
+    # Format response to match what the frontend expects
+    assistant_message = ollama_response.get("message", {})
+    return {
+        "message": {
+            "role": "assistant",
+            "content": assistant_message.get("content", "No response from Ollama")
+        }
+    }
+
+
+def format_ollama_chat_chunk(chunk):
+    return {
+        "message": {
+            "role": "assistant",
+            "content": chunk.get("message", {}).get("content", "")
+        },
+        "done": bool(chunk.get("done"))
+    }
+
+
+def build_ollama_generate_request(request_data, stream):
+    """Build the Ollama /api/generate payload from a Replicate-style /api/ollama request body"""
+    # Extract the query and other parameters from the request
+    input_data = request_data.get('input', {})
+    return {
+        "model": "llama3",  # You can change this to your preferred model
+        "prompt": input_data.get('query', ''),
+        "stream": stream,
+        "options": {
+            "temperature": input_data.get('temperature', 0.7)
+        }
+    }
+
+
+def format_ollama_generate_response(ollama_response):
+    # Format response to match what the frontend expects from Replicate
+    return {
+        "id": "ollama-response",
+        "status": "succeeded",
+        "output": ollama_response.get("response", "No response from Ollama")
+    }
+
+
+def format_ollama_generate_chunk(chunk):
+    return {
+        "id": "ollama-response",
+        "status": "succeeded" if chunk.get("done") else "processing",
+        "output": chunk.get("response", ""),
+        "done": bool(chunk.get("done"))
+    }
+
+
+def ollama_error_body(status, text):
+    error_message = f"Error from Ollama API: {status} {text}"
+    logger.error(error_message)
+    return {"error": error_message}, status
+
+
+class OllamaBackendCall:
+    """
+    One request to the pool's pick of Ollama backend. finish() releases the backend and
+    records the outcome on Ollama's circuit breaker, once: ok when the backend answered
+    without a connection error or 5xx, None when the client went away first, which says
+    nothing about the backend. served only with a 2xx, when the model is known to be loaded.
+    """
+
+    def __init__(self, path, ollama_request):
+        self.ollama_request = ollama_request
+        self.backend = ollama_pool.acquire(ollama_request["model"])
+        self.url = f"{self.backend}{path}"
+        self.finished = False
+
+    def finish(self, ok, served=False):
+        if self.finished:
+            return
+        self.finished = True
+        ollama_pool.release(self.backend, ok, self.ollama_request["model"] if served else None)
+        if ok is not None:
+            provider_router.record("ollama", ok)
+
+
+def call_ollama(path, ollama_request, format_response):
+    """Send a non-streaming request to Ollama, returning (body, status)"""
+    call = OllamaBackendCall(path, ollama_request)
+    ok = served = False
+    try:
+        response = upstream.post(
+            call.url,
+            headers={"Content-Type": "application/json"},
+            json=ollama_request,
+            read_timeout=OLLAMA_READ_TIMEOUT
+        )
+        ok = response.status_code < 500
+        served = 200 <= response.status_code < 300
+        if not response.ok:
+            return ollama_error_body(response.status_code, response.text)
+        # Parse Ollama response
+        return format_response(response.json()), 200
+    finally:
+        call.finish(ok, served)
+
+
+async def call_ollama_async(path, ollama_request, format_response):
+    call = OllamaBackendCall(path, ollama_request)
+    ok = served = False
+    try:
+        async with async_upstream.post(call.url, json=ollama_request, read_timeout=OLLAMA_READ_TIMEOUT) as response:
+            ok = response.status < 500
+            served = 200 <= response.status < 300
+            if response.status >= 400:
+                return ollama_error_body(response.status, await response.text())
+            return format_response(await response.json(content_type=None)), 200
+    finally:
+        call.finish(ok, served)
+
+
+def generate_coalesced(ollama_request, headers):
+    """
+    /api/ollama's non-streaming answer, (body, status, headers) with X-Cache: identical
+    concurrent prompts share one Ollama call and temperature 0 answers are cached
+    """
+    result, cache_source = coalescer.run(
+        request_fingerprint("ollama", ollama_request),
+        lambda: call_ollama("/api/generate", ollama_request, format_ollama_generate_response),
+        cacheable=float(ollama_request["options"]["temperature"]) == 0,
+        bypass=cache_bypassed(headers)
+    )
+    return result + ({"X-Cache": cache_source},)
+
+
+async def generate_coalesced_async(ollama_request, headers):
+    result, cache_source = await async_coalescer.run(
+        request_fingerprint("ollama", ollama_request),
+        lambda: call_ollama_async("/api/generate", ollama_request, format_ollama_generate_response),
+        cacheable=float(ollama_request["options"]["temperature"]) == 0,
+        bypass=cache_bypassed(headers)
+    )
+    return result + ({"X-Cache": cache_source},)
+
+
+class OllamaStream(OllamaBackendCall):
+    """
+    One streamed Ollama request relayed as SSE events. relay_ollama_stream and
+    relay_ollama_stream_async read the NDJSON lines and turn each into an event with
+    event(); on_done, if given, is called with the full chat reply once Ollama finishes it.
+    The backend counts as busy until finish().
+    """
+
+    def __init__(self, path, ollama_request, format_chunk, on_done=None):
+        super().__init__(path, ollama_request)
+        self.format_chunk = format_chunk
+        self.on_done = on_done
+        self.reply = []
+        self.ended = False
+        self.response = None  # The open upstream response in Flask mode, closed by finish()
+
+    def refused(self, status, text):
+        """(body, status) for a stream Ollama answered with an error status instead"""
+        self.finish(status < 500)
+        return ollama_error_body(status, text)
+
+    def event(self, line):
+        """The SSE event for one NDJSON line, or None for a blank one; sets ended after the last"""
+        if not line.strip():
+            return None
+        chunk = json.loads(line)
+        if chunk.get("error"):
+            self.ended = True
+            return sse_event({"error": chunk["error"]}, event="error")
+        if self.on_done:
+            self.reply.append(chunk.get("message", {}).get("content", ""))
+        if chunk.get("done"):
+            self.ended = True
+            if self.on_done:
+                self.on_done("".join(self.reply))
+        return sse_event(self.format_chunk(chunk))
+
+    def error_event(self, e):
+        error_message = f"Error while streaming from Ollama: {str(e)}"
+        logger.error(error_message)
+        return sse_event({"error": error_message}, event="error")
+
+    def finish(self, ok, served=False):
+        if self.response is not None:
+            self.response.close()
+        super().finish(ok, served)
+
+    def abandon(self):
+        """Release the backend without a verdict when the client left before the stream started"""
+        self.finish(None)
+
+
+def relay_ollama_stream(stream):
+    """
+    Start stream's request and relay its chunks as they arrive, without buffering the
+    full completion. Returns (error, events): error is the (body, status) to send when
+    Ollama refused the request, events a generator of SSE events. A client that
+    disconnects before the first event never runs the generator; call stream.abandon() then.
+    """
+    try:
+        stream.response = upstream.post(
+            stream.url,
+            headers={"Content-Type": "application/json"},
+            json=stream.ollama_request,
+            read_timeout=OLLAMA_READ_TIMEOUT,
+            stream=True
+        )
+    except Exception:
+        stream.finish(False)
+        raise
+    if not stream.response.ok:
+        return stream.refused(stream.response.status_code, stream.response.text), None
+    
+    def generate():
+        ok = None  # Left as None when the client disconnects (GeneratorExit)
+        try:
+            for line in stream.response.iter_lines():
+                event = stream.event(line)
+                if event:
+                    yield event
+                if stream.ended:
+                    break
+            ok = True
+        except Exception as e:
+            ok = False
+            yield stream.error_event(e)
+        finally:
+            stream.finish(ok, served=ok)
+    
+    return None, generate()
+
+
+async def relay_ollama_stream_async(stream, open_sse):
+    """
+    Awaited counterpart of relay_ollama_stream. Returns (error, None) when Ollama refused
+    the request, else (None, sse) once the chunks were relayed to the response that the
+    open_sse() coroutine prepared.
+    """
+    ok = False
+    try:
+        async with async_upstream.post(stream.url, json=stream.ollama_request, read_timeout=OLLAMA_READ_TIMEOUT) as response:
+            if response.status >= 400:
+                return stream.refused(response.status, await response.text()), None
+            sse = await open_sse()
+            try:
+                async for line in response.content:
+                    event = stream.event(line)
+                    if event:
+                        await sse.write(event.encode('utf-8'))
+                    if stream.ended:
+                        break
+                ok = True
+            except ConnectionResetError:
+                # The client went away (pressed stop), which says nothing about the backend
+                ok = None
+                return None, sse
+            except Exception as e:
+                await sse.write(stream.error_event(e).encode('utf-8'))
+            await sse.write_eof()
+            return None, sse
+    except asyncio.CancelledError:
+        ok = None
+        raise
+    finally:
+        stream.finish(ok, served=ok)
+
+
+def probe_ollama(timeout):
+    backends = {}
+    for url in ollama_pool.urls():
+        try:
+            response = upstream.get(f"{url}/api/tags", connect_timeout=timeout, read_timeout=timeout)
+            response.close()
+            backends[url] = "up" if response.ok else f"status {response.status_code}"
+        except Exception as e:
+            backends[url] = str(e)[:100]
+    if not any(state == "up" for state in backends.values()):
+        raise RuntimeError(f"no Ollama backend reachable: {backends}")
+    return {"status": "up", "backends": backends}
+
+
+provider_health.register("ollama", probe_ollama)
@@ -0,0 +1,239 @@
+"""Provider health probing, circuit breakers per provider and fallback routing"""
+import threading
+import time
+
+from .logs import logger
+from .metrics import metrics
+from .resilience import CircuitBreaker
+from .settings import (
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT,
+    PROVIDER_FALLBACKS, PROVIDER_SLOW_THRESHOLD
+)
+
+
+class ProviderHealth:
+    """
+    Keeps a cached view of each provider's health and latency so health checks and
+    routing never wait on an upstream. A background thread runs every provider's probe
+    each interval. Probes are registered by the provider modules: Gemini makes a CountTokens
+    call on the server's own key (never a caller's), Replicate a GET on the predictions API
+    and Ollama a GET on /api/tags of every backend.
+    """
+
+    PROVIDERS = ("gemini", "replicate", "ollama")
+
+    def __init__(self, interval, timeout, slow_threshold):
+        self.interval = interval
+        self.timeout = timeout
+        self.slow_threshold = slow_threshold
+        self._status = {name: {"status": "unknown"} for name in self.PROVIDERS}
+        self._probes = {}  # name -> probe(timeout), returning a status dict or raising when down
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, name, probe):
+        self._probes[name] = probe
+
+    def ensure_running(self):
+        """Start the prober on first use, and again in a forked worker where the thread is gone"""
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="provider-prober", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self.probe_all()
+            time.sleep(self.interval)
+
+    def probe_all(self):
+        for name in self.PROVIDERS:
+            probe = self._probes.get(name)
+            if probe is None:
+                continue
+            start = time.monotonic()
+            try:
+                result = probe(self.timeout)
+                error = None
+            except Exception as e:
+                result, error = {"status": "down"}, str(e)[:200]
+            latency = time.monotonic() - start
+            if result["status"] == "up" and latency > self.slow_threshold:
+                result["status"] = "slow"
+            with self._lock:
+                previous = self._status[name]
+                failures = previous.get("consecutive_failures", 0) + 1 if result["status"] == "down" else 0
+                self._status[name] = dict(
+                    result,
+                    latency_ms=round(latency * 1000, 1),
+                    checked_at=time.time(),
+                    error=error,
+                    consecutive_failures=failures
+                )
+            if result["status"] != previous.get("status") and previous.get("status") != "unknown":
+                logger.warning("Provider %s is now %s%s", name, result["status"], f": {error}" if error else "")
+
+    def status(self, name):
+        with self._lock:
+            return dict(self._status[name])
+
+    def degraded(self, name):
+        """True when the last probe found the provider down or slow"""
+        with self._lock:
+            return self._status[name]["status"] in ("down", "slow")
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(status) for name, status in self._status.items()}
+
+
+class ProviderRouter:
+    """
+    Chooses which provider serves a request: the primary unless its circuit is open or
+    probes report it down or slow, otherwise its configured fallback when that one looks
+    usable. Failed primaries can also hand the request to the fallback afterwards.
+    """
+
+    def __init__(self, health, fallbacks, failure_threshold, reset_timeout):
+        self.health = health
+        self.fallbacks = fallbacks
+        self.breakers = {name: CircuitBreaker(name, failure_threshold, reset_timeout) for name in ProviderHealth.PROVIDERS}
+
+    def _usable_fallback(self, primary):
+        fallback = self.fallbacks.get(primary)
+        if fallback and not self.health.degraded(fallback) and self.breakers[fallback].allow():
+            return fallback
+        return None
+
+    def pick(self, primary):
+        """Provider to send a request to: primary, its fallback, or None when neither may be used"""
+        breaker = self.breakers[primary]
+        if not self.health.degraded(primary) and breaker.allow():
+            return primary
+        fallback = self._usable_fallback(primary)
+        if fallback:
+            reason = "circuit_open" if breaker.is_open() else "unhealthy"
+            metrics.inc('proxy_fallbacks_total', primary=primary, fallback=fallback, reason=reason)
+            logger.warning("Routing %s request to %s (%s)", primary, fallback, reason)
+            return fallback
+        # Probes may be stale: with a closed circuit the primary is still worth trying
+        return primary if breaker.allow() else None
+
+    def fallback_after_failure(self, primary):
+        """Fallback to retry a request the primary failed, or None"""
+        fallback = self._usable_fallback(primary)
+        if fallback:
+            metrics.inc('proxy_fallbacks_total', primary=primary, fallback=fallback, reason="failed")
+            logger.warning("%s request failed, retrying on %s", primary, fallback)
+        return fallback
+
+    def record(self, provider, ok):
+        self.breakers[provider].record(ok)
+
+    def unavailable_body(self, provider):
+        """(body, status, headers) for a request refused because the provider's circuit is open"""
+        retry_after = self.breakers[provider].retry_after()
+        body = {"error": f"{provider.capitalize()} is temporarily unavailable, please retry shortly", "retry_after": retry_after}
+        return body, 503, {"Retry-After": str(retry_after)}
+
+    def health_body(self):
+        """(body, status) for /api/health, answered from cached probe results"""
+        serving = any(
+            not self.health.degraded(name) and not breaker.is_open()
+            for name, breaker in self.breakers.items()
+        )
+        return {"status": "ok" if serving else "unavailable", "providers": self.stats()}, 200 if serving else 503
+
+    def stats(self):
+        health = self.health.stats()
+        return {
+            name: dict(health[name], circuit=self.breakers[name].stats(), fallback=self.fallbacks.get(name))
+            for name in ProviderHealth.PROVIDERS
+        }
+
+
+def _parse_fallbacks(spec):
+    """Parse "primary:fallback,..." into a dict, ignoring unknown providers"""
+    fallbacks = {}
+    for entry in spec.split(','):
+        primary, _, fallback = entry.strip().partition(':')
+        if primary in ProviderHealth.PROVIDERS and fallback in ProviderHealth.PROVIDERS and primary != fallback:
+            fallbacks[primary] = fallback
+    return fallbacks
+
+
+provider_health = ProviderHealth(HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT, PROVIDER_SLOW_THRESHOLD)
+provider_router = ProviderRouter(provider_health, _parse_fallbacks(PROVIDER_FALLBACKS), BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+
+def pick_provider(primary):
+    """
+    (error, provider) for a request that can only be routed before it starts, like a stream:
+    error is the 503 reply to send when neither the primary nor its fallback may be used
+    """
+    provider = provider_router.pick(primary)
+    if provider is None:
+        return provider_router.unavailable_body(primary), None
+    return None, provider
+
+
+class RoutedRequest:
+    """
+    Routing of one non-streaming request: the provider the router picked, and its fallback
+    when the primary answers with a 5xx. route_request and route_request_async make the
+    calls and pass each answer to answered(), which returns the reply with the serving
+    provider in X-Provider, or None when the request should go to the fallback instead.
+    """
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.provider = provider_router.pick(primary)
+
+    def answered(self, body, status, headers=None):
+        if self.provider == self.primary and status >= 500:
+            fallback = provider_router.fallback_after_failure(self.primary)
+            if fallback is not None:
+                self.provider = fallback
+                return None
+        return body, status, dict(headers or {}, **{"X-Provider": self.provider})
+
+    def fallback_failed(self, e):
+        logger.error("Fallback to %s failed: %s", self.provider, e)
+        return self.answered({"error": f"Error communicating with {self.provider.capitalize()}: {str(e)}"}, 502)
+
+
+def route_request(primary, call_primary, call_fallback):
+    """
+    Send a non-streaming request where the provider router says: call_primary() normally,
+    call_fallback() when the primary is unavailable or answers with a 5xx and a fallback
+    is usable. Both return (body, status) or (body, status, headers), and call_primary
+    records its own outcome. Returns (body, status, headers) with the serving provider in X-Provider.
+    """
+    routed = RoutedRequest(primary)
+    if routed.provider is None:
+        return provider_router.unavailable_body(primary)
+    if routed.provider == primary:
+        reply = routed.answered(*call_primary())
+        if reply is not None:
+            return reply
+    try:
+        return routed.answered(*call_fallback())
+    except Exception as e:
+        return routed.fallback_failed(e)
+
+
+async def route_request_async(primary, call_primary, call_fallback):
+    """Awaited counterpart of route_request; call_primary and call_fallback return coroutines"""
+    routed = RoutedRequest(primary)
+    if routed.provider is None:
+        return provider_router.unavailable_body(primary)
+    if routed.provider == primary:
+        reply = routed.answered(*await call_primary())
+        if reply is not None:
+            return reply
+    try:
+        return routed.answered(*await call_fallback())
+    except Exception as e:
+        return routed.fallback_failed(e)
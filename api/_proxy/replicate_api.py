@@ -0,0 +1,541 @@
+"""Replicate predictions: Prefer: wait calls, async jobs with a background poller, and output decoding"""
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import orjson  # Optional: faster decoding of structured Replicate output
+except ImportError:
+    orjson = None
+
+from .http_clients import async_upstream, upstream
+from .logs import logger, sample_bodies
+from .metrics import metrics
+from .ollama_backends import build_ollama_generate_request, call_ollama, call_ollama_async, format_ollama_generate_response
+from .providers import provider_health, provider_router, route_request, route_request_async
+from .resilience import UpstreamAttempts
+from .settings import (
+    REPLICATE_API_URL, REPLICATE_ASYNC_JOBS, REPLICATE_JOB_TTL, REPLICATE_MAX_JOBS, REPLICATE_POLL_INTERVAL,
+    REPLICATE_POLL_MAX_INTERVAL, REPLICATE_POLL_RATE, REPLICATE_PROBE_TOKEN, REPLICATE_READ_TIMEOUT,
+    REPLICATE_STRUCTURED_MAX_CALLS, REPLICATE_STRUCTURED_MAX_CHARS, REPLICATE_STRUCTURED_MAX_DEPTH,
+    REPLICATE_STRUCTURED_OUTPUT
+)
+
+
+class ReplicateJobTracker:
+    """
+    Tracks Replicate predictions created in async job mode.
+    A single background thread polls every unfinished prediction, backing off per job
+    and never exceeding max_polls_per_second overall, and keeps finished results for job_ttl.
+    """
+
+    TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+    def __init__(self, poll_interval, max_poll_interval, max_polls_per_second, max_jobs, job_ttl):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_polls_per_second = max_polls_per_second
+        self.max_jobs = max_jobs
+        self.job_ttl = job_ttl
+        self._jobs = OrderedDict()  # prediction id -> job
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.polls = 0
+        self.poll_errors = 0
+
+    def _purge(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["finished_at"] is not None and now - job["finished_at"] > self.job_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if len(self._jobs) >= self.max_jobs:
+            # Drop the oldest finished results first; active jobs are never dropped
+            for job_id in [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]:
+                del self._jobs[job_id]
+                if len(self._jobs) < self.max_jobs:
+                    break
+
+    def submit(self, prediction, api_token):
+        """Start tracking a prediction returned by the create call"""
+        now = time.monotonic()
+        job = {
+            "id": prediction["id"],
+            "token_hash": hashlib.sha256(api_token.encode('utf-8')).hexdigest(),
+            "api_token": api_token,
+            "prediction": prediction,
+            "interval": self.poll_interval,
+            "next_poll": now + self.poll_interval,
+            "polls": 0,
+            "errors": 0,
+            "finished_at": now if prediction.get("status") in self.TERMINAL_STATUSES else None
+        }
+        with self._lock:
+            self._purge(now)
+            if len(self._jobs) >= self.max_jobs:
+                raise RuntimeError("Too many pending Replicate jobs, try again later")
+            self._jobs[job["id"]] = job
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="replicate-poller", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return job
+
+    def get(self, job_id, api_token):
+        """Return the last known prediction state, or None if unknown or owned by another token"""
+        token_hash = hashlib.sha256(api_token.encode('utf-8')).hexdigest()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or not hmac.compare_digest(job["token_hash"], token_hash):
+                return None
+            # The urls point at Replicate; clients poll through this proxy instead
+            prediction = {key: value for key, value in job["prediction"].items() if key != "urls"}
+            prediction["polls"] = job["polls"]
+            return prediction
+
+    def _next_due_job(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            active = [job for job in self._jobs.values() if job["finished_at"] is None]
+            return min(active, key=lambda job: job["next_poll"]) if active else None
+
+    def _run(self):
+        min_gap = 1.0 / self.max_polls_per_second
+        while True:
+            job = self._next_due_job()
+            wait = self.poll_interval if job is None else job["next_poll"] - time.monotonic()
+            if wait > 0:
+                self._wakeup.wait(timeout=wait)
+                self._wakeup.clear()
+                continue
+            self._poll(job)
+            time.sleep(min_gap)  # Bounds the overall polling rate
+
+    def _poll(self, job):
+        now = time.monotonic()
+        try:
+            response = upstream.get(
+                f"{REPLICATE_API_URL}/{job['id']}",
+                headers={"Authorization": f"Bearer {job['api_token']}"}
+            )
+            prediction = response.json()
+            if not response.ok:
+                raise RuntimeError(f"status {response.status_code}: {str(prediction)[:200]}")
+        except Exception as e:
+            with self._lock:
+                self.poll_errors += 1
+                job["errors"] += 1
+                job["next_poll"] = now + job["interval"]
+                if job["errors"] > 10:
+                    job["prediction"] = dict(job["prediction"], status="failed", error=f"Lost track of prediction: {str(e)}")
+                    job["finished_at"] = now
+            logger.warning("Error polling Replicate prediction %s: %s", job['id'], e)
+            return
+        
+        with self._lock:
+            self.polls += 1
+            job["polls"] += 1
+            job["errors"] = 0
+            job["prediction"] = prediction
+            if prediction.get("status") in self.TERMINAL_STATUSES:
+                job["finished_at"] = now
+                logger.info("Replicate prediction %s finished with status %s after %d polls", job['id'], prediction['status'], job['polls'])
+            else:
+                job["interval"] = min(job["interval"] * 1.5, self.max_poll_interval)
+                job["next_poll"] = now + job["interval"]
+
+    def stats(self):
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job["finished_at"] is None)
+            return {
+                "active": active,
+                "finished": len(self._jobs) - active,
+                "max_jobs": self.max_jobs,
+                "polls": self.polls,
+                "poll_errors": self.poll_errors,
+                "max_polls_per_second": self.max_polls_per_second
+            }
+
+
+replicate_jobs = ReplicateJobTracker(
+    REPLICATE_POLL_INTERVAL, REPLICATE_POLL_MAX_INTERVAL, REPLICATE_POLL_RATE,
+    REPLICATE_MAX_JOBS, REPLICATE_JOB_TTL
+)
+
+
+def wants_async_job(args):
+    """Async job mode is opt-in via ?async=1, or the default when REPLICATE_ASYNC_JOBS is set"""
+    value = args.get('async', '').lower()
+    if value:
+        return value in ('1', 'true', 'yes')
+    return REPLICATE_ASYNC_JOBS
+
+
+def start_replicate_job(status, prediction, api_token):
+    """Hand a freshly created prediction to the poller, returning (body, status)"""
+    if status >= 400:
+        logger.error("Error from Replicate API: %s", prediction)
+        return prediction, status
+    if not prediction.get("id"):
+        return {"error": "Replicate did not return a prediction id"}, 502
+    try:
+        replicate_jobs.submit(prediction, api_token)
+    except RuntimeError as e:
+        return {"error": str(e)}, 503
+    logger.info("Started Replicate job %s (status: %s)", prediction['id'], prediction.get('status'))
+    return {
+        "id": prediction["id"],
+        "status": prediction.get("status", "starting"),
+        "output": prediction.get("output"),
+        "poll_url": f"/api/replicate/{prediction['id']}"
+    }, 202
+
+
+def log_replicate_response(response_data, ok):
+    """
+    Debug logging for a Replicate prediction, including the nested JSON output.
+    Serializing the output is expensive, so callers only invoke this for sampled requests.
+    """
+    logger.debug("Raw Replicate API response: %.500s", json.dumps(response_data))
+    
+    # Add more detailed logging for the output field
+    if 'output' in response_data:
+        logger.debug("Complete output: %s", json.dumps(response_data['output']))
+        
+        # Parse output for better debugging
+        if response_data['output'] is not None:
+            try:
+                if isinstance(response_data['output'], str):
+                    # Try to parse the string as JSON
+                    parsed_output = json.loads(response_data['output'])
+                    
+                    # If it's an array of strings, try to parse each string
+                    if isinstance(parsed_output, list):
+                        parsed_items = []
+                        for item in parsed_output:
+                            if isinstance(item, str) and (item.startswith('{') or item.startswith('[')):
+                                try:
+                                    parsed_item = json.loads(item)
+                                    parsed_items.append(parsed_item)
+                                except:
+                                    parsed_items.append(item)
+                            else:
+                                parsed_items.append(item)
+                        parsed_output = parsed_items
+                    logger.debug("Parsed output: %s", json.dumps(parsed_output))
+            except Exception as e:
+                logger.debug("Error parsing output JSON: %s", e)
+    else:
+        logger.debug("No 'output' field found in response")
+    
+    # If there's an error, log the full response for debugging
+    if not ok:
+        logger.debug("Full error response: %s", json.dumps(response_data))
+
+def wants_structured_output(args):
+    """Structured output is opt-in via ?structured=1, or the default when REPLICATE_STRUCTURED_OUTPUT is set"""
+    value = args.get('structured', '').lower()
+    if value:
+        return value in ('1', 'true', 'yes')
+    return REPLICATE_STRUCTURED_OUTPUT
+
+
+def decode_json(text):
+    """json.loads, using orjson when it is installed; raises ValueError for invalid JSON"""
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def decode_replicate_output(output):
+    """
+    Decode the JSON layers of a Replicate output once: a JSON string (possibly wrapping
+    more JSON), a list of JSON documents, or a list of streamed tokens forming one.
+    Text that isn't JSON is returned as the joined string. At most
+    REPLICATE_STRUCTURED_MAX_DEPTH layers are unwrapped.
+    """
+    for _ in range(REPLICATE_STRUCTURED_MAX_DEPTH):
+        if isinstance(output, list) and output and all(isinstance(item, str) for item in output):
+            # One JSON document per item, or the tokens of a single text
+            if len(output) > 1 and all(item.lstrip()[:1] in ('{', '[') for item in output):
+                try:
+                    return [decode_json(item) for item in output]
+                except ValueError:
+                    pass
+            output = ''.join(output)
+        if not (isinstance(output, str) and output.lstrip()[:1] in ('{', '[', '"')):
+            return output
+        try:
+            value = decode_json(output)
+        except ValueError:
+            return output
+        if not isinstance(value, (str, list)):
+            return value
+        output = value
+    return output
+
+
+def json_depth(value, limit):
+    """Nesting depth of lists and objects in a decoded JSON value, counted no further than limit + 1"""
+    depth, level = 0, [value]
+    while depth <= limit:
+        containers = [item for item in level if isinstance(item, (list, dict))]
+        if not containers:
+            break
+        depth += 1
+        level = [child for item in containers for child in (item.values() if isinstance(item, dict) else item)]
+    return depth
+
+
+def iter_list_items(value):
+    """Items of value, with nested lists flattened in order; value itself when it isn't a list"""
+    stack = [iter(value if isinstance(value, list) else [value])]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, list):
+                stack.append(iter(item))
+                break
+            yield item
+        else:
+            stack.pop()
+
+
+def replicate_function_calls(value):
+    """Function calls in decoded Replicate output, in the {name, arguments} shape of /api/gemini_functions"""
+    calls = []
+    for item in iter_list_items(value):
+        if not isinstance(item, dict):
+            continue
+        # OpenAI-style tool calls nest the call under "function"
+        function = item["function"] if isinstance(item.get("function"), dict) else item
+        name = function.get("name")
+        if not isinstance(name, str) or not name:
+            continue
+        arguments = function.get("arguments", function.get("parameters"))
+        if isinstance(arguments, str):
+            try:
+                arguments = decode_json(arguments)
+            except ValueError:
+                pass
+        calls.append({"name": name, "arguments": arguments if isinstance(arguments, dict) else {}})
+    return calls
+
+
+def structure_replicate_body(body):
+    """
+    For ?structured=1: replace a prediction's output with its function calls, or the decoded
+    text when it has none. Returns (body, headers); X-Replicate-Output says which form was
+    sent, and outputs over the size or nesting limits are left raw.
+    """
+    output = body.get("output") if isinstance(body, dict) else None
+    if output is None:
+        return body, {}
+    
+    if isinstance(output, str):
+        size = len(output)
+    elif isinstance(output, list):
+        size = sum(len(item) for item in output if isinstance(item, str))
+    else:
+        size = 0
+    if size > REPLICATE_STRUCTURED_MAX_CHARS:
+        result = "too_large"
+    else:
+        try:
+            value = decode_replicate_output(output)
+            too_deep = json_depth(value, REPLICATE_STRUCTURED_MAX_DEPTH) > REPLICATE_STRUCTURED_MAX_DEPTH
+        except RecursionError:
+            # The standard library decoder recurses once per nesting level
+            too_deep = True
+        calls = [] if too_deep else replicate_function_calls(value)
+        if too_deep:
+            result = "too_deep"
+        elif len(calls) > REPLICATE_STRUCTURED_MAX_CALLS:
+            result = "too_many_calls"
+        else:
+            result = "function_calls" if calls else "text" if isinstance(value, str) else "json"
+    metrics.inc('proxy_replicate_structured_outputs_total', result=result)
+    if result in ("too_large", "too_many_calls", "too_deep"):
+        logger.warning("Returning raw Replicate output (%s, %d characters)", result, size)
+        return body, {"X-Replicate-Output": "raw"}
+    return dict(body, output=calls or value), {"X-Replicate-Output": "structured"}
+
+
+class ReplicateAttempts(UpstreamAttempts):
+    """Outcomes of Prefer: wait prediction attempts; methods return (body, status), or None to retry"""
+
+    def __init__(self):
+        super().__init__("replicate")
+
+    def completed(self, status, response_data):
+        # A null output with Prefer: wait means the model is still cold-starting
+        if status < 400 and response_data.get('output') is None and self.retry("cold_start"):
+            logger.warning("Attempt %d: Replicate returned null output (cold start). Retrying...", self.retry_count)
+            return None
+        if status >= 400:
+            logger.error("Error from Replicate API: %s", response_data)
+            provider_router.record("replicate", status < 500)
+            return response_data, status
+        provider_router.record("replicate", True)
+        return response_data, 200
+
+    def invalid(self, status, text):
+        logger.error("Non-JSON response from Replicate API: %.500s", text)
+        provider_router.record("replicate", status < 500)
+        return {"error": f"Invalid response from Replicate API: {text[:200]}..."}, status
+
+    def failed(self, e):
+        error_message = f"Error communicating with Replicate API: {str(e)}"
+        logger.error(error_message)
+        if self.retry("error"):
+            logger.warning("Retrying request (attempt %d/%d)...", self.retry_count, self.max_retries)
+            return None
+        provider_router.record("replicate", False)
+        return {"error": error_message}, 500
+
+
+def call_replicate_wait(request_data, api_token):
+    """
+    Create a prediction with Prefer: wait, retrying cold starts and errors, returning (body, status).
+    The outcome is recorded on Replicate's circuit breaker.
+    """
+    attempts = ReplicateAttempts()
+    while True:
+        try:
+            # Forward the request to Replicate API using the HTTP API approach
+            response = upstream.post(
+                REPLICATE_API_URL,
+                headers={
+                    "Authorization": f"Bearer {api_token}",
+                    "Content-Type": "application/json",
+                    "Prefer": "wait"  # Added Prefer: wait header to wait for completion
+                },
+                json=request_data,
+                read_timeout=REPLICATE_READ_TIMEOUT  # Add a timeout to prevent hanging
+            )
+            try:
+                response_data = response.json()
+            except ValueError:
+                return attempts.invalid(response.status_code, response.text)
+            if sample_bodies():
+                log_replicate_response(response_data, response.ok)
+            result = attempts.completed(response.status_code, response_data)
+        except Exception as e:
+            result = attempts.failed(e)
+        if result is not None:
+            return result
+        time.sleep(attempts.backoff())
+
+
+async def call_replicate_wait_async(request_data, api_token):
+    """Awaited counterpart of call_replicate_wait: the backoff holds no thread"""
+    attempts = ReplicateAttempts()
+    while True:
+        try:
+            async with async_upstream.post(
+                REPLICATE_API_URL,
+                headers={
+                    "Authorization": f"Bearer {api_token}",
+                    "Content-Type": "application/json",
+                    "Prefer": "wait"
+                },
+                json=request_data,
+                read_timeout=REPLICATE_READ_TIMEOUT
+            ) as response:
+                status = response.status
+                body_text = await response.text()
+            try:
+                response_data = json.loads(body_text)
+            except ValueError:
+                return attempts.invalid(status, body_text)
+            if sample_bodies():
+                log_replicate_response(response_data, status < 400)
+            result = attempts.completed(status, response_data)
+        except Exception as e:
+            result = attempts.failed(e)
+        if result is not None:
+            return result
+        await asyncio.sleep(attempts.backoff())
+
+
+def replicate_error_body(e):
+    error_message = f"Error communicating with Replicate API: {str(e)}"
+    logger.error(error_message)
+    return {"error": error_message}, 500
+
+
+def create_replicate_job(request_data, api_token):
+    """
+    Create a prediction for async job mode and hand it to the poller, returning (body, status).
+    No Prefer: wait and no cold-start retries: the poller waits for the prediction instead.
+    """
+    try:
+        response = upstream.post(
+            REPLICATE_API_URL,
+            headers={
+                "Authorization": f"Bearer {api_token}",
+                "Content-Type": "application/json"
+            },
+            json=request_data
+        )
+        return start_replicate_job(response.status_code, response.json(), api_token)
+    except Exception as e:
+        return replicate_error_body(e)
+
+
+async def create_replicate_job_async(request_data, api_token):
+    try:
+        async with async_upstream.post(
+            REPLICATE_API_URL,
+            headers={
+                "Authorization": f"Bearer {api_token}",
+                "Content-Type": "application/json"
+            },
+            json=request_data
+        ) as response:
+            return start_replicate_job(response.status, await response.json(content_type=None), api_token)
+    except Exception as e:
+        return replicate_error_body(e)
+
+
+def answer_replicate_request(request_data, api_token):
+    """
+    (body, status, headers) for a Prefer: wait request: Replicate's answer or, while it is
+    down, Ollama's, handled identically
+    """
+    return route_request(
+        "replicate",
+        lambda: call_replicate_wait(request_data, api_token),
+        lambda: call_ollama("/api/generate", build_ollama_generate_request(request_data, False), format_ollama_generate_response)
+    )
+
+
+async def answer_replicate_request_async(request_data, api_token):
+    return await route_request_async(
+        "replicate",
+        lambda: call_replicate_wait_async(request_data, api_token),
+        lambda: call_ollama_async("/api/generate", build_ollama_generate_request(request_data, False), format_ollama_generate_response)
+    )
+
+
+def structured_reply(reply, args):
+    """Decode a successful reply's output into function calls when ?structured=1 (or the default) asks for it"""
+    body, status, headers = reply
+    if status == 200 and wants_structured_output(args):
+        body, structured_headers = structure_replicate_body(body)
+        headers = dict(headers, **structured_headers)
+    return body, status, headers
+
+
+def probe_replicate(timeout):
+    # Without a token Replicate answers 401, which still shows the API is reachable
+    headers = {"Authorization": f"Bearer {REPLICATE_PROBE_TOKEN}"} if REPLICATE_PROBE_TOKEN else {}
+    response = upstream.get(REPLICATE_API_URL, headers=headers, connect_timeout=timeout, read_timeout=timeout)
+    response.close()
+    if response.status_code >= 500:
+        raise RuntimeError(f"status {response.status_code}")
+    return {"status": "up"}
+
+
+provider_health.register("replicate", probe_replicate)
@@ -0,0 +1,342 @@
+"""Retries, hedging and circuit breaking: how the proxy copes with slow or failing upstreams"""
+import asyncio
+import contextlib
+import contextvars
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as futures_wait
+
+from .logs import logger
+from .metrics import add_request_upstream, metrics, request_upstream_seconds
+from .settings import (
+    HEDGE_MAX_IN_FLIGHT, HEDGE_MIN_DELAY, HEDGE_MIN_SAMPLES, HEDGE_PERCENTILE, HEDGE_UPSTREAMS,
+    RETRY_BACKOFF_BASE, RETRY_BACKOFF_CAP, RETRY_BUDGET_MIN, RETRY_BUDGET_RATIO, RETRY_BUDGET_WINDOW,
+    UPSTREAM_MAX_RETRIES
+)
+
+
+def backoff_delay(retry_count):
+    """Seconds to wait before retry number retry_count: exponential with full jitter, capped"""
+    return random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** retry_count))
+
+
+class RetryBudget:
+    """
+    Process-wide cap on retries and hedges.
+    Within any `window` seconds at most min_retries + ratio * calls retries are allowed,
+    so during an incident retries can't multiply the load on an upstream that is
+    already struggling. Counts are kept in one-second buckets.
+    """
+
+    def __init__(self, ratio, min_retries, window):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._buckets = deque()  # [second, calls, retries]
+        self._denied = 0
+        self._lock = threading.Lock()
+
+    def _current(self):
+        second = int(time.monotonic())
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0])
+        while self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+        return self._buckets[-1]
+
+    def record_request(self):
+        """Count a first attempt at an upstream call"""
+        with self._lock:
+            self._current()[1] += 1
+
+    def allow(self, upstream_name, reason):
+        """Spend one retry from the budget, or return False when it is used up"""
+        with self._lock:
+            bucket = self._current()
+            calls = sum(b[1] for b in self._buckets)
+            retries = sum(b[2] for b in self._buckets)
+            if retries < self.min_retries + self.ratio * calls:
+                bucket[2] += 1
+                return True
+            self._denied += 1
+        metrics.inc('proxy_retries_denied_total', upstream=upstream_name, reason=reason)
+        logger.warning("Retry budget spent, not retrying %s (%s)", upstream_name, reason)
+        return False
+
+    def stats(self):
+        with self._lock:
+            self._current()
+            return {
+                "calls": sum(b[1] for b in self._buckets),
+                "retries": sum(b[2] for b in self._buckets),
+                "window_seconds": self.window,
+                "denied": self._denied
+            }
+
+
+class HedgePolicy:
+    """
+    Tracks recent successful call latencies for hedged upstreams and derives the
+    hedge delay from them: a call still running after the configured percentile
+    gets a duplicate. Until min_samples calls have been seen nothing is hedged.
+    """
+
+    def __init__(self, upstreams, percentile, min_samples, min_delay, window=500):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._samples = {name: deque(maxlen=window) for name in upstreams}
+        self._lock = threading.Lock()
+
+    def observe(self, upstream_name, seconds):
+        samples = self._samples.get(upstream_name)
+        if samples is not None:
+            with self._lock:
+                samples.append(seconds)
+
+    def delay(self, upstream_name):
+        """Seconds to wait before hedging a call, or None when it shouldn't be hedged"""
+        samples = self._samples.get(upstream_name)
+        if samples is None:
+            return None
+        with self._lock:
+            if len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        # Nearest-rank percentile
+        rank = min(max(math.ceil(len(ordered) * self.percentile / 100) - 1, 0), len(ordered) - 1)
+        return max(ordered[rank], self.min_delay)
+
+    def stats(self):
+        return {
+            name: {"samples": len(samples), "delay": self.delay(name)}
+            for name, samples in self._samples.items()
+        }
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN, RETRY_BUDGET_WINDOW)
+hedge_policy = HedgePolicy(
+    [name.strip() for name in HEDGE_UPSTREAMS.split(',') if name.strip()],
+    HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY
+)
+# Flask mode runs both copies of a hedged call here so the request can take whichever answers first
+hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_MAX_IN_FLIGHT, thread_name_prefix='hedge')
+hedge_slots = threading.BoundedSemaphore(HEDGE_MAX_IN_FLIGHT)
+
+
+def record_upstream(name, seconds, error=False):
+    metrics.observe('proxy_upstream_duration_seconds', seconds, upstream=name)
+    if error:
+        metrics.inc('proxy_upstream_errors_total', upstream=name)
+    else:
+        hedge_policy.observe(name, seconds)
+    add_request_upstream(seconds)
+
+
+@contextlib.contextmanager
+def timed_upstream(name):
+    """Time an upstream call that doesn't go through UpstreamClient (the Gemini SDK)"""
+    metrics.inc('proxy_upstream_in_flight', upstream=name)
+    start = time.monotonic()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        metrics.dec('proxy_upstream_in_flight', upstream=name)
+        record_upstream(name, time.monotonic() - start, error=failed)
+
+
+class UpstreamAttempts:
+    """
+    Retry bookkeeping for one request's attempts against an upstream. The sync and
+    async code paths do the I/O and the backoff sleep; subclasses classify each
+    attempt's outcome, record it on the provider's circuit breaker and say whether
+    to try again.
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.max_retries = UPSTREAM_MAX_RETRIES
+        self.retry_count = 0
+        retry_budget.record_request()
+
+    def retry(self, reason):
+        """Whether another attempt may be made for reason (cold_start, empty, error); counts it if so"""
+        if self.retry_count >= self.max_retries or not retry_budget.allow(self.upstream, reason):
+            return False
+        self.retry_count += 1
+        metrics.inc('proxy_retries_total', upstream=self.upstream, reason=reason)
+        return True
+
+    def backoff(self):
+        """Seconds to sleep before the retry just granted (jittered exponential backoff)"""
+        return backoff_delay(self.retry_count)
+
+
+def _submit_hedge_attempt(call, hedge_of=None):
+    """
+    Run call on the hedge pool, or return None when every slot is busy. A duplicate
+    (hedge_of names its upstream) is paid for from the retry budget once it has a slot.
+    Each copy counts its upstream seconds apart, in future.upstream_seconds.
+    """
+    slots = hedge_slots
+    if not slots.acquire(blocking=False):
+        return None
+    if hedge_of is not None and not retry_budget.allow(hedge_of, "hedge"):
+        slots.release()
+        return None
+    spent = [0.0]
+    
+    def attempt():
+        request_upstream_seconds.set(spent)
+        return call()
+    
+    future = hedge_pool.submit(contextvars.copy_context().run, attempt)
+    future.upstream_seconds = spent
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def _hedge_result(future, started_after=0.0):
+    # Only the copy the request waited for counts towards its upstream time, so
+    # proxy_overhead_seconds isn't understated by the copy running alongside it
+    futures_wait([future])
+    add_request_upstream(started_after + future.upstream_seconds[0])
+    return future.result()
+
+
+def hedged_call(upstream_name, call):
+    """
+    Run call(), and if it hasn't answered after the upstream's hedge delay run a duplicate
+    and return whichever succeeds first. The duplicate is paid for from the retry budget;
+    the slower copy is left to finish in the background.
+    """
+    delay = hedge_policy.delay(upstream_name)
+    first = _submit_hedge_attempt(call) if delay is not None else None
+    if first is None:
+        return call()
+    start = time.monotonic()
+    done, _ = futures_wait([first], timeout=delay)
+    second = None if done else _submit_hedge_attempt(call, hedge_of=upstream_name)
+    if second is None:
+        return _hedge_result(first)
+    second_after = time.monotonic() - start
+    metrics.inc('proxy_hedged_requests_total', upstream=upstream_name)
+    
+    pending = {first, second}
+    while True:
+        done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+        succeeded = [future for future in done if future.exception() is None]
+        if succeeded or not pending:
+            winner = succeeded[0] if succeeded else done.pop()
+            if winner is second and succeeded:
+                metrics.inc('proxy_hedge_wins_total', upstream=upstream_name)
+            return _hedge_result(winner, second_after if winner is second else 0.0)
+
+
+async def _hedge_attempt_async(call, spent):
+    # Tasks run in a copy of the request's context, so this only redirects this copy's upstream time
+    request_upstream_seconds.set(spent)
+    return await call()
+
+
+async def hedged_call_async(upstream_name, call):
+    """Awaited counterpart of hedged_call; the slower copy is cancelled"""
+    delay = hedge_policy.delay(upstream_name)
+    if delay is None:
+        return await call()
+    first_spent, second_spent = [0.0], [0.0]
+    start = time.monotonic()
+    first = asyncio.ensure_future(_hedge_attempt_async(call, first_spent))
+    done, _ = await asyncio.wait([first], timeout=delay)
+    if done or not retry_budget.allow(upstream_name, "hedge"):
+        try:
+            return await first
+        finally:
+            add_request_upstream(first_spent[0])
+    metrics.inc('proxy_hedged_requests_total', upstream=upstream_name)
+    second_after = time.monotonic() - start
+    second = asyncio.ensure_future(_hedge_attempt_async(call, second_spent))
+    
+    pending = {first, second}
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded or not pending:
+                winner = succeeded[0] if succeeded else done.pop()
+                if winner is second and succeeded:
+                    metrics.inc('proxy_hedge_wins_total', upstream=upstream_name)
+                add_request_upstream(second_after + second_spent[0] if winner is second else first_spent[0])
+                return winner.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker.
+    failure_threshold consecutive failed requests open the circuit and requests are refused
+    for reset_timeout; then a single trial request is let through (half-open). Its success
+    closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return self.state != "closed" and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self):
+        """Whether a request may go to this provider now; may claim the half-open trial"""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and now - self.opened_at < self.reset_timeout:
+                return False
+            if self.state == "half_open" and now - self.trial_started < self.reset_timeout:
+                return False  # A trial is already in flight
+            self.state = "half_open"
+            self.trial_started = now
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.state = "closed"
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == "closed" and self.failures < self.failure_threshold:
+                return
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.opens += 1
+        logger.warning("Circuit for %s opened after %d consecutive failures", self.name, self.failures)
+        metrics.inc('proxy_circuit_opens_total', provider=self.name)
+
+    def retry_after(self):
+        """Seconds until the circuit will let a trial request through"""
+        with self._lock:
+            if self.state == "closed":
+                return 0
+            return max(int(self.reset_timeout - (time.monotonic() - self.opened_at)) + 1, 1)
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, "opens": self.opens}
@@ -0,0 +1,124 @@
+"""Configuration, read from the environment (and a .env file) once at import"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()  # Load variables from .env if present
+
+# Logging
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()  # "text" or "json"
+LOG_BODY_SAMPLE_RATE = float(os.environ.get('LOG_BODY_SAMPLE_RATE', 0.0))  # Fraction of requests whose bodies are logged at DEBUG
+
+# Configuration
+OLLAMA_BASE_URL = "http://localhost:11434"  # Default Ollama endpoint
+REPLICATE_API_URL = os.environ.get('REPLICATE_API_URL', "https://api.replicate.com/v1/predictions")  # Override to point at a local fake
+
+# "flask" (default, threaded WSGI) or "async" (aiohttp, upstream calls and backoff are awaited)
+SERVER_MODE = os.environ.get('SERVER_MODE', 'flask').lower()
+# Provider SDKs load on first use; set to import them at startup, e.g. once in a preloading gunicorn master
+PRELOAD_PROVIDER_SDKS = os.environ.get('PRELOAD_PROVIDER_SDKS', '').lower() in ('1', 'true', 'yes')
+
+# Upstream connection pool configuration
+UPSTREAM_POOL_CONNECTIONS = int(os.environ.get('UPSTREAM_POOL_CONNECTIONS', 10))  # Pools kept per host
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 20))  # Keep-alive connections per pool
+UPSTREAM_POOL_SIZES = os.environ.get('UPSTREAM_POOL_SIZES', '')  # Per-host overrides, e.g. "api.replicate.com=32,localhost:11434=4"
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+REPLICATE_READ_TIMEOUT = float(os.environ.get('REPLICATE_READ_TIMEOUT', 30))
+OLLAMA_READ_TIMEOUT = float(os.environ.get('OLLAMA_READ_TIMEOUT', 120))
+
+# Replicate async job mode: create the prediction once and poll it in the background
+REPLICATE_ASYNC_JOBS = os.environ.get('REPLICATE_ASYNC_JOBS', '').lower() in ('1', 'true', 'yes')  # Default for requests without ?async=
+REPLICATE_POLL_INTERVAL = float(os.environ.get('REPLICATE_POLL_INTERVAL', 1.0))  # First poll delay per prediction
+REPLICATE_POLL_MAX_INTERVAL = float(os.environ.get('REPLICATE_POLL_MAX_INTERVAL', 10.0))
+REPLICATE_POLL_RATE = float(os.environ.get('REPLICATE_POLL_RATE', 5.0))  # Max status polls per second across all jobs
+REPLICATE_MAX_JOBS = int(os.environ.get('REPLICATE_MAX_JOBS', 1000))
+REPLICATE_JOB_TTL = float(os.environ.get('REPLICATE_JOB_TTL', 600))  # Seconds a finished job's result is kept
+
+# Structured Replicate output: decode the nested output into [{name, arguments}] on the server
+REPLICATE_STRUCTURED_OUTPUT = os.environ.get('REPLICATE_STRUCTURED_OUTPUT', '').lower() in ('1', 'true', 'yes')  # Default for requests without ?structured=
+REPLICATE_STRUCTURED_MAX_CHARS = int(os.environ.get('REPLICATE_STRUCTURED_MAX_CHARS', 1048576))  # Larger outputs are returned raw
+REPLICATE_STRUCTURED_MAX_CALLS = int(os.environ.get('REPLICATE_STRUCTURED_MAX_CALLS', 64))  # Outputs with more function calls are returned raw
+REPLICATE_STRUCTURED_MAX_DEPTH = int(os.environ.get('REPLICATE_STRUCTURED_MAX_DEPTH', 32))  # Outputs nested deeper (JSON layers, lists or objects) are returned raw
+
+# Ollama backend pool: requests go to the least busy healthy backend, preferring ones with the model loaded
+OLLAMA_BACKENDS = os.environ.get('OLLAMA_BACKENDS') or os.environ.get('OLLAMA_URL') or OLLAMA_BASE_URL  # Comma-separated URLs
+OLLAMA_FAILURE_THRESHOLD = int(os.environ.get('OLLAMA_FAILURE_THRESHOLD', 3))  # Consecutive failures before a backend is ejected
+OLLAMA_EJECT_COOLDOWN = float(os.environ.get('OLLAMA_EJECT_COOLDOWN', 30))  # Seconds an ejected backend stays out of rotation
+OLLAMA_MODEL_TTL = float(os.environ.get('OLLAMA_MODEL_TTL', 300))  # Seconds a model is assumed loaded after a backend served it (Ollama keep_alive)
+OLLAMA_SPILL_OUTSTANDING = int(os.environ.get('OLLAMA_SPILL_OUTSTANDING', 8))  # Busy warm backends spill over to cold ones at this many outstanding requests
+
+# Compiled Gemini tools/model cache configuration
+GEMINI_MODEL_CACHE_SIZE = int(os.environ.get('GEMINI_MODEL_CACHE_SIZE', 32))
+
+# Relevance-based tool pre-selection for /api/gemini_functions
+TOOL_PRESELECT_TOP_K = int(os.environ.get('TOOL_PRESELECT_TOP_K', 0))  # Send only the k tools most relevant to the query; 0 sends all (a request's "tool_top_k" overrides it)
+TOOL_PRESELECT_MIN_TOOLS = int(os.environ.get('TOOL_PRESELECT_MIN_TOOLS', 12))  # Smaller tool sets are always sent whole
+TOOL_INDEX_CACHE_SIZE = int(os.environ.get('TOOL_INDEX_CACHE_SIZE', 32))  # Tools payloads whose search index is kept
+TOOL_PRESELECT_BASELINE_RATE = float(os.environ.get('TOOL_PRESELECT_BASELINE_RATE', 0.05))  # Fraction of eligible requests still sent every tool, the baseline for the reported savings
+
+# Response cache for deterministic (temperature 0) requests; set RESPONSE_CACHE_SIZE=0 to disable
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 300))
+CACHE_BYPASS_HEADER = 'X-Cache-Bypass'  # Send "X-Cache-Bypass: 1" to skip the response cache and request coalescing
+
+# Provider health probes, circuit breakers and cross-provider fallback
+HEALTH_PROBE_INTERVAL = float(os.environ.get('HEALTH_PROBE_INTERVAL', 30))  # Seconds between background probes; 0 disables them
+HEALTH_PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', 5))
+PROVIDER_SLOW_THRESHOLD = float(os.environ.get('PROVIDER_SLOW_THRESHOLD', 5))  # Probe latency in seconds above which a provider counts as slow
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))  # Consecutive failed requests that open a provider's circuit
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))  # Seconds an open circuit waits before letting a trial request through
+PROVIDER_FALLBACKS = os.environ.get('PROVIDER_FALLBACKS', 'replicate:ollama,gemini:ollama')  # primary:fallback pairs; empty disables fallback
+FALLBACK_OLLAMA_MODEL = os.environ.get('FALLBACK_OLLAMA_MODEL', 'llama3.1')  # Tool-capable model used when function calling falls back to Ollama
+GEMINI_PROBE_MODEL = os.environ.get('GEMINI_PROBE_MODEL', 'gemini-3-flash-preview')
+REPLICATE_PROBE_TOKEN = os.environ.get('REPLICATE_API_TOKEN', '')  # Optional; without it the probe only checks Replicate is reachable
+
+# Retry, backoff and hedging configuration
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+RETRY_BACKOFF_BASE = float(os.environ.get('RETRY_BACKOFF_BASE', 1))  # Retry n waits a random 0..BASE * 2**n seconds (full jitter)
+RETRY_BACKOFF_CAP = float(os.environ.get('RETRY_BACKOFF_CAP', 10))
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.2))  # Retries plus hedges allowed as a fraction of recent upstream calls
+RETRY_BUDGET_MIN = int(os.environ.get('RETRY_BUDGET_MIN', 10))  # Retries always allowed per window, so quiet periods can still retry
+RETRY_BUDGET_WINDOW = int(os.environ.get('RETRY_BUDGET_WINDOW', 10))  # Seconds of traffic the budget looks back over
+HEDGE_UPSTREAMS = os.environ.get('HEDGE_UPSTREAMS', 'gemini')  # Upstreams whose slow calls get a duplicate; empty disables hedging
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))  # A duplicate is sent once a call outlasts this latency percentile
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.05))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))  # Successful calls observed before hedging starts
+HEDGE_MAX_IN_FLIGHT = int(os.environ.get('HEDGE_MAX_IN_FLIGHT', 64))  # Threads for hedgeable calls in Flask mode; beyond it calls run unhedged
+
+# Admission control configuration
+RATE_LIMIT_RPS = float(os.environ.get('RATE_LIMIT_RPS', 5))  # Sustained requests per second per API key (or client address without one); 0 disables rate limiting
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 20))  # Token bucket size: requests a key may send at once after being idle
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 10000))  # Buckets kept; the least recently seen keys are dropped beyond it
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))  # Proxies in front of the app whose X-Forwarded-For entries are trusted
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 32))  # Threads per Flask mode worker (read by gunicorn.conf.py too)
+ROUTE_CONCURRENCY = os.environ.get('ROUTE_CONCURRENCY', '')  # Requests handled at once per upstream route; empty: GUNICORN_THREADS // 4 in Flask mode, 32 in async mode; 0 disables the limit
+ROUTE_CONCURRENCY_LIMITS = os.environ.get('ROUTE_CONCURRENCY_LIMITS', '')  # Per-route overrides, e.g. "/api/chat=8,/api/gemini_functions=64"
+ROUTE_QUEUE_SIZE = os.environ.get('ROUTE_QUEUE_SIZE', '')  # Requests allowed to wait for a slot per route, more are shed with a 503; empty: the route's limit in Flask mode, 64 in async mode
+ROUTE_QUEUE_TIMEOUT = float(os.environ.get('ROUTE_QUEUE_TIMEOUT', 5))  # Seconds a request waits for a slot before being shed
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', 1))  # Retry-After sent with shed requests
+
+# /api/chat session configuration
+CHAT_SESSION_MAX = int(os.environ.get('CHAT_SESSION_MAX', 1000))  # Sessions kept in memory; the least recently used are evicted beyond it
+CHAT_SESSION_TTL = float(os.environ.get('CHAT_SESSION_TTL', 3600))  # Seconds an idle session is kept
+CHAT_SESSION_TOKEN_BUDGET = int(os.environ.get('CHAT_SESSION_TOKEN_BUDGET', 4096))  # Estimated tokens of history sent to Ollama per turn
+CHAT_SESSION_DIR = os.environ.get('CHAT_SESSION_DIR', '')  # Optional directory to persist sessions in, shared by workers and restarts
+
+# /api/gemini_functions/batch configuration
+GEMINI_BATCH_WORKERS = int(os.environ.get('GEMINI_BATCH_WORKERS', 8))  # Batch queries running at once across all batches
+GEMINI_BATCH_MAX_ITEMS = int(os.environ.get('GEMINI_BATCH_MAX_ITEMS', 100))
+
+# Per-API-key Gemini client registry configuration
+GEMINI_CLIENT_MAX = int(os.environ.get('GEMINI_CLIENT_MAX', 64))
+GEMINI_CLIENT_IDLE_TTL = float(os.environ.get('GEMINI_CLIENT_IDLE_TTL', 900))  # Seconds before an unused client is dropped
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT', '')  # Plain-text gRPC host:port of a local fake (bench/fake_upstreams.py); API keys are not sent
+
+
+def parse_pool_sizes(spec):
+    """Parse "host=size,host=size" into a dict, ignoring malformed entries"""
+    sizes = {}
+    for entry in spec.split(','):
+        host, _, size = entry.strip().partition('=')
+        if host and size.strip().isdigit():
+            sizes[host.strip()] = int(size)
+    return sizes
@@ -0,0 +1,18 @@
+"""Server-sent events, shared by the Flask and aiohttp streaming responses"""
+import json
+
+# Tells proxies such as nginx not to buffer the stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def wants_stream(request_data, args):
+    """Streaming is opt-in via ?stream=1 or "stream": true in the request body"""
+    if args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return request_data.get('stream') is True
+
+
+def sse_event(data, event=None):
+    """Format one server-sent event carrying a JSON payload"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
@@ -0,0 +1,208 @@
+"""Pre-selection of the tools sent with a function calling request, by relevance to the query"""
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+from .caching import LRUCache
+from .chat_sessions import CHARS_PER_TOKEN
+from .metrics import metrics
+from .settings import TOOL_INDEX_CACHE_SIZE, TOOL_PRESELECT_BASELINE_RATE, TOOL_PRESELECT_MIN_TOOLS, TOOL_PRESELECT_TOP_K
+
+
+TOOL_STOPWORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "get", "how", "i", "in", "is", "it",
+    "me", "my", "of", "on", "or", "please", "that", "the", "this", "to", "what", "with", "you", "your"
+))
+
+
+def tool_terms(text):
+    """Lowercased search terms, with camelCase and snake_case names split into words"""
+    terms = []
+    for word in re.findall(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+', text or ''):
+        word = word.lower()
+        if word in TOOL_STOPWORDS:
+            continue
+        # Crude plural folding so "balances" matches get_balance
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class ToolIndex:
+    """BM25 index over one tools payload: names (weighted double), descriptions and parameters"""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, tools):
+        self.tools = tools
+        self.documents = [Counter(self._terms(tool)) for tool in tools]
+        self.lengths = [sum(document.values()) for document in self.documents]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        document_frequency = Counter(term for document in self.documents for term in document)
+        self.idf = {
+            term: math.log(1 + (len(tools) - count + 0.5) / (count + 0.5))
+            for term, count in document_frequency.items()
+        }
+        # Rough prompt cost of each declaration, for the reported savings
+        self.token_estimates = [len(json.dumps(tool)) // CHARS_PER_TOKEN for tool in tools]
+
+    @staticmethod
+    def _terms(tool):
+        function = tool.get("function") if isinstance(tool, dict) else None
+        if not isinstance(function, dict):
+            return []
+        terms = tool_terms(function.get("name")) * 2 + tool_terms(function.get("description"))
+        parameters = function.get("parameters")
+        properties = parameters.get("properties") if isinstance(parameters, dict) else None
+        for name, schema in (properties or {}).items():
+            terms += tool_terms(name)
+            if isinstance(schema, dict):
+                terms += tool_terms(schema.get("description"))
+        return terms
+
+    def score(self, index, query_terms):
+        document = self.documents[index]
+        length_norm = 1 - self.B + self.B * self.lengths[index] / (self.average_length or 1)
+        total = 0.0
+        for term in query_terms:
+            frequency = document.get(term)
+            if frequency:
+                total += self.idf[term] * frequency * (self.K1 + 1) / (frequency + self.K1 * length_norm)
+        return total
+
+    def top_k(self, query, k):
+        """Indices of up to k tools matching the query, in payload order; empty when nothing matches"""
+        query_terms = set(tool_terms(query))
+        scores = [(self.score(index, query_terms), index) for index in range(len(self.tools))]
+        best = sorted((item for item in scores if item[0] > 0), key=lambda item: (-item[0], item[1]))[:k]
+        # Payload order keeps the subset's JSON, and so its compiled model, stable across queries
+        return sorted(index for _, index in best)
+
+
+class ToolSelector:
+    """
+    Narrows large tool sets to the ones relevant to a query, with indexes cached per
+    tools payload. A small sample of eligible requests keeps every tool so the
+    latency of preselected requests can be compared against a measured baseline.
+    """
+
+    def __init__(self, top_k, min_tools, cache_size, baseline_rate):
+        self.top_k = top_k
+        self.min_tools = min_tools
+        self.baseline_rate = baseline_rate
+        self.indexes = LRUCache(cache_size)
+        self._lock = threading.Lock()
+        self.preselected = 0
+        self.baseline = 0
+        self.unmatched = 0
+        self.tools_offered = 0
+        self.tools_sent = 0
+        self.tokens_offered = 0
+        self.tokens_sent = 0
+        self._latency = {"preselected": [0, 0.0], "all": [0, 0.0]}  # tools -> [count, total seconds]
+
+    def index_for(self, tools_json_string):
+        tools_hash = hashlib.sha256(tools_json_string.encode('utf-8')).hexdigest()
+        index = self.indexes.get(tools_hash)
+        if index is None:
+            index = ToolIndex(json.loads(tools_json_string))
+            self.indexes.put(tools_hash, index)
+        return index
+
+    def select(self, query, tools_json_string, top_k=None):
+        """
+        Return (tools_json_string, selection): the tools to send, and for requests eligible
+        for pre-selection a dict with the mode ("preselected" or "all"), sent and total.
+        Raises ValueError for an invalid tool_top_k; invalid tools JSON is passed through.
+        """
+        if top_k is None:
+            top_k = self.top_k
+        elif isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 0:
+            raise ValueError("Parameter 'tool_top_k' must be a non-negative integer")
+        if top_k <= 0:
+            return tools_json_string, None
+        
+        start = time.perf_counter()
+        try:
+            index = self.index_for(tools_json_string)
+        except ValueError:
+            return tools_json_string, None
+        total = len(index.tools)
+        if not isinstance(index.tools, list) or total < max(self.min_tools, top_k + 1):
+            return tools_json_string, None
+        
+        selected = index.top_k(query, top_k) if random.random() >= self.baseline_rate else None
+        metrics.observe('proxy_tool_selection_seconds', time.perf_counter() - start)
+        
+        total_tokens = sum(index.token_estimates)
+        with self._lock:
+            self.tools_offered += total
+            self.tokens_offered += total_tokens
+            if not selected:
+                # Baseline sample, or no tool shares a term with the query: send everything
+                if selected is None:
+                    self.baseline += 1
+                else:
+                    self.unmatched += 1
+                self.tools_sent += total
+                self.tokens_sent += total_tokens
+                return tools_json_string, {"mode": "all", "sent": total, "total": total}
+            sent_tokens = sum(index.token_estimates[i] for i in selected)
+            self.preselected += 1
+            self.tools_sent += len(selected)
+            self.tokens_sent += sent_tokens
+        metrics.inc('proxy_tool_tokens_saved_total', total_tokens - sent_tokens)
+        subset = json.dumps([index.tools[i] for i in selected])
+        return subset, {"mode": "preselected", "sent": len(selected), "total": total}
+
+    def observe(self, selection, seconds):
+        """Record the upstream time of an uncached Gemini answer for a selected request"""
+        if selection is None:
+            return
+        metrics.observe('proxy_gemini_tools_latency_seconds', seconds, tools=selection["mode"])
+        with self._lock:
+            latency = self._latency[selection["mode"]]
+            latency[0] += 1
+            latency[1] += seconds
+
+    def stats(self):
+        with self._lock:
+            mean = {mode: (total / count if count else None) for mode, (count, total) in self._latency.items()}
+            saved = None
+            if mean["preselected"] is not None and mean["all"] is not None:
+                saved = round((mean["all"] - mean["preselected"]) * 1000, 1) or 0.0
+            return {
+                "top_k": self.top_k,
+                "min_tools": self.min_tools,
+                "baseline_rate": self.baseline_rate,
+                "preselected": self.preselected,
+                "baseline": self.baseline,
+                "unmatched": self.unmatched,
+                "tools_offered": self.tools_offered,
+                "tools_sent": self.tools_sent,
+                "estimated_tokens_offered": self.tokens_offered,
+                "estimated_tokens_sent": self.tokens_sent,
+                "estimated_tokens_saved": self.tokens_offered - self.tokens_sent,
+                "mean_latency_ms": {mode: round(value * 1000, 1) if value is not None else None for mode, value in mean.items()},
+                "latency_saved_ms": saved,
+                "indexes": self.indexes.stats()
+            }
+
+
+tool_selector = ToolSelector(TOOL_PRESELECT_TOP_K, TOOL_PRESELECT_MIN_TOOLS, TOOL_INDEX_CACHE_SIZE, TOOL_PRESELECT_BASELINE_RATE)
+
+
+def tool_selection_headers(selection):
+    return {"X-Tool-Selection": f"{selection['sent']}/{selection['total']}"} if selection else {}
+
+
+def is_uncached_gemini_answer(status, headers):
+    # Only fresh Gemini calls say anything about how the tool count affects latency
+    return status == 200 and headers.get("X-Provider") == "gemini" and headers.get("X-Cache") in ("MISS", "BYPASS")
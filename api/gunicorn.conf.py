@@ -0,0 +1,44 @@
+"""
+Production server settings for api/replicate_py.py:
+
+    gunicorn -c api/gunicorn.conf.py
+
+The master imports the app once (preload_app) and forks WEB_CONCURRENCY workers from
+it, so workers start serving without importing Flask and the proxy again and share
+those memory pages. Flask mode workers are threaded (gthread, GUNICORN_THREADS each);
+SERVER_MODE=async runs aiohttp's worker with one event loop per worker.
+The app reads GUNICORN_THREADS too: a request waiting for a route's concurrency slot
+holds a thread, so each route's limit plus queue is kept within half of them.
+
+There is one worker by default because most state lives in the worker's memory:
+- chat sessions (unless CHAT_SESSION_DIR is set)
+- Replicate async jobs
+- per-key rate limits and route concurrency limits
+- circuit breakers
+- caches
+- the /metrics counters
+With several workers, a session or job started on one worker is unknown to the others,
+each worker lets a key through at the full RATE_LIMIT_RPS, and every scrape of /metrics
+sees a single worker. Scale with GUNICORN_THREADS, or raise WEB_CONCURRENCY only when
+none of that matters (no sessions without CHAT_SESSION_DIR, no ?async=1).
+"""
+import os
+
+pythonpath = os.path.dirname(os.path.abspath(__file__))
+bind = f"0.0.0.0:{os.environ.get('PORT', 3000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+preload_app = True
+
+if os.environ.get('SERVER_MODE', 'flask').lower() == 'async':
+    worker_class = 'aiohttp.GunicornWebWorker'
+    wsgi_app = 'replicate_py:create_async_app()'
+else:
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', 32))
+    wsgi_app = 'replicate_py:app'
+
+# Ollama may take OLLAMA_READ_TIMEOUT (120s by default) before answering
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 180))
+graceful_timeout = 30
+keepalive = 5
+errorlog = '-'
@@ -1,20 +1,49 @@
-from flask import Flask, request, jsonify
-import requests
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 import os
-import json
-from flask_cors import CORS
-from dotenv import load_dotenv
 import time
-# Add import for Google Generative AI SDK
-import google.generativeai as genai
+from flask_cors import CORS
+
+from _proxy.admission import admitted_route, rate_limit, route_limiters, shed_body
+from _proxy.caching import coalescer
+from _proxy.chat_sessions import chat_session_reply
+from _proxy.gemini import answer_gemini_batch, answer_gemini_request, gemini_events
+from _proxy.handlers import (
+    cache_stats_body, chat_failed, gemini_health_reply, gemini_reply, ollama_failed, prepare_chat_request,
+    prepare_gemini_batch, prepare_gemini_request, prepare_ollama_request, prepare_replicate_request,
+    replicate_job_reply, upstream_stats_body
+)
+from _proxy.http_clients import upstream
+from _proxy.logs import logger
+from _proxy.metrics import METRICS_CONTENT_TYPE, begin_request_metrics, end_request_metrics, metrics
+from _proxy.ollama_backends import OllamaStream, format_ollama_generate_chunk, generate_coalesced, ollama_pool, relay_ollama_stream
+from _proxy.providers import pick_provider, provider_health, provider_router
+from _proxy.replicate_api import answer_replicate_request, create_replicate_job, structured_reply, wants_async_job
+from _proxy.settings import SERVER_MODE
+from _proxy.streaming import SSE_HEADERS, wants_stream
+# The Google Generative AI SDK is imported on first use, see _proxy.gemini.gemini_sdk()
 
-load_dotenv()  # Load variables from .env if present
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Configuration
-OLLAMA_BASE_URL = "http://localhost:11434"  # Default Ollama endpoint
-REPLICATE_API_URL = "https://api.replicate.com/v1/predictions"
+
+def json_reply(body, status=200, headers=None):
+    return jsonify(body), status, headers or {}
+
+
+def sse_response(events):
+    """Wrap an SSE generator in a response that proxies won't buffer"""
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+
+def relay_ollama(stream):
+    error, events = relay_ollama_stream(stream)
+    if error:
+        return json_reply(*error)
+    streamed = sse_response(events)
+    # A client that disconnects before the first chunk closes the generator without running it
+    streamed.call_on_close(stream.abandon)
+    return streamed
+
 
 @app.route('/api/replicate', methods=['POST'])
 def proxy_replicate():
@@ -22,111 +51,23 @@ def proxy_replicate():
     This endpoint forwards requests to the Replicate API using the HTTP API approach
     Note: This endpoint is now deprecated and replaced by Gemini function calling,
     but kept for backward compatibility
+    With ?async=1 the prediction is created once and a job id is returned immediately (202);
+    poll /api/replicate/<id> for the result
+    Otherwise, while Replicate is down the request is answered by the fallback provider (Ollama)
+    With ?structured=1 the output is decoded into [{name, arguments}] function calls
     """
-    # Get the request data
-    request_data = request.json
-    
-    if not request_data:
-        return jsonify({"error": "Request body is required"}), 400
-    
-    # Get the API token from the headers
-    api_token = request.headers.get('X-Replicate-API-Token')
-    if not api_token:
-        return jsonify({"error": "Replicate API token is required"}), 401
-    
-    print(f"Forwarding request to Replicate API: {json.dumps(request_data)[:500]}...")
-    
-    # Implement retry mechanism for cold starts
-    max_retries = 2
-    retry_count = 0
-    
-    while retry_count <= max_retries:
-        try:
-            # Forward the request to Replicate API using the HTTP API approach
-            response = requests.post(
-                REPLICATE_API_URL,
-                headers={
-                    "Authorization": f"Bearer {api_token}",
-                    "Content-Type": "application/json",
-                    "Prefer": "wait"  # Added Prefer: wait header to wait for completion
-                },
-                json=request_data,
-                timeout=30  # Add a timeout to prevent hanging
-            )
-            
-            # Get the response from Replicate
-            try:
-                response_data = response.json()
-                print(f"Raw Replicate API response: {json.dumps(response_data)[:500]}...")
-                
-                # Add more detailed logging for the output field
-                if 'output' in response_data:
-                    print(f"COMPLETE OUTPUT: {json.dumps(response_data['output'])}")
-                    
-                    # Parse output for better debugging
-                    if response_data['output'] is not None:
-                        try:
-                            if isinstance(response_data['output'], str):
-                                # Try to parse the string as JSON
-                                parsed_output = json.loads(response_data['output'])
-                                print(f"Parsed output (JSON): {json.dumps(parsed_output, indent=2)}")
-                                
-                                # If it's an array of strings, try to parse each string
-                                if isinstance(parsed_output, list):
-                                    parsed_items = []
-                                    for item in parsed_output:
-                                        if isinstance(item, str) and (item.startswith('{') or item.startswith('[')):
-                                            try:
-                                                parsed_item = json.loads(item)
-                                                parsed_items.append(parsed_item)
-                                            except:
-                                                parsed_items.append(item)
-                                        else:
-                                            parsed_items.append(item)
-                                    print(f"Parsed items: {json.dumps(parsed_items, indent=2)}")
-                        except Exception as e:
-                            print(f"Error parsing output JSON: {str(e)}")
-                            print(f"Raw output: {response_data['output']}")
-                else:
-                    print("No 'output' field found in response")
-                
-                # If there's an error, print the full response for debugging
-                if not response.ok:
-                    print(f"FULL ERROR RESPONSE: {json.dumps(response_data)}")
-            except:
-                print(f"Non-JSON response from Replicate API: {response.text[:500]}...")
-                return jsonify({"error": f"Invalid response from Replicate API: {response.text[:200]}..."}), response.status_code
-            
-            # Check if we got a null output (cold start)
-            if response.ok and response_data.get('output') is None and retry_count < max_retries:
-                print(f"Attempt {retry_count + 1}: Replicate returned null output (cold start). Retrying...")
-                retry_count += 1
-                # Wait before retrying (exponential backoff)
-                time.sleep(2 ** retry_count)
-                continue
-            
-            if not response.ok:
-                error_message = f"Error from Replicate API: {response_data}"
-                print(error_message)
-                return jsonify(response_data), response.status_code
-            
-            # With Prefer: wait, we should get the completed prediction directly
-            # No need to poll for results
-            return jsonify(response_data)
-            
-        except Exception as e:
-            error_message = f"Error communicating with Replicate API: {str(e)}"
-            print(error_message)
-            
-            retry_count += 1
-            if retry_count <= max_retries:
-                print(f"Retrying request (attempt {retry_count}/{max_retries})...")
-                time.sleep(2 ** retry_count)  # Exponential backoff
-                continue
-            
-            return jsonify({"error": error_message}), 500
-    
-    return jsonify({"error": "Maximum retries exceeded"}), 500
+    request_data = request.get_json(silent=True)
+    error, api_token = prepare_replicate_request(request_data, request.headers)
+    if error:
+        return json_reply(*error)
+    if wants_async_job(request.args):
+        return json_reply(*create_replicate_job(request_data, api_token))
+    return json_reply(*structured_reply(answer_replicate_request(request_data, api_token), request.args))
+
+@app.route('/api/replicate/<job_id>', methods=['GET'])
+def replicate_job_status(job_id):
+    """Return the last polled state of a prediction started with /api/replicate?async=1"""
+    return json_reply(*replicate_job_reply(job_id, request.headers))
 
 # NEW ENDPOINT FOR GEMINI FUNCTION CALLING
 @app.route('/api/gemini_functions', methods=['POST'])
@@ -134,385 +75,175 @@ def gemini_functions_proxy():
     """
     This endpoint handles requests for Gemini function calling, replacing the Replicate FlockWeb3 model
     It converts OpenAI-style tools to Gemini's function declarations format and handles responses
+    Pass ?stream=1 or "stream": true to receive function calls and text as server-sent events
     """
-    # --- Begin Enhanced Debug Logging ---
-    print("--- /api/gemini_functions (proxied) ---")
-    print(f"Request Method: {request.method}")
-    print(f"Request Path: {request.path}")
-    print("Incoming Headers:")
-    headers_dict = dict(request.headers)
-    for key, value in headers_dict.items():
-        print(f"  {key}: {value}")
-    
-    raw_body = request.get_data(as_text=True)
-    print(f"Raw Request Body (first 500 chars): {raw_body[:500]}")
-
-    header_api_key = request.headers.get('X-Gemini-API-Key')
-    # Support both GEMINI_API_KEY and GOOGLE_API_KEY for Render/Google compatibility
-    env_api_key = os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY')
-    
-    print(f"Extracted Header X-Gemini-API-Key: '{header_api_key}' (Type: {type(header_api_key)})")
-    
-    env_key_display = env_api_key
-    if env_api_key and len(env_api_key) > 9:
-        env_key_display = f"{env_api_key[:5]}...{env_api_key[-4:]}"
-    print(f"Extracted Environment GEMINI_API_KEY: '{env_key_display}' (Type: {type(env_api_key)})")
-
-    gemini_api_key = header_api_key or env_api_key
-    
-    resolved_key_display = gemini_api_key
-    if gemini_api_key and len(gemini_api_key) > 9:
-        resolved_key_display = f"{gemini_api_key[:5]}...{gemini_api_key[-4:]}"
-    print(f"Resolved gemini_api_key for use: '{resolved_key_display}' (Type: {type(gemini_api_key)})")
-    print(f"Condition 'not gemini_api_key' (i.e., key is falsy): {not gemini_api_key}")
-    # --- End Enhanced Debug Logging ---
-
-    if not gemini_api_key:
-        print("Critical Failure: No Gemini API key resolved. gemini_api_key is falsy. Sending 401.")
-        return jsonify({"error": "Gemini API key is required to use the function calling feature"}), 401
-    
-    try:
-        # Configure the Gemini SDK with the API key
-        genai.configure(api_key=gemini_api_key)
-    except Exception as e:
-        print(f"Failed to configure Gemini SDK: {str(e)}")
-        return jsonify({"error": f"Failed to configure Gemini SDK: {str(e)}"}), 500
-    
-    # Get the query and tools from the request
-    query = request.json.get('query')
-    tools_json_string = request.json.get('tools')  # Expected as JSON string from createDefaultWeb3Tools
+    request_data = request.get_json(silent=True) or {}
+    error, gemini_request = prepare_gemini_request(request_data, request.headers)
+    if error:
+        return json_reply(*error)
+    
+    if wants_stream(request_data, request.args):
+        error, provider = pick_provider("gemini")
+        if error:
+            return json_reply(*error)
+        return sse_response(gemini_events(gemini_request, provider))
+    
+    start = time.perf_counter()
+    reply = answer_gemini_request(gemini_request)
+    return json_reply(*gemini_reply(gemini_request, reply, time.perf_counter() - start))
 
-    # main branch default model for function calling
-    model_name = request.json.get('model', 'gemini-3-flash-preview')
-    
-    temperature = request.json.get('temperature', 0.7)
-    top_p = request.json.get('top_p')  # Gemini supports top_p
-    max_output_tokens = request.json.get('max_output_tokens', request.json.get('max_new_tokens', 2048))
-    
-    if not query:
-        return jsonify({"error": "Parameter 'query' is required"}), 400
-    if not tools_json_string:
-        return jsonify({"error": "Parameter 'tools' (JSON string) is required"}), 400
-    
-    # Enhanced debugging for function calling issues
-    print(f"Gemini API request details:")
-    print(f"- Model: {model_name}")
-    print(f"- Query length: {len(query)} chars")
-    print(f"- API key present: {bool(gemini_api_key)}")
-    
-    # Convert OpenAI-style tools (from createDefaultWeb3Tools) to Gemini format
-    gemini_tool_config = None
-    try:
-        parsed_tools_list = json.loads(tools_json_string)  # This is a list of OpenAI-like tool objects
-        function_declarations = []
-        
-        for tool_def in parsed_tools_list:
-            if tool_def.get("type") == "function" and "function" in tool_def:
-                func_details = tool_def["function"]
-                # Create a FunctionDeclaration for each tool
-                declaration = genai.types.FunctionDeclaration(
-                    name=func_details["name"],
-                    description=func_details.get("description", ""),
-                    parameters=func_details.get("parameters")
-                )
-                function_declarations.append(declaration)
-                print(f"Added function declaration: {func_details['name']}")
-        
-        # If no function declarations, proceed without tools (text-only)
-        if not function_declarations:
-            gemini_tool_config = []
-        else:
-            # Gemini expects a Tool object containing the list of function declarations
-            gemini_tool_config = [genai.types.Tool(function_declarations=function_declarations)]
-        print(f"Created tool config with {len(function_declarations)} function declarations")
-    
-    except json.JSONDecodeError:
-        print(f"Invalid JSON string for 'tools': {tools_json_string[:100]}...")
-        return jsonify({"error": "Invalid JSON string for 'tools'"}), 400
-    except Exception as e:
-        print(f"Error processing tools for Gemini: {str(e)}")
-        return jsonify({"error": f"Error processing tools for Gemini: {str(e)}"}), 500
-    
-    # Set up generation config parameters
-    generation_config_params = {
-        "temperature": float(temperature),
-        "max_output_tokens": int(max_output_tokens)
-    }
-    if top_p is not None:
-        generation_config_params["top_p"] = float(top_p)
-    
-    generation_config = genai.types.GenerationConfig(**generation_config_params)
-    
-    print(f"Requesting Gemini ({model_name}) for function calling. Query: {query[:100]}...")
-    
-    # Implement retry mechanism for stability
-    max_retries = 2
-    retry_count = 0
-    
-    while retry_count <= max_retries:
-        try:
-            # Initialize the Gemini model with tools
-            model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config=generation_config,
-                tools=gemini_tool_config,
-                # Use a dictionary directly for the tool_config
-                tool_config={'function_calling_config': {'mode': 'ANY'}}
-            )
-            
-            # Using a chat session for function calling
-            chat = model.start_chat()
-            response = chat.send_message(query)
-            
-            function_calls_for_frontend = []
-            text_content = None
-            
-            # Process Gemini's response parts with better error handling
-            if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-                print(f"Received {len(response.candidates[0].content.parts)} response parts from Gemini")
-                for part in response.candidates[0].content.parts:
-                    print(f"Processing part type: {type(part)}")
-                    
-                    # Handle function calls
-                    if hasattr(part, 'function_call') and part.function_call:
-                        fc = part.function_call
-                        function_call_data = {
-                            "name": fc.name,
-                            "arguments": dict(fc.args) if hasattr(fc, 'args') else {}
-                        }
-                        function_calls_for_frontend.append(function_call_data)
-                        print(f"Gemini requested function: {fc.name} with args: {function_call_data['arguments']}")
-                    
-                    # Handle text content
-                    if hasattr(part, 'text') and part.text:
-                        text_content = part.text
-                        print(f"Gemini returned text: {text_content[:100]}...")
-            else:
-                print("No valid response content found in Gemini response")
-                print(f"Response structure: {str(response)[:500]}")
-            
-            # Handle cases where the response might be blocked or empty
-            if not function_calls_for_frontend and not text_content:
-                if hasattr(response, 'prompt_feedback') and response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason'):
-                    reason = response.prompt_feedback.block_reason.name if hasattr(response.prompt_feedback.block_reason, 'name') else str(response.prompt_feedback.block_reason)
-                    print(f"Gemini request blocked: {reason}")
-                    return jsonify({
-                        "error": f"Gemini request blocked due to: {reason}",
-                        "details": str(response.prompt_feedback)
-                    }), 400
-                
-                # If we didn't get a response and haven't used all retries, try again
-                if retry_count < max_retries:
-                    print(f"Attempt {retry_count + 1}: Gemini returned empty response. Retrying...")
-                    retry_count += 1
-                    time.sleep(2 ** retry_count)  # Exponential backoff
-                    continue
-                
-                # If we've exhausted retries, return a null output with a more helpful message
-                print("Maximum retries exceeded with empty responses")
-                return jsonify({
-                    "id": f"gemini-func-{int(time.time())}", 
-                    "output": "I couldn't process your request properly. Please try rephrasing your question.",
-                    "status": "partial_failure"
-                }), 200
-            
-            # Prioritize function calls in the 'output' field for the frontend
-            # as this endpoint's primary purpose is function calling
-            output_data = None
-            if function_calls_for_frontend:
-                output_data = function_calls_for_frontend
-                print(f"Returning {len(function_calls_for_frontend)} function calls to frontend")
-            elif text_content:  # Fallback to text if no function calls
-                output_data = text_content
-                print("Returning text content to frontend (no function calls)")
-            
-            response_data = {
-                "id": f"gemini-func-{int(time.time())}",
-                "status": "succeeded",
-                "output": output_data,  # This will be array of func_calls or text string
-                "text_if_any": text_content  # Explicitly provide text if it co-existed with function calls
-            }
-            
-            print(f"Gemini response processed successfully")
-            return jsonify(response_data)
-            
-        except Exception as e:
-            error_message = f"Error during Gemini API call: {str(e)}"
-            print(error_message)
-            import traceback
-            print(traceback.format_exc())  # Detailed error for backend logs
-            
-            retry_count += 1
-            if retry_count <= max_retries:
-                print(f"Retrying after error (attempt {retry_count}/{max_retries})")
-                time.sleep(2 ** retry_count)  # Exponential backoff
-                continue
-            
-            # Return a more user-friendly error for the frontend
-            # Structured, friendly error response for frontend
-            return jsonify({
-                "status": "error",
-                "error": "AI backend error. Please try again shortly.",
-                "details": str(e)[:500]
-            }), 502
-    
-    return jsonify({"error": "Maximum retries exceeded"}), 500
+@app.route('/api/gemini_functions/batch', methods=['POST'])
+def gemini_functions_batch():
+    """
+    Run many function calling queries that share one tools payload and model config.
+    Body: {"queries": [...], "tools": ..., plus the single endpoint's model options}.
+    Tools are compiled once, queries run concurrently on a bounded pool, and results
+    come back in order, each with the single endpoint's body, its index and status_code.
+    """
+    error, gemini_requests = prepare_gemini_batch(request.get_json(silent=True) or {}, request.headers)
+    if error:
+        return json_reply(*error)
+    return json_reply(answer_gemini_batch(gemini_requests))
 
 @app.route('/api/gemini_health', methods=['GET'])
 def gemini_health_check():
     """
     Health check endpoint to verify Gemini API key configuration.
+    Upstream status is the background prober's cached result, so this never waits on Gemini.
     """
-    print("Received request for /api/gemini_health")
-    gemini_api_key = request.headers.get('X-Gemini-API-Key') or os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY')
-    
-    if not gemini_api_key:
-        print("Health check: No Gemini API key found in headers or environment.")
-        return jsonify({"status": "error", "message": "Gemini API key not found in X-Gemini-API-Key header or GEMINI_API_KEY environment variable."}), 401
-    
-    print(f"Health check: Attempting to configure Gemini with key: {gemini_api_key[:5]}...{gemini_api_key[-4:] if len(gemini_api_key) > 9 else ''}")
-    try:
-        genai.configure(api_key=gemini_api_key)
-        print("Health check: Gemini SDK configured successfully.")
-        return jsonify({"status": "success", "message": "Gemini API key configured successfully."})
-    except Exception as e:
-        error_message = f"Failed to configure Gemini SDK: {str(e)}"
-        print(f"Health check: {error_message}")
-        return jsonify({"status": "error", "message": "Failed to configure Gemini API key.", "details": str(e)}), 500
+    return json_reply(*gemini_health_reply(request.headers))
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    """Handle local LLM chat requests using Ollama"""
+    """
+    Handle local LLM chat requests using Ollama
+    Pass ?stream=1 or "stream": true to receive the reply incrementally as server-sent events
+    Pass "session": true to start a server-side session, then "session_id" with only the new
+    messages on later turns; the server keeps the history, trimmed to a token budget
+    """
     try:
-        request_data = request.json
-        
-        if not request_data:
-            return jsonify({"error": "Request body is required"}), 400
-        
-        # Extract messages from the request
-        messages = request_data.get('messages', [])
-        
-        if not messages:
-            return jsonify({"error": "No messages provided"}), 400
-        
-        # Format messages for Ollama
-        formatted_messages = []
-        for msg in messages:
-            role = msg.get('role', 'user')
-            content = msg.get('content', '')
-            formatted_messages.append({"role": role, "content": content})
-        
-        # Prepare the request for Ollama
-        ollama_request = {
-            "model": request_data.get('model', 'llama3'),
-            "messages": formatted_messages,
-            "stream": False,
-            "options": {
-                "temperature": request_data.get('temperature', 0.7)
-            }
-        }
-        
-        print(f"Sending chat request to Ollama: {json.dumps(ollama_request)[:100]}...")
-        
-        # Send request to Ollama
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/chat",
-            headers={"Content-Type": "application/json"},
-            json=ollama_request
-        )
-        
-        if not response.ok:
-            error_message = f"Error from Ollama API: {response.status_code} {response.text}"
-            print(error_message)
-            return jsonify({"error": error_message}), response.status_code
-        
-        # Parse Ollama response
-        ollama_response = response.json()
-        
-        # Format response to match what the frontend expects
-        assistant_message = ollama_response.get("message", {})
-        formatted_response = {
-            "message": {
-                "role": "assistant",
-                "content": assistant_message.get("content", "No response from Ollama")
-            }
-        }
-        
-        return jsonify(formatted_response)
-    
+        error, turn = prepare_chat_request(request.get_json(silent=True), request.args)
+        if error:
+            return json_reply(*error)
+        if turn.ollama_request["stream"]:
+            return relay_ollama(turn.stream())
+        return json_reply(*turn.answer())
     except Exception as e:
-        error_message = f"Error in chat endpoint: {str(e)}"
-        print(error_message)
-        return jsonify({"error": error_message}), 500
+        return json_reply(*chat_failed(e))
+
+@app.route('/api/chat/sessions/<session_id>', methods=['GET', 'DELETE'])
+def chat_session(session_id):
+    """Report a chat session's size (messages, estimated tokens, bytes), or end it with DELETE"""
+    return json_reply(*chat_session_reply(request.method, session_id))
 
 @app.route('/api/ollama', methods=['POST'])
 def ollama_proxy():
     """
     This endpoint forwards requests to Ollama as a fallback
     when Replicate API is not available or for testing
+    Pass ?stream=1 or "stream": true to receive the output incrementally as server-sent events
     """
-    # Get the request data
-    request_data = request.json
-    
-    if not request_data:
-        return jsonify({"error": "Request body is required"}), 400
-    
-    # Extract the query and other parameters from the request
-    input_data = request_data.get('input', {})
-    query = input_data.get('query', '')
-    temperature = input_data.get('temperature', 0.7)
-    
-    print(f"Forwarding request to Ollama: {query[:100]}...")
-    
-    # Prepare the request for Ollama
-    ollama_request = {
-        "model": "llama3",  # You can change this to your preferred model
-        "prompt": query,
-        "stream": False,
-        "options": {
-            "temperature": temperature
-        }
-    }
-    
+    error, ollama_request = prepare_ollama_request(request.get_json(silent=True), request.args)
+    if error:
+        return json_reply(*error)
     try:
-        # Send request to Ollama
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/generate",
-            headers={"Content-Type": "application/json"},
-            json=ollama_request
-        )
-        
-        if not response.ok:
-            error_message = f"Error from Ollama API: {response.status_code} {response.text}"
-            print(error_message)
-            return jsonify({"error": error_message}), response.status_code
-        
-        # Parse Ollama response
-        ollama_response = response.json()
-        
-        # Format response to match what the frontend expects from Replicate
-        formatted_response = {
-            "id": "ollama-response",
-            "status": "succeeded",
-            "output": ollama_response.get("response", "No response from Ollama")
-        }
-        
-        return jsonify(formatted_response)
-    
+        if ollama_request["stream"]:
+            return relay_ollama(OllamaStream("/api/generate", ollama_request, format_ollama_generate_chunk))
+        return json_reply(*generate_coalesced(ollama_request, request.headers))
     except Exception as e:
-        error_message = f"Error communicating with Ollama: {str(e)}"
-        print(error_message)
-        return jsonify({"error": error_message}), 500
+        return json_reply(*ollama_failed(e))
+
+def metrics_route():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = begin_request_metrics(metrics_route(), request.content_length)
+
+@app.before_request
+def start_provider_prober():
+    provider_health.ensure_running()
+
+@app.before_request
+def admit_request():
+    """Per-key rate limit, then a concurrency slot for the route, held until the response is closed"""
+    route = metrics_route()
+    if not admitted_route(route, request.method):
+        return None
+    rejected = rate_limit(route, request.headers, request.remote_addr, request.get_json(silent=True))
+    if rejected:
+        return json_reply(*rejected)
+    limiter = route_limiters.get(route)
+    if limiter is not None:
+        reason = limiter.acquire()
+        if reason:
+            return json_reply(*shed_body(route, reason))
+        g.route_limiter = limiter
+    return None
+
+@app.after_request
+def finish_request_metrics(response):
+    route, start, status = metrics_route(), g.metrics_start, response.status_code
+    # Streamed responses have no length up front
+    response_size = None if response.is_streamed else response.content_length
+    # Recorded once the body has been sent, so streamed requests are timed in full
+    response.call_on_close(lambda: end_request_metrics(route, start, status, response_size))
+    limiter = g.pop('route_limiter', None)
+    if limiter is not None:
+        # Streams keep their slot until the last chunk has been sent
+        response.call_on_close(limiter.release)
+    return response
+
+@app.teardown_request
+def release_route_slot(exc):
+    # Only set here when after_request never ran (an unhandled error), so nothing else frees the slot
+    limiter = g.pop('route_limiter', None)
+    if limiter is not None:
+        limiter.release()
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint: per-route and per-upstream latency, retries and in-flight requests"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/health', methods=['GET'])
+def provider_health_check():
+    """Cached health, latency and circuit state of every provider; 503 when none can serve"""
+    return json_reply(*provider_router.health_body())
+
+@app.route('/api/upstream_stats', methods=['GET'])
+def upstream_stats():
+    """Report connection pool usage and request counters for each upstream host"""
+    return json_reply(upstream_stats_body(upstream, route_limiters))
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """Report hit/miss counters for the in-process caches"""
+    return json_reply(cache_stats_body(coalescer))
+
+
+def create_async_app():
+    """
+    Build the aiohttp application used when SERVER_MODE=async (see _proxy/async_app.py).
+    Imported here on demand, so Flask mode never loads aiohttp.
+    """
+    from _proxy.async_app import create_async_app
+    return create_async_app()
 
 if __name__ == '__main__':
     # Use PORT environment variable if available (e.g., on Vercel)
     port = int(os.environ.get('PORT', 3000))
     
-    # Check for OLLAMA_URL environment variable to override default
-    ollama_env_url = os.environ.get('OLLAMA_URL')
-    if ollama_env_url:
-        OLLAMA_BASE_URL = ollama_env_url
-    
-    print(f"Using Ollama endpoint: {OLLAMA_BASE_URL}")
-    print(f"Server running on http://0.0.0.0:{port}")
-    app.run(host='0.0.0.0', port=port, debug=True)
+    # OLLAMA_BACKENDS, or OLLAMA_URL for a single backend, overrides the default endpoint
+    logger.info("Using Ollama backends: %s", ", ".join(ollama_pool.urls()))
+    logger.info("Server running on http://0.0.0.0:%d (%s mode)", port, SERVER_MODE)
+    if SERVER_MODE == 'async':
+        from aiohttp import web
+        web.run_app(create_async_app(), host='0.0.0.0', port=port, print=None)
+    else:
+        # Development server; production runs under gunicorn (gunicorn -c api/gunicorn.conf.py).
+        # FLASK_DEBUG=1 turns on the reloader and debugger, which also import the app twice.
+        debug = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes')
+        if not debug:
+            logger.warning("Using the Flask development server; run gunicorn -c api/gunicorn.conf.py in production")
+        app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
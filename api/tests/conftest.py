@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# Configure the proxy before it is imported: no background prober, quiet logs, no server keys
+os.environ['HEALTH_PROBE_INTERVAL'] = '0'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.pop('GEMINI_API_KEY', None)
+os.environ.pop('GOOGLE_API_KEY', None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fresh_router(monkeypatch):
+    """The provider router every module shares, with new circuit breakers, no probes and no fallbacks"""
+    from _proxy.providers import ProviderHealth, ProviderRouter, provider_router
+    router = ProviderRouter(ProviderHealth(0, 1, 5), {}, failure_threshold=5, reset_timeout=30)
+    for name in ("health", "fallbacks", "breakers"):
+        monkeypatch.setattr(provider_router, name, getattr(router, name))
+    return provider_router
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limiter(monkeypatch):
+    """Every test's requests come from 127.0.0.1, so each gets its own token buckets"""
+    from _proxy import admission
+    limiter = admission.rate_limiter
+    monkeypatch.setattr(admission, "rate_limiter", admission.RateLimiter(limiter.rate, limiter.burst, limiter.max_keys))
@@ -0,0 +1,161 @@
+import threading
+import time
+
+import pytest
+
+import replicate_py
+from _proxy import admission
+from _proxy.admission import ConcurrencyLimiter, RateLimiter, admission_cost, admission_key, route_admission_limits
+
+
+def test_rate_limit_disabled():
+    limiter = RateLimiter(0, 1, 10)
+    assert all(limiter.acquire("key") == 0 for _ in range(100))
+
+
+def test_burst_then_limited():
+    limiter = RateLimiter(rate=10, burst=3, max_keys=10)
+    assert [limiter.acquire("key") for _ in range(3)] == [0, 0, 0]
+    wait = limiter.acquire("key")
+    assert 0 < wait <= 0.1
+    assert limiter.stats()["limited"] == 1
+
+
+def test_tokens_refill_over_time():
+    limiter = RateLimiter(rate=50, burst=1, max_keys=10)
+    assert limiter.acquire("key") == 0
+    assert limiter.acquire("key") > 0
+    time.sleep(0.05)
+    assert limiter.acquire("key") == 0
+
+
+def test_keys_have_separate_buckets():
+    limiter = RateLimiter(rate=1, burst=1, max_keys=10)
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") > 0
+    assert limiter.acquire("b") == 0
+
+
+def test_batch_over_the_burst_pays_its_full_cost():
+    limiter = RateLimiter(rate=5, burst=20, max_keys=10)
+    # Let through with a full bucket, leaving it 30 tokens in debt
+    assert limiter.acquire("key", cost=50) == 0
+    assert limiter.acquire("key") == pytest.approx(31 / 5, abs=0.05)
+    # A second large batch needs the debt paid off and a full bucket again
+    assert limiter.acquire("key", cost=50) == pytest.approx(50 / 5, abs=0.05)
+
+
+def test_batch_within_the_burst_needs_all_of_its_tokens():
+    limiter = RateLimiter(rate=5, burst=20, max_keys=10)
+    assert limiter.acquire("key", cost=15) == 0
+    assert limiter.acquire("key", cost=10) == pytest.approx(5 / 5, abs=0.05)
+
+
+def test_least_recently_seen_keys_are_dropped():
+    limiter = RateLimiter(rate=1, burst=1, max_keys=2)
+    limiter.acquire("a")
+    limiter.acquire("b")
+    limiter.acquire("c")
+    assert limiter.stats()["keys"] == 2
+    # "a" was dropped, so it starts over with a full bucket
+    assert limiter.acquire("a") == 0
+
+
+def test_admission_cost():
+    assert admission_cost('/api/gemini_functions/batch', {"queries": ["a", "b", "c"]}) == 3
+    assert admission_cost('/api/gemini_functions/batch', {"queries": []}) == 1
+    assert admission_cost('/api/gemini_functions/batch', None) == 1
+    assert admission_cost('/api/gemini_functions', {"queries": ["a", "b"]}) == 1
+
+
+def test_admission_key_uses_the_route_credential():
+    headers = {"X-Gemini-API-Key": "g-key", "X-Replicate-API-Token": "r-token"}
+    gemini = admission_key('/api/gemini_functions', headers, "10.0.0.1")
+    assert gemini == admission_key('/api/gemini_functions/batch', {"X-Gemini-API-Key": "g-key"}, "10.0.0.2")
+    assert admission_key('/api/replicate', headers, "10.0.0.1") != gemini
+    # A header the route never uses does not buy a fresh bucket
+    assert admission_key('/api/gemini_functions', {"X-Replicate-API-Token": "junk"}, "10.0.0.1") == \
+        admission_key('/api/gemini_functions', {"X-Replicate-API-Token": "other"}, "10.0.0.1")
+
+
+def test_admission_key_falls_back_to_the_client_address():
+    assert admission_key('/api/gemini_functions', {}, "10.0.0.1") == "addr:10.0.0.1"
+    assert admission_key('/api/chat', {"X-Gemini-API-Key": "g-key"}, "10.0.0.1") == "addr:10.0.0.1"
+    # X-Forwarded-For is only believed behind a trusted proxy
+    assert admission_key('/api/chat', {"X-Forwarded-For": "1.2.3.4"}, "10.0.0.1") == "addr:10.0.0.1"
+
+
+def test_admission_key_trusts_configured_proxy_hops(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXY_HOPS", 1)
+    headers = {"X-Forwarded-For": "6.6.6.6, 1.2.3.4"}
+    # The client can prepend anything; only the entry added by our proxy counts
+    assert admission_key('/api/chat', headers, "10.0.0.1") == "addr:1.2.3.4"
+    assert admission_key('/api/chat', {}, "10.0.0.1") == "addr:10.0.0.1"
+
+
+def test_requests_without_a_key_are_rate_limited(monkeypatch):
+    monkeypatch.setattr(admission, "rate_limiter", RateLimiter(rate=1, burst=2, max_keys=10))
+    monkeypatch.setattr(admission, "route_limiters", {})
+    client = replicate_py.app.test_client()
+    statuses = []
+    for _ in range(3):
+        response = client.post('/api/gemini_functions', json={})
+        statuses.append(response.status_code)
+        response.close()
+    # No server key here, so admitted requests get a 401; the third never reaches the route
+    assert statuses == [401, 401, 429]
+
+
+def test_concurrency_limit_sheds_when_the_queue_is_full():
+    limiter = ConcurrencyLimiter('/api/chat', limit=1, queue_size=0, queue_timeout=1)
+    assert limiter.acquire() is None
+    assert limiter.acquire() == "queue_full"
+    limiter.release()
+    assert limiter.acquire() is None
+    assert limiter.stats() == {"limit": 1, "active": 1, "waiting": 0, "shed": 1}
+
+
+def test_concurrency_limit_times_out_queued_requests():
+    limiter = ConcurrencyLimiter('/api/chat', limit=1, queue_size=1, queue_timeout=0.05)
+    assert limiter.acquire() is None
+    start = time.monotonic()
+    assert limiter.acquire() == "queue_timeout"
+    assert time.monotonic() - start >= 0.05
+    assert limiter.stats()["waiting"] == 0
+
+
+def test_release_hands_the_slot_to_a_queued_request():
+    limiter = ConcurrencyLimiter('/api/chat', limit=1, queue_size=1, queue_timeout=5)
+    assert limiter.acquire() is None
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    waiter.start()
+    while limiter.stats()["waiting"] == 0:
+        time.sleep(0.001)
+    limiter.release()
+    waiter.join(timeout=5)
+    assert results == [None]
+    assert limiter.stats()["active"] == 1
+
+
+def test_route_limits_leave_threads_for_other_routes():
+    limits = route_admission_limits(threads=32)
+    assert limits['/api/chat'] == (8, 8)
+    assert all(limit + queue_size <= 16 for limit, queue_size in limits.values())
+    # Waiting costs no thread in async mode
+    assert route_admission_limits()['/api/chat'] == (32, 64)
+
+
+def test_route_limits_over_the_thread_share_are_capped(monkeypatch):
+    monkeypatch.setattr(admission, "ROUTE_CONCURRENCY", "32")
+    monkeypatch.setattr(admission, "ROUTE_QUEUE_SIZE", "64")
+    monkeypatch.setattr(admission, "ROUTE_CONCURRENCY_LIMITS", "/api/chat=4")
+    limits = route_admission_limits(threads=32)
+    assert limits['/api/gemini_functions'] == (16, 0)
+    assert limits['/api/chat'] == (4, 12)
+    assert route_admission_limits()['/api/gemini_functions'] == (32, 64)
+
+
+def test_route_limits_disabled(monkeypatch):
+    monkeypatch.setattr(admission, "ROUTE_CONCURRENCY", "0")
+    assert route_admission_limits(threads=32) == {}
@@ -0,0 +1,141 @@
+import asyncio
+import json
+
+import pytest
+
+from _proxy import admission, chat_sessions, ollama_backends
+from _proxy.admission import RateLimiter
+from _proxy.chat_sessions import ChatSessionStore
+from _proxy.metrics import METRICS_CONTENT_TYPE
+from _proxy.ollama_backends import OllamaBackendPool
+
+pytest.importorskip("aiohttp")
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from _proxy.async_app import create_async_app
+
+
+def chat_chunks(*words):
+    return [{"message": {"role": "assistant", "content": word}, "done": False} for word in words] + [
+        {"message": {"role": "assistant", "content": ""}, "done": True}]
+
+
+def events(body):
+    parsed = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        parsed.append((lines.get("event", "message"), json.loads(lines["data"])))
+    return parsed
+
+
+class FakeOllama:
+    """An Ollama server on the test's event loop: replies are popped in order, streamed as NDJSON when asked"""
+
+    def __init__(self):
+        self.replies = []
+        self.requests = []
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests.append((request.path, body))
+        reply = self.replies.pop(0)
+        if not body.get("stream"):
+            return web.json_response(reply)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for chunk in reply:
+            await response.write(json.dumps(chunk).encode() + b"\n")
+        await response.write_eof()
+        return response
+
+    def app(self):
+        ollama_app = web.Application()
+        ollama_app.router.add_post('/api/chat', self.handle)
+        ollama_app.router.add_post('/api/generate', self.handle)
+        return ollama_app
+
+
+@pytest.fixture
+def serve(fresh_router, monkeypatch):
+    """Run test(client, ollama) against the async app, with Ollama served by a FakeOllama"""
+    monkeypatch.setattr(chat_sessions, "chat_sessions", ChatSessionStore(10, 3600, 1000))
+
+    def run(test):
+        async def main():
+            ollama = FakeOllama()
+            async with TestServer(ollama.app()) as ollama_server:
+                monkeypatch.setattr(ollama_backends, "ollama_pool", OllamaBackendPool([str(ollama_server.make_url('')).rstrip('/')]))
+                async with TestClient(TestServer(create_async_app())) as client:
+                    await test(client, ollama)
+
+        asyncio.run(main())
+
+    return run
+
+
+def test_chat_session_turns_and_endpoints(serve):
+    async def test(client, ollama):
+        ollama.replies.append({"message": {"role": "assistant", "content": "Hi!"}, "done": True})
+        response = await client.post('/api/chat', json={"session": True, "messages": [{"role": "user", "content": "hi"}]})
+        assert response.status == 200
+        assert response.headers["Access-Control-Allow-Origin"] == "*"
+        body = await response.json()
+        assert body["message"]["content"] == "Hi!"
+        session_id = body["session_id"]
+        # The second turn is streamed, and the reply is still added to the session
+        ollama.replies.append(chat_chunks("Hel", "lo"))
+        response = await client.post('/api/chat?stream=1', json={"session_id": session_id, "messages": [{"content": "again"}]})
+        assert response.headers["Content-Type"].startswith("text/event-stream")
+        chunks = [data for _, data in events(await response.text())]
+        assert [chunk["message"]["content"] for chunk in chunks] == ["Hel", "lo", ""]
+        assert [m["content"] for m in ollama.requests[-1][1]["messages"]] == ["hi", "Hi!", "again"]
+        response = await client.get(f'/api/chat/sessions/{session_id}')
+        assert (await response.json())["messages"] == 4
+        response = await client.delete(f'/api/chat/sessions/{session_id}')
+        assert response.status == 200
+        response = await client.get(f'/api/chat/sessions/{session_id}')
+        assert response.status == 404
+
+    serve(test)
+
+
+def test_ollama_streams_and_answers(serve):
+    async def test(client, ollama):
+        ollama.replies.append([{"response": "Hel", "done": False}, {"response": "lo", "done": False}, {"response": "", "done": True}])
+        response = await client.post('/api/ollama', json={"input": {"query": "hi"}, "stream": True})
+        assert [data["output"] for _, data in events(await response.text())] == ["Hel", "lo", ""]
+        ollama.replies.append({"response": "Hello", "done": True})
+        response = await client.post('/api/ollama', json={"input": {"query": "hi"}})
+        assert await response.json() == {"id": "ollama-response", "status": "succeeded", "output": "Hello"}
+        assert [path for path, _ in ollama.requests] == ["/api/generate", "/api/generate"]
+
+    serve(test)
+
+
+def test_metrics_count_requests_by_route(serve):
+    async def test(client, ollama):
+        await client.post('/api/chat', json={"messages": "not a list"})
+        response = await client.get('/metrics')
+        assert response.headers["Content-Type"] == METRICS_CONTENT_TYPE
+        assert 'proxy_requests_total{route="/api/chat",status="400"}' in await response.text()
+
+    serve(test)
+
+
+def test_rate_limited_and_preflight_requests(serve, monkeypatch):
+    monkeypatch.setattr(admission, "rate_limiter", RateLimiter(rate=1, burst=1, max_keys=10))
+
+    async def test(client, ollama):
+        statuses = []
+        for _ in range(2):
+            response = await client.post('/api/gemini_functions', json={})
+            statuses.append(response.status)
+        # No server key here, so the admitted request gets a 401
+        assert statuses == [401, 429]
+        assert response.headers["Access-Control-Allow-Origin"] == "*"
+        response = await client.options('/api/chat')
+        assert response.status == 200
+        assert response.headers["Access-Control-Allow-Methods"] == "GET, POST, OPTIONS"
+
+    serve(test)
@@ -0,0 +1,211 @@
+import os
+import time
+
+import pytest
+
+import replicate_py
+from _proxy import chat_sessions
+from _proxy.chat_sessions import ChatSessionStore, estimate_tokens, trim_to_token_budget
+from _proxy.http_clients import upstream
+
+
+def message(role, words):
+    return {"role": role, "content": "word " * words}
+
+
+def test_everything_fits():
+    messages = [message("system", 1), message("user", 1), message("assistant", 1)]
+    assert trim_to_token_budget(messages, 1000) == messages
+
+
+def test_keeps_system_messages_and_the_most_recent_turns():
+    system = message("system", 4)
+    turns = [message("user" if i % 2 == 0 else "assistant", 10) for i in range(10)]
+    budget = estimate_tokens(system) + 3 * estimate_tokens(turns[0])
+    assert trim_to_token_budget([system] + turns, budget) == [system] + turns[-3:]
+
+
+def test_newest_message_is_kept_even_over_budget():
+    old, new = message("user", 5), message("user", 1000)
+    assert trim_to_token_budget([old, new], 10) == [new]
+
+
+def test_only_leading_system_messages_are_pinned():
+    messages = [message("system", 1), message("user", 100), message("system", 100), message("user", 1)]
+    trimmed = trim_to_token_budget(messages, estimate_tokens(messages[0]) + estimate_tokens(messages[3]))
+    assert trimmed == [messages[0], messages[3]]
+
+
+def test_empty_and_system_only_histories():
+    assert trim_to_token_budget([], 10) == []
+    system = [message("system", 1000)]
+    assert trim_to_token_budget(system, 10) == system
+
+
+def test_expiry_keeps_files_another_worker_still_uses(tmp_path):
+    first = ChatSessionStore(10, 0.3, 1000, str(tmp_path))
+    second = ChatSessionStore(10, 0.3, 1000, str(tmp_path))
+    session_id = first.new_id()
+    first.append(session_id, [message("user", 1)], create=True)
+    time.sleep(0.2)
+    second.append(session_id, [message("user", 3)])
+    time.sleep(0.15)
+    # Idle past the TTL in the first worker, but the second one wrote the file since
+    assert first.stats()["expirations"] == 1
+    assert os.path.exists(tmp_path / f"{session_id}.json")
+    assert first.info(session_id)["messages"] == 2
+
+
+class FakeOllamaReply:
+    ok = True
+    status_code = 200
+
+    def json(self):
+        return {"message": {"role": "assistant", "content": "Hi!"}, "done": True}
+
+
+@pytest.fixture
+def chat_client(monkeypatch, fresh_router):
+    """A Flask test client with an empty session store, a fresh breaker and a canned Ollama reply"""
+    store = ChatSessionStore(10, 3600, 1000)
+    monkeypatch.setattr(chat_sessions, "chat_sessions", store)
+    monkeypatch.setattr(upstream, "post", lambda url, **kwargs: FakeOllamaReply())
+    return replicate_py.app.test_client(), store
+
+
+def post_chat(client, body):
+    response = client.post('/api/chat', json=body)
+    result = response.status_code, response.get_json()
+    response.close()
+    return result
+
+
+def test_new_session_is_stored_with_its_first_turn(chat_client):
+    client, store = chat_client
+    status, body = post_chat(client, {"session": True, "messages": [{"role": "user", "content": None}]})
+    assert status == 200
+    # A null content is sent as an empty message rather than failing the request
+    assert store.info(body["session_id"])["messages"] == 2
+    status, body = post_chat(client, {"session_id": body["session_id"], "messages": [{"content": "again"}]})
+    assert status == 200
+    assert store.info(body["session_id"])["messages"] == 4
+
+
+def test_rejected_requests_leave_no_session_behind(chat_client, fresh_router):
+    client, store = chat_client
+    assert post_chat(client, {"session": True, "messages": ["not an object"]})[0] == 400
+    assert post_chat(client, {"session": True, "messages": [{"content": 42}]})[0] == 400
+    for _ in range(5):
+        fresh_router.record("ollama", False)
+    # The circuit is open, so Ollama is never asked and no session is started
+    assert post_chat(client, {"session": True, "messages": [{"content": "hi"}]})[0] == 503
+    assert store.stats()["sessions"] == 0
+
+
+def test_idle_sessions_expire():
+    store = ChatSessionStore(10, 0.1, 1000)
+    session_id = store.new_id()
+    store.append(session_id, [message("user", 1)], create=True)
+    time.sleep(0.15)
+    assert store.context(session_id, [message("user", 1)]) is None
+    assert store.stats()["expirations"] == 1
+
+
+def test_least_recently_used_session_is_evicted():
+    store = ChatSessionStore(2, 3600, 1000)
+    first, second, third = store.new_id(), store.new_id(), store.new_id()
+    store.append(first, [message("user", 1)], create=True)
+    store.append(second, [message("user", 1)], create=True)
+    # Using the first session makes the second one the least recently used
+    assert store.context(first, []) == [message("user", 1)]
+    store.append(third, [message("user", 1)], create=True)
+    assert store.info(second) is None
+    assert store.info(first)["messages"] == 1
+    assert store.stats()["evictions"] == 1
+
+
+def test_stored_history_is_trimmed_to_the_budget():
+    store = ChatSessionStore(10, 3600, estimate_tokens(message("user", 10)) * 2)
+    session_id = store.new_id()
+    turns = [message("user", 10), message("assistant", 10), message("user", 10)]
+    store.append(session_id, turns, create=True)
+    assert store.context(session_id, []) == turns[1:]
+
+
+def test_sessions_are_persisted_for_other_workers_and_restarts(tmp_path):
+    store = ChatSessionStore(1, 3600, 1000, str(tmp_path))
+    first, second = store.new_id(), store.new_id()
+    store.append(first, [message("user", 1)], create=True)
+    store.append(second, [message("user", 2)], create=True)
+    # Evicted from memory, but reloaded from its file
+    assert store.stats()["evictions"] == 1
+    assert store.context(first, []) == [message("user", 1)]
+    restarted = ChatSessionStore(10, 3600, 1000, str(tmp_path))
+    assert restarted.info(second)["messages"] == 1
+    assert restarted.delete(second)
+    assert not os.path.exists(tmp_path / f"{second}.json")
+    assert store.info(second) is None
+
+
+def test_append_to_an_unknown_session_needs_create():
+    store = ChatSessionStore(10, 3600, 1000)
+    store.append("unknown", [message("user", 1)])
+    assert store.stats()["sessions"] == 0
+
+
+@pytest.mark.parametrize("session_id, valid", [
+    ("abc-DEF_123", True),
+    ("x" * 64, True),
+    ("x" * 65, False),
+    ("", False),
+    ("../secrets", False),
+    ("sp ace", False),
+    ("café", False),
+    (None, False),
+])
+def test_valid_id(session_id, valid):
+    assert ChatSessionStore.valid_id(session_id) is valid
+
+
+def test_session_endpoints(chat_client):
+    client, store = chat_client
+    _, body = post_chat(client, {"session": True, "messages": [{"role": "user", "content": "hi"}]})
+    session_id = body["session_id"]
+    response = client.get(f'/api/chat/sessions/{session_id}')
+    info = response.get_json()
+    assert response.status_code == 200
+    assert info["session_id"] == session_id and info["messages"] == 2 and info["token_budget"] == 1000
+    response = client.delete(f'/api/chat/sessions/{session_id}')
+    assert response.get_json() == {"session_id": session_id, "deleted": True}
+    assert client.get(f'/api/chat/sessions/{session_id}').status_code == 404
+    assert client.delete(f'/api/chat/sessions/{session_id}').status_code == 404
+    assert post_chat(client, {"session_id": session_id, "messages": [{"content": "again"}]}) == (404, {
+        "error": "Unknown or expired chat session; start a new one and resend the conversation", "session_expired": True})
+
+
+class FakeOllamaStream:
+    ok = True
+    status_code = 200
+
+    def iter_lines(self):
+        yield b'{"message": {"role": "assistant", "content": "Hel"}, "done": false}'
+        yield b'{"message": {"role": "assistant", "content": "lo"}, "done": false}'
+        yield b'{"message": {"role": "assistant", "content": ""}, "done": true}'
+
+    def close(self):
+        pass
+
+
+def test_streamed_turn_is_recorded_once_the_reply_is_complete(chat_client, monkeypatch):
+    client, store = chat_client
+    _, body = post_chat(client, {"session": True, "messages": [{"role": "user", "content": "hi"}]})
+    session_id = body["session_id"]
+    sent = []
+    monkeypatch.setattr(upstream, "post", lambda url, **kwargs: sent.append(kwargs["json"]) or FakeOllamaStream())
+    response = client.post('/api/chat?stream=1', json={"session_id": session_id, "messages": [{"content": "again"}]})
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    response.get_data()
+    response.close()
+    assert [m["content"] for m in sent[0]["messages"]] == ["hi", "Hi!", "again"]
+    assert store.context(session_id, [])[-1] == {"role": "assistant", "content": "Hello"}
+    assert store.info(session_id)["messages"] == 4
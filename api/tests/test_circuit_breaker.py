@@ -0,0 +1,159 @@
+import json
+import time
+
+import pytest
+
+import replicate_py
+from _proxy import ollama_backends, resilience
+from _proxy.gemini import GeminiAttempts, gemini_caller_error_status
+from _proxy.http_clients import upstream
+from _proxy.ollama_backends import OllamaBackendPool
+from _proxy.resilience import CircuitBreaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("gemini", failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record(False)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.is_open()
+    assert not breaker.allow()
+    assert breaker.stats() == {"state": "open", "consecutive_failures": 3, "opens": 1}
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker("gemini", failure_threshold=2, reset_timeout=30)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert not breaker.is_open()
+    assert breaker.allow()
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker("gemini", failure_threshold=1, reset_timeout=0.05)
+    breaker.record(False)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    # A trial is in flight: everyone else is still refused
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.allow()
+    assert breaker.stats()["state"] == "closed"
+
+
+def test_failed_trial_opens_the_circuit_again():
+    breaker = CircuitBreaker("gemini", failure_threshold=3, reset_timeout=0.05)
+    for _ in range(3):
+        breaker.record(False)
+    time.sleep(0.06)
+    assert breaker.allow()
+    # A single failure is enough once the circuit has opened
+    breaker.record(False)
+    assert breaker.is_open()
+    assert breaker.stats()["opens"] == 2
+
+
+def test_retry_after():
+    breaker = CircuitBreaker("gemini", failure_threshold=1, reset_timeout=30)
+    assert breaker.retry_after() == 0
+    breaker.record(False)
+    assert 1 <= breaker.retry_after() <= 31
+
+
+@pytest.fixture
+def router(fresh_router, monkeypatch):
+    """A fresh provider router with no retries, so every failure is recorded at once"""
+    monkeypatch.setattr(resilience, "UPSTREAM_MAX_RETRIES", 0)
+    return fresh_router
+
+
+def test_gemini_caller_errors_do_not_open_the_circuit(router):
+    exceptions = pytest.importorskip("google.api_core.exceptions")
+    for error in (exceptions.InvalidArgument("API key not valid"), exceptions.PermissionDenied("denied"),
+                  exceptions.ResourceExhausted("quota")) * 2:
+        body, status = GeminiAttempts().failed(error)
+        assert status == error.code
+        assert body["status"] == "error"
+    assert router.breakers["gemini"].stats()["consecutive_failures"] == 0
+    assert router.pick("gemini") == "gemini"
+
+
+def test_gemini_provider_errors_open_the_circuit(router):
+    exceptions = pytest.importorskip("google.api_core.exceptions")
+    errors = [exceptions.ServiceUnavailable("down"), exceptions.DeadlineExceeded("slow"),
+              exceptions.InternalServerError("oops"), ConnectionError("reset"), TimeoutError()]
+    for error in errors:
+        body, status = GeminiAttempts().failed(error)
+        assert status == 502
+    assert router.breakers["gemini"].is_open()
+    assert router.pick("gemini") is None
+
+
+def test_gemini_caller_error_status():
+    exceptions = pytest.importorskip("google.api_core.exceptions")
+    assert gemini_caller_error_status(exceptions.InvalidArgument("bad")) == 400
+    assert gemini_caller_error_status(exceptions.ResourceExhausted("quota")) == 429
+    assert gemini_caller_error_status(exceptions.ServiceUnavailable("down")) is None
+    assert gemini_caller_error_status(ValueError("not an API error")) is None
+
+
+class FakeOllamaStream:
+    """A streaming Ollama /api/chat reply with one NDJSON chunk per word"""
+    ok = True
+    status_code = 200
+
+    def __init__(self, words):
+        self.words = words
+        self.closed = False
+
+    def iter_lines(self):
+        for word in self.words:
+            yield json.dumps({"message": {"role": "assistant", "content": word}, "done": False}).encode()
+        yield json.dumps({"message": {"role": "assistant", "content": ""}, "done": True}).encode()
+
+    def json(self):
+        return {"message": {"role": "assistant", "content": "".join(self.words)}, "done": True}
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def ollama(router, monkeypatch):
+    """A single-backend Ollama pool whose upstream streams canned replies"""
+    pool = OllamaBackendPool(["http://gpu-1:11434"], failure_threshold=1)
+    monkeypatch.setattr(ollama_backends, "ollama_pool", pool)
+    streams = []
+
+    def post(url, **kwargs):
+        streams.append(FakeOllamaStream(["Hello", " there"]))
+        return streams[-1]
+
+    monkeypatch.setattr(upstream, "post", post)
+    return pool, streams
+
+
+@pytest.mark.parametrize("chunks_read", [0, 1])
+def test_aborted_ollama_stream_leaves_breaker_and_pool_alone(router, ollama, chunks_read):
+    pool, streams = ollama
+    client = replicate_py.app.test_client()
+    body = {"messages": [{"role": "user", "content": "hi"}]}
+    for _ in range(6):
+        response = client.post("/api/chat?stream=1", json=body, buffered=False)
+        assert response.status_code == 200
+        chunks = iter(response.response)
+        for _ in range(chunks_read):
+            next(chunks)
+        # The client presses stop
+        response.close()
+        assert streams[-1].closed
+    backend = pool.stats()["http://gpu-1:11434"]
+    assert backend["outstanding"] == 0
+    assert backend["errors"] == 0 and backend["ejections"] == 0
+    assert router.breakers["ollama"].stats()["consecutive_failures"] == 0
+    response = client.post("/api/chat", json=dict(body, stream=False))
+    assert response.status_code == 200
+    response.close()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from _proxy.caching import LRUCache, RequestCoalescer
+
+
+def test_concurrent_identical_calls_share_one_upstream_call():
+    coalescer = RequestCoalescer(LRUCache(10))
+    calls = []
+    release = threading.Event()
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {"status": "succeeded"}, 200
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(coalescer.run("key", fn))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while coalescer.stats()["coalesced"] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(source for _, source in results) == ["COALESCED"] * 4 + ["MISS"]
+    assert all(result == ({"status": "succeeded"}, 200) for result, _ in results)
+    assert coalescer.stats()["in_flight"] == 0
+
+
+def test_leader_errors_reach_every_waiter():
+    coalescer = RequestCoalescer(LRUCache(10))
+    started = threading.Event()
+    release = threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    errors = []
+
+    def run():
+        try:
+            coalescer.run("key", fn)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=run)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=run)
+    follower.start()
+    while coalescer.stats()["coalesced"] < 1:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert errors == ["upstream down", "upstream down"]
+    # The failed call is not remembered: the next caller tries again
+    assert coalescer.run("key", lambda: ({"status": "succeeded"}, 200)) == (({"status": "succeeded"}, 200), "MISS")
+
+
+def test_successful_results_are_cached():
+    coalescer = RequestCoalescer(LRUCache(10))
+    result = ({"status": "succeeded", "output": "hi"}, 200)
+    assert coalescer.run("key", lambda: result, cacheable=True) == (result, "MISS")
+    assert coalescer.run("key", pytest.fail, cacheable=True) == (result, "HIT")
+
+
+@pytest.mark.parametrize("result", [
+    ({"error": "boom"}, 500),
+    ({"status": "partial_failure"}, 200),
+    ("not a dict", 200),
+])
+def test_failed_results_are_not_cached(result):
+    coalescer = RequestCoalescer(LRUCache(10))
+    coalescer.run("key", lambda: result, cacheable=True)
+    assert coalescer.run("key", lambda: result, cacheable=True)[1] == "MISS"
+
+
+def test_bypass_skips_cache_and_coalescing():
+    cache = LRUCache(10)
+    coalescer = RequestCoalescer(cache)
+    result = ({"status": "succeeded"}, 200)
+    coalescer.run("key", lambda: result, cacheable=True)
+    calls = []
+    assert coalescer.run("key", lambda: calls.append(1) or result, cacheable=True, bypass=True) == (result, "BYPASS")
+    assert calls == [1]
+    assert coalescer.stats()["bypassed"] == 1
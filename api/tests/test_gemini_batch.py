@@ -0,0 +1,74 @@
+import json
+import time
+
+import pytest
+
+import replicate_py
+from _proxy import gemini
+
+pytest.importorskip("google.generativeai")
+
+TOOLS = json.dumps([{"type": "function", "function": {
+    "name": "get_balance", "description": "Balance of an address",
+    "parameters": {"type": "object", "properties": {"address": {"type": "string"}}}
+}}])
+HEADERS = {"X-Gemini-API-Key": "batch-key"}
+
+
+@pytest.fixture
+def answered(monkeypatch):
+    """Queries answered by a stub that echoes them, slower for earlier ones, so results finish out of order"""
+    requests = []
+
+    def answer_gemini_request(gemini_request):
+        requests.append(gemini_request)
+        if gemini_request.query == "boom":
+            raise ConnectionError("connection reset")
+        time.sleep(0.05 if gemini_request.query == "first" else 0)
+        return {"status": "succeeded", "output": [], "text_if_any": gemini_request.query}, 200, {}
+
+    monkeypatch.setattr(gemini, "new_gemini_client", lambda api_key, asynchronous=False: object())
+    monkeypatch.setattr(gemini, "answer_gemini_request", answer_gemini_request)
+    return requests
+
+
+def post_batch(body, headers=HEADERS):
+    response = replicate_py.app.test_client().post('/api/gemini_functions/batch', json=body, headers=headers)
+    result = response.status_code, response.get_json()
+    response.close()
+    return result
+
+
+def test_results_come_back_in_order(answered):
+    status, body = post_batch({"queries": ["first", "", "second", 7, "boom"], "tools": TOOLS})
+    assert status == 200
+    results = body["results"]
+    assert [item["index"] for item in results] == [0, 1, 2, 3, 4]
+    assert [item["status_code"] for item in results] == [200, 400, 200, 400, 502]
+    assert results[0]["text_if_any"] == "first" and results[2]["text_if_any"] == "second"
+    assert results[1] == {"index": 1, "status_code": 400, "status": "error", "error": "Each query must be a non-empty string"}
+    assert results[4]["status"] == "error"
+    assert body["succeeded"] == 2 and body["failed"] == 3
+    # Invalid queries never reach Gemini, and the rest share one compiled model
+    assert sorted(gemini_request.query for gemini_request in answered) == ["boom", "first", "second"]
+    assert len({id(gemini_request.compiled) for gemini_request in answered}) == 1
+
+
+@pytest.mark.parametrize("body", [
+    {"tools": TOOLS},
+    {"queries": [], "tools": TOOLS},
+    {"queries": "not a list", "tools": TOOLS},
+    {"queries": ["a", "b", "c"], "tools": TOOLS},
+    {"queries": ["a"]},
+])
+def test_invalid_batches_are_rejected(answered, monkeypatch, body):
+    monkeypatch.setattr(gemini, "GEMINI_BATCH_MAX_ITEMS", 2)
+    status, reply = post_batch(body)
+    assert status == 400 and reply["error"]
+    assert answered == []
+
+
+def test_batch_needs_a_gemini_key(answered, monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.delenv("GOOGLE_API_KEY", raising=False)
+    assert post_batch({"queries": ["a"], "tools": TOOLS}, headers={})[0] == 401
@@ -0,0 +1,52 @@
+import pytest
+
+from _proxy import gemini
+from _proxy.gemini import GeminiClientRegistry
+
+
+@pytest.fixture
+def created(monkeypatch):
+    """Record the clients the registry creates instead of opening gRPC channels"""
+    clients = []
+
+    def new_client(api_key, asynchronous=False):
+        clients.append((api_key, asynchronous))
+        return object()
+
+    monkeypatch.setattr(gemini, "new_gemini_client", new_client)
+    return clients
+
+
+def test_one_client_per_key(created):
+    registry = GeminiClientRegistry(max_clients=10, idle_ttl=60)
+    assert registry.get("key-a") is registry.get("key-a")
+    assert registry.get("key-a") is not registry.get("key-b")
+    assert created == [("key-a", False), ("key-b", False)]
+
+
+def test_async_mode_only_opens_the_async_client(created):
+    registry = GeminiClientRegistry(max_clients=10, idle_ttl=60)
+    assert registry.get_async("key-a") is registry.get_async("key-a")
+    assert created == [("key-a", True)]
+    registry.get("key-a")
+    assert created == [("key-a", True), ("key-a", False)]
+    assert registry.stats()["size"] == 1
+
+
+def test_least_recently_used_keys_are_evicted(created):
+    registry = GeminiClientRegistry(max_clients=2, idle_ttl=60)
+    first = registry.get("key-a")
+    registry.get("key-b")
+    registry.get("key-a")
+    registry.get("key-c")
+    assert registry.stats()["evicted"] == 1
+    # key-b was the least recently used
+    assert registry.get("key-a") is first
+    registry.get("key-b")
+    assert created.count(("key-b", False)) == 2
+
+
+def test_idle_clients_expire(created):
+    registry = GeminiClientRegistry(max_clients=10, idle_ttl=0)
+    registry.get("key-a")
+    assert registry.stats() == {"size": 0, "max_clients": 10, "idle_ttl": 0, "created": 1, "evicted": 1}
@@ -0,0 +1,137 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import replicate_py
+from _proxy import gemini, ollama_backends, resilience
+from _proxy.gemini import GeminiRequest
+from _proxy.http_clients import upstream
+from _proxy.ollama_backends import OllamaBackendPool
+
+pytest.importorskip("google.generativeai")
+
+TOOLS = json.dumps([{"type": "function", "function": {
+    "name": "get_balance", "description": "Balance of an address",
+    "parameters": {"type": "object", "properties": {"address": {"type": "string"}}}
+}}])
+HEADERS = {"X-Gemini-API-Key": "test-key"}
+
+
+def call_part(name, **args):
+    return SimpleNamespace(function_call=SimpleNamespace(name=name, args=args), text="")
+
+
+def text_part(text):
+    return SimpleNamespace(function_call=None, text=text)
+
+
+def chunk(*parts):
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=list(parts)))])
+
+
+class FakeStream:
+    """Streams its chunks, then raises error if one is given"""
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    def __iter__(self):
+        yield from self.chunks
+        if self.error:
+            raise self.error
+
+
+class FakeModel:
+    """Stands in for the compiled model bound to the request's client; each send_message takes the next stream"""
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.sent = []
+
+    def start_chat(self):
+        return self
+
+    def send_message(self, query, stream=False):
+        assert stream
+        self.sent.append(query)
+        return self.streams.pop(0)
+
+
+@pytest.fixture
+def gemini_model(fresh_router, monkeypatch):
+    """Gemini calls answered by a FakeModel, retried at once"""
+    model = FakeModel([])
+    monkeypatch.setattr(gemini, "new_gemini_client", lambda api_key, asynchronous=False: object())
+    monkeypatch.setattr(GeminiRequest, "model", lambda self: model)
+    monkeypatch.setattr(resilience, "backoff_delay", lambda retry_count: 0)
+    return model
+
+
+def events(body):
+    parsed = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        parsed.append((lines.get("event", "message"), json.loads(lines["data"])))
+    return parsed
+
+
+def stream(path, body):
+    response = replicate_py.app.test_client().post(path, json=body, headers=HEADERS)
+    result = response.status_code, response.headers, response.get_data(as_text=True)
+    response.close()
+    return result
+
+
+def test_parts_are_sent_as_they_stream(gemini_model):
+    gemini_model.streams.append(FakeStream([chunk(call_part("get_balance", address="0xabc")), chunk(text_part("Checking"), text_part(" now"))]))
+    status, headers, body = stream('/api/gemini_functions', {"query": "my balance?", "tools": TOOLS, "stream": True})
+    assert status == 200
+    assert headers["Content-Type"].startswith("text/event-stream")
+    received = events(body)
+    assert [name for name, _ in received] == ["function_call", "text", "text", "done"]
+    assert received[0][1]["function_call"] == {"name": "get_balance", "arguments": {"address": "0xabc"}}
+    done = received[-1][1]
+    # The final event carries the same body as the non-streaming endpoint
+    assert done["status"] == "succeeded"
+    assert done["output"] == [{"name": "get_balance", "arguments": {"address": "0xabc"}}]
+    assert done["text_if_any"] == "Checking now"
+    assert all(data["id"] == done["id"] for _, data in received)
+
+
+def test_failure_before_the_first_event_is_retried(gemini_model):
+    gemini_model.streams += [FakeStream([], error=ConnectionError("reset")), FakeStream([chunk(text_part("Hello"))])]
+    _, _, body = stream('/api/gemini_functions?stream=1', {"query": "hi", "tools": TOOLS})
+    assert [name for name, _ in events(body)] == ["text", "done"]
+    assert gemini_model.sent == ["hi", "hi"]
+
+
+def test_failure_after_an_event_is_reported_not_retried(gemini_model, fresh_router):
+    gemini_model.streams += [FakeStream([chunk(text_part("Hel"))], error=ConnectionError("reset")), FakeStream([chunk(text_part("Hello"))])]
+    _, _, body = stream('/api/gemini_functions?stream=1', {"query": "hi", "tools": TOOLS})
+    received = events(body)
+    # A retry would send the client "Hel" twice
+    assert [name for name, _ in received] == ["text", "error"]
+    assert received[-1][1]["status"] == "error"
+    assert len(gemini_model.sent) == 1
+    assert fresh_router.breakers["gemini"].stats()["consecutive_failures"] == 1
+
+
+def test_open_circuit_streams_the_fallback_answer(gemini_model, fresh_router, monkeypatch):
+    monkeypatch.setattr(fresh_router, "fallbacks", {"gemini": "ollama"})
+    monkeypatch.setattr(ollama_backends, "ollama_pool", OllamaBackendPool(["http://gpu-1:11434"]))
+    ollama_reply = SimpleNamespace(ok=True, status_code=200, json=lambda: {"message": {
+        "role": "assistant", "content": "", "tool_calls": [{"function": {"name": "get_balance", "arguments": {"address": "0xabc"}}}]
+    }})
+    sent = []
+    monkeypatch.setattr(upstream, "post", lambda url, **kwargs: sent.append(kwargs["json"]) or ollama_reply)
+    for _ in range(5):
+        fresh_router.record("gemini", False)
+    _, _, body = stream('/api/gemini_functions?stream=1', {"query": "my balance?", "tools": TOOLS})
+    received = events(body)
+    assert [name for name, _ in received] == ["function_call", "done"]
+    assert received[0][1]["function_call"] == {"name": "get_balance", "arguments": {"address": "0xabc"}}
+    assert gemini_model.sent == []
+    # Ollama gets the same OpenAI-style tools
+    assert sent[0]["tools"] == json.loads(TOOLS) and sent[0]["stream"] is False
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from _proxy import resilience
+from _proxy.metrics import request_upstream_seconds
+from _proxy.resilience import HedgePolicy, RetryBudget, hedged_call, hedged_call_async, timed_upstream
+
+
+def test_retry_budget_allows_min_retries_plus_a_ratio_of_calls():
+    budget = RetryBudget(ratio=0.5, min_retries=1, window=10)
+    for _ in range(4):
+        budget.record_request()
+    assert [budget.allow("gemini", "error") for _ in range(4)] == [True, True, True, False]
+    assert budget.stats() == {"calls": 4, "retries": 3, "window_seconds": 10, "denied": 1}
+
+
+def test_retry_budget_forgets_old_traffic():
+    budget = RetryBudget(ratio=0, min_retries=1, window=1)
+    assert budget.allow("gemini", "error")
+    assert not budget.allow("gemini", "error")
+    time.sleep(1.1)
+    assert budget.allow("gemini", "error")
+
+
+def test_hedge_delay_is_the_latency_percentile():
+    policy = HedgePolicy(["gemini"], percentile=90, min_samples=10, min_delay=0.01)
+    for i in range(1, 10):
+        policy.observe("gemini", i / 100)
+    assert policy.delay("gemini") is None
+    policy.observe("gemini", 0.10)
+    assert policy.delay("gemini") == pytest.approx(0.09)
+    assert policy.delay("replicate") is None
+
+
+class SlowThenFast:
+    """The first copy of a call takes `slow` seconds and the duplicate answers at once"""
+
+    def __init__(self, slow=0.3):
+        self.slow = slow
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def seconds(self):
+        with self._lock:
+            self.calls += 1
+            return self.slow if self.calls == 1 else 0.01
+
+    def __call__(self):
+        seconds = self.seconds()
+        with timed_upstream("gemini"):
+            time.sleep(seconds)
+        return seconds
+
+    async def call_async(self):
+        seconds = self.seconds()
+        with timed_upstream("gemini"):
+            await asyncio.sleep(seconds)
+        return seconds
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    """Hedge gemini calls after 20 ms, with a fresh budget and two hedge slots"""
+    policy = HedgePolicy(["gemini"], percentile=50, min_samples=1, min_delay=0.02)
+    policy.observe("gemini", 0.02)
+    budget = RetryBudget(ratio=0, min_retries=10, window=10)
+    monkeypatch.setattr(resilience, "hedge_policy", policy)
+    monkeypatch.setattr(resilience, "retry_budget", budget)
+    monkeypatch.setattr(resilience, "hedge_slots", threading.BoundedSemaphore(2))
+    pool = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(resilience, "hedge_pool", pool)
+    token = request_upstream_seconds.set([0.0])
+    yield budget
+    request_upstream_seconds.reset(token)
+    # Let the slower copies finish before the module's pool and slots are restored
+    pool.shutdown(wait=True)
+
+
+def test_slow_call_is_hedged(hedging):
+    call = SlowThenFast()
+    assert hedged_call("gemini", call) == 0.01
+    assert call.calls == 2
+    assert hedging.stats()["retries"] == 1
+
+
+def test_hedged_request_counts_upstream_time_once(hedging):
+    start = time.monotonic()
+    hedged_call("gemini", SlowThenFast())
+    waited = time.monotonic() - start
+    # The slow copy's 0.3 s is not added on top of the duplicate's, even once it finishes
+    resilience.hedge_pool.shutdown(wait=True)
+    spent = request_upstream_seconds.get()[0]
+    assert 0.01 <= spent <= waited + 0.01
+    assert spent < 0.3
+
+
+def test_hedge_without_a_free_slot_spends_no_budget(hedging, monkeypatch):
+    monkeypatch.setattr(resilience, "hedge_slots", threading.BoundedSemaphore(1))
+    call = SlowThenFast(slow=0.1)
+    assert hedged_call("gemini", call) == 0.1
+    assert call.calls == 1
+    assert hedging.stats() == {"calls": 0, "retries": 0, "window_seconds": 10, "denied": 0}
+
+
+def test_async_hedged_request_counts_upstream_time_once(hedging):
+    call = SlowThenFast()
+
+    async def main():
+        request_upstream_seconds.set([0.0])
+        start = time.monotonic()
+        result = await hedged_call_async("gemini", call.call_async)
+        return result, request_upstream_seconds.get()[0], time.monotonic() - start
+
+    result, spent, waited = asyncio.run(main())
+    assert result == 0.01 and call.calls == 2
+    assert 0.01 <= spent <= waited + 0.01
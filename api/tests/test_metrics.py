@@ -0,0 +1,77 @@
+import threading
+
+import replicate_py
+from _proxy.metrics import METRICS_CONTENT_TYPE, MetricsRegistry, begin_request_metrics, end_request_metrics, metrics
+
+
+def test_counters_and_gauges():
+    registry = MetricsRegistry()
+    registry.counter('requests_total', "Requests")
+    registry.gauge('in_flight', "In flight")
+    registry.inc('requests_total', route="/b", status="200")
+    registry.inc('requests_total', 2, route="/a", status="200")
+    registry.inc('in_flight')
+    registry.inc('in_flight')
+    registry.dec('in_flight')
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{route="/a",status="200"} 2.0\n'
+        'requests_total{route="/b",status="200"} 1.0\n'
+        "# HELP in_flight In flight\n"
+        "# TYPE in_flight gauge\n"
+        "in_flight 1.0\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    registry.histogram('duration_seconds', "Duration", [1, 0.1])
+    for value in (0.05, 0.1, 0.5, 3):
+        registry.observe('duration_seconds', value, route="/a")
+    assert registry.render().splitlines()[2:] == [
+        'duration_seconds_bucket{route="/a",le="0.1"} 2',
+        'duration_seconds_bucket{route="/a",le="1.0"} 3',
+        'duration_seconds_bucket{route="/a",le="+Inf"} 4',
+        'duration_seconds_sum{route="/a"} 3.65',
+        'duration_seconds_count{route="/a"} 4'
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter('errors_total', "Errors")
+    registry.inc('errors_total', reason='say "hi"\\\n')
+    assert 'errors_total{reason="say \\"hi\\"\\\\\\n"} 1.0' in registry.render()
+
+
+def test_pending_events_are_folded_once_over_the_limit():
+    registry = MetricsRegistry(max_pending=10)
+    registry.counter('events_total', "Events")
+    threads = [threading.Thread(target=lambda: [registry.inc('events_total') for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(registry._pending) <= 11
+    assert "events_total 4000.0" in registry.render()
+
+
+def test_request_metrics_record_status_and_size():
+    start = begin_request_metrics('/test/route', 120)
+    end_request_metrics('/test/route', start, 201, response_size=50)
+    rendered = metrics.render()
+    assert 'proxy_requests_total{route="/test/route",status="201"} 1.0' in rendered
+    assert 'proxy_requests_in_flight{route="/test/route"} 0.0' in rendered
+    assert 'proxy_request_size_bytes_count{route="/test/route"} 1' in rendered
+    assert 'proxy_response_size_bytes_sum{route="/test/route"} 50' in rendered
+
+
+def test_metrics_route():
+    client = replicate_py.app.test_client()
+    # Requests are recorded once their response is closed
+    client.get('/api/cache_stats').close()
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == METRICS_CONTENT_TYPE
+    assert 'proxy_requests_total{route="/api/cache_stats",status="200"}' in response.get_data(as_text=True)
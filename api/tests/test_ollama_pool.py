@@ -0,0 +1,106 @@
+from _proxy.ollama_backends import OllamaBackendPool
+
+A, B = "http://gpu-1:11434", "http://gpu-2:11434"
+
+
+def pool(**options):
+    return OllamaBackendPool([A, B + "/"], **options)
+
+
+def finish_on(backends, url, ok, model="llama3", served=False):
+    """Acquire until url is picked, then release it with the given outcome"""
+    held = []
+    while True:
+        picked = backends.acquire(model)
+        if picked == url:
+            break
+        held.append(picked)
+    backends.release(url, ok, model if served else None)
+    for other in held:
+        backends.release(other, True)
+
+
+def test_urls_are_normalised():
+    assert pool().urls() == [A, B]
+
+
+def test_picks_the_least_busy_backend():
+    backends = pool()
+    first = backends.acquire("llama3")
+    second = backends.acquire("llama3")
+    assert {first, second} == {A, B}
+    backends.release(first, True)
+    assert backends.acquire("llama3") == first
+
+
+def test_prefers_backends_with_the_model_loaded():
+    backends = pool()
+    backends.release(backends.acquire("llama3"), True, "llama3")
+    warm = [url for url, state in backends.stats().items() if state["loaded_models"] == ["llama3"]]
+    assert len(warm) == 1
+    for _ in range(5):
+        url = backends.acquire("llama3")
+        assert url == warm[0]
+        backends.release(url, True, "llama3")
+
+
+def test_spills_to_cold_backends_when_warm_ones_are_busy():
+    backends = pool(spill_outstanding=2)
+    finish_on(backends, A, True, served=True)
+    picks = [backends.acquire("llama3") for _ in range(4)]
+    assert picks[:2] == [A, A]
+    assert B in picks[2:]
+
+
+def test_a_4xx_answer_does_not_mark_the_model_loaded():
+    backends = pool()
+    url = backends.acquire("missing")
+    # Healthy backend, but "model not found": no served_model
+    backends.release(url, True)
+    assert backends.stats()[url]["loaded_models"] == []
+    assert backends.stats()[url]["errors"] == 0
+
+
+def test_repeated_failures_eject_a_backend():
+    backends = pool(failure_threshold=2, cooldown=30)
+    for _ in range(2):
+        finish_on(backends, A, False)
+    stats = backends.stats()
+    assert not stats[A]["healthy"]
+    assert stats[A]["ejections"] == 1
+    assert all(backends.acquire("llama3") == B for _ in range(3))
+
+
+def test_success_resets_the_failure_count():
+    backends = pool(failure_threshold=2, cooldown=30)
+    finish_on(backends, A, False)
+    finish_on(backends, A, True)
+    finish_on(backends, A, False)
+    assert backends.stats()[A]["healthy"]
+
+
+def test_client_disconnects_are_neutral():
+    backends = pool(failure_threshold=2, cooldown=30)
+    finish_on(backends, A, False)
+    # Neither a failure that ejects the backend nor a success that forgives the earlier one
+    for _ in range(3):
+        finish_on(backends, A, None)
+    stats = backends.stats()
+    assert stats[A]["healthy"]
+    assert stats[A]["errors"] == 1 and stats[A]["outstanding"] == 0
+    finish_on(backends, A, False)
+    assert not backends.stats()[A]["healthy"]
+
+
+def test_fails_open_when_every_backend_is_ejected():
+    backends = pool(failure_threshold=1, cooldown=30)
+    finish_on(backends, A, False)
+    finish_on(backends, B, False)
+    assert not any(state["healthy"] for state in backends.stats().values())
+    assert backends.acquire("llama3") in (A, B)
+
+
+def test_unknown_backends_are_ignored_on_release():
+    backends = pool()
+    backends.release("http://elsewhere:11434", False)
+    assert all(state["errors"] == 0 and state["outstanding"] == 0 for state in backends.stats().values())
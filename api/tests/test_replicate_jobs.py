@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import pytest
+
+import replicate_py
+from _proxy import handlers, replicate_api
+from _proxy.http_clients import upstream
+from _proxy.replicate_api import ReplicateJobTracker, start_replicate_job
+
+
+def prediction(job_id, status="starting", **fields):
+    return {"id": job_id, "status": status, "urls": {"get": f"https://api.replicate.com/v1/predictions/{job_id}"}, **fields}
+
+
+def replicate_reply(body, status_code=200):
+    return SimpleNamespace(ok=status_code < 400, status_code=status_code, json=lambda: body)
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    """A tracker used by the routes; its poller waits an hour, so tests poll with _poll themselves"""
+    tracker = ReplicateJobTracker(3600, 7200, 10, max_jobs=3, job_ttl=60)
+    monkeypatch.setattr(replicate_api, "replicate_jobs", tracker)
+    monkeypatch.setattr(handlers, "replicate_jobs", tracker)
+    return tracker
+
+
+def test_jobs_are_only_shown_to_their_token(jobs):
+    jobs.submit(prediction("p1"), "token-a")
+    state = jobs.get("p1", "token-a")
+    # The urls point at Replicate, so they are not handed to clients
+    assert state == {"id": "p1", "status": "starting", "polls": 0}
+    assert jobs.get("p1", "token-b") is None
+    assert jobs.get("unknown", "token-a") is None
+
+
+def test_polling_until_the_prediction_finishes(jobs, monkeypatch):
+    replies = [replicate_reply(prediction("p1", "processing")), replicate_reply(prediction("p1", "succeeded", output=["done"]))]
+    requests = []
+    monkeypatch.setattr(upstream, "get", lambda url, **kwargs: requests.append((url, kwargs)) or replies.pop(0))
+    job = jobs.submit(prediction("p1"), "token-a")
+    jobs._poll(job)
+    assert jobs.get("p1", "token-a")["status"] == "processing"
+    # Unfinished jobs are polled less and less often
+    assert job["interval"] == 5400 and job["finished_at"] is None
+    jobs._poll(job)
+    assert jobs.get("p1", "token-a") == {"id": "p1", "status": "succeeded", "output": ["done"], "polls": 2}
+    assert job["finished_at"] is not None
+    assert requests[0] == ("https://api.replicate.com/v1/predictions/p1", {"headers": {"Authorization": "Bearer token-a"}})
+    assert jobs.stats()["active"] == 0 and jobs.stats()["polls"] == 2
+
+
+def test_a_job_that_keeps_failing_to_poll_is_given_up(jobs, monkeypatch):
+    monkeypatch.setattr(upstream, "get", lambda url, **kwargs: replicate_reply({"detail": "unavailable"}, 503))
+    job = jobs.submit(prediction("p1"), "token-a")
+    for _ in range(11):
+        jobs._poll(job)
+    state = jobs.get("p1", "token-a")
+    assert state["status"] == "failed" and "Lost track of prediction" in state["error"]
+    assert jobs.stats()["poll_errors"] == 11
+
+
+def test_finished_jobs_expire_and_make_room(jobs):
+    jobs.submit(prediction("done", "succeeded"), "token")
+    jobs.submit(prediction("p1"), "token")
+    jobs.submit(prediction("p2"), "token")
+    # Full, so the finished job is dropped for the new one
+    jobs.submit(prediction("p3"), "token")
+    assert jobs.get("done", "token") is None
+    # Active jobs are never dropped
+    with pytest.raises(RuntimeError):
+        jobs.submit(prediction("p4"), "token")
+    assert start_replicate_job(201, prediction("p4"), "token") == ({"error": "Too many pending Replicate jobs, try again later"}, 503)
+    jobs._jobs["p1"]["finished_at"] = 0.0
+    jobs._purge(jobs.job_ttl + 1)
+    assert jobs.get("p1", "token") is None and jobs.stats()["active"] == 2
+
+
+def test_start_replicate_job(jobs):
+    body, status = start_replicate_job(201, prediction("p1", output=None), "token")
+    assert status == 202
+    assert body == {"id": "p1", "status": "starting", "output": None, "poll_url": "/api/replicate/p1"}
+    assert start_replicate_job(422, {"detail": "bad input"}, "token") == ({"detail": "bad input"}, 422)
+    assert start_replicate_job(201, {"status": "starting"}, "token")[1] == 502
+
+
+def test_async_job_routes(jobs, monkeypatch):
+    monkeypatch.setattr(upstream, "post", lambda url, **kwargs: replicate_reply(prediction("p1"), 201))
+    client = replicate_py.app.test_client()
+    headers = {"X-Replicate-API-Token": "token-a"}
+    response = client.post('/api/replicate?async=1', json={"version": "v1", "input": {}}, headers=headers)
+    assert response.status_code == 202
+    poll_url = response.get_json()["poll_url"]
+    response = client.get(poll_url, headers=headers)
+    assert response.status_code == 200 and response.get_json()["status"] == "starting"
+    assert client.get(poll_url).status_code == 401
+    assert client.get(poll_url, headers={"X-Replicate-API-Token": "token-b"}).status_code == 404
+    assert client.get('/api/replicate/unknown', headers=headers).status_code == 404
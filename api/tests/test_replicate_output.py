@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from _proxy import replicate_api
+from _proxy.replicate_api import decode_replicate_output, replicate_function_calls, structure_replicate_body
+
+CALLS = [{"name": "get_balance", "arguments": {"address": "0xabc"}}]
+
+
+@pytest.fixture(params=["orjson", "json"], autouse=True)
+def json_backend(request, monkeypatch):
+    """Run every case with orjson when it is installed and with the standard library decoder"""
+    if request.param == "orjson":
+        if replicate_api.orjson is None:
+            pytest.skip("orjson is not installed")
+    else:
+        monkeypatch.setattr(replicate_api, "orjson", None)
+
+
+@pytest.mark.parametrize("output", [
+    [json.dumps(CALLS)],
+    json.dumps(CALLS),
+    json.dumps(json.dumps(CALLS)),
+    [token for token in json.dumps(CALLS)],
+])
+def test_decodes_the_json_layers(output):
+    assert decode_replicate_output(output) == CALLS
+
+
+def test_one_document_per_item():
+    assert decode_replicate_output(['{"a": 1}', '[2]']) == [{"a": 1}, [2]]
+
+
+def test_text_is_joined_and_left_alone():
+    assert decode_replicate_output(["Hello", " world"]) == "Hello world"
+    assert decode_replicate_output(["[not json"]) == "[not json"
+    assert decode_replicate_output(42) == 42
+
+
+@pytest.mark.parametrize("value, calls", [
+    (CALLS, CALLS),
+    ({"name": "f", "arguments": '{"x": 1}'}, [{"name": "f", "arguments": {"x": 1}}]),
+    ([{"type": "function", "function": {"name": "f", "parameters": {"x": 1}}}], [{"name": "f", "arguments": {"x": 1}}]),
+    ([[{"name": "f"}], [[{"name": "g", "arguments": "not json"}]]], [{"name": "f", "arguments": {}}, {"name": "g", "arguments": {}}]),
+    ([{"name": ""}, {"arguments": {}}, "text", 3, None], []),
+])
+def test_function_calls(value, calls):
+    assert replicate_function_calls(value) == calls
+
+
+def test_structured_body():
+    body, headers = structure_replicate_body({"id": "p1", "output": [json.dumps(CALLS)]})
+    assert body == {"id": "p1", "output": CALLS}
+    assert headers == {"X-Replicate-Output": "structured"}
+    body, headers = structure_replicate_body({"id": "p2", "output": ["Hi", " there"]})
+    assert body["output"] == "Hi there"
+
+
+def test_missing_output_is_untouched():
+    assert structure_replicate_body({"id": "p1", "output": None}) == ({"id": "p1", "output": None}, {})
+    assert structure_replicate_body(["not", "a", "prediction"]) == (["not", "a", "prediction"], {})
+
+
+@pytest.mark.parametrize("output", [
+    "[" * 1000 + "]" * 1000,
+    ["[" * 1000 + "]" * 1000],
+    ["[" * 100 + '{"name": "f"}' + "]" * 100],
+    [json.dumps({"a": {"b": {"c": {}}}})],
+])
+def test_deep_nesting_is_returned_raw(output, monkeypatch):
+    monkeypatch.setattr(replicate_api, "REPLICATE_STRUCTURED_MAX_DEPTH", 3)
+    body = {"id": "p1", "output": output}
+    assert structure_replicate_body(body) == (body, {"X-Replicate-Output": "raw"})
+
+
+def test_default_depth_limit_stops_runaway_nesting():
+    body = {"id": "p1", "output": ["[" * 1000 + "]" * 1000]}
+    assert structure_replicate_body(body) == (body, {"X-Replicate-Output": "raw"})
+
+
+def test_size_and_call_limits(monkeypatch):
+    monkeypatch.setattr(replicate_api, "REPLICATE_STRUCTURED_MAX_CALLS", 2)
+    body = {"id": "p1", "output": [json.dumps(CALLS * 3)]}
+    assert structure_replicate_body(body) == (body, {"X-Replicate-Output": "raw"})
+    monkeypatch.setattr(replicate_api, "REPLICATE_STRUCTURED_MAX_CHARS", 10)
+    body = {"id": "p2", "output": ["x" * 11]}
+    assert structure_replicate_body(body) == (body, {"X-Replicate-Output": "raw"})
@@ -0,0 +1,138 @@
+import json
+
+import pytest
+
+import replicate_py
+from _proxy import ollama_backends
+from _proxy.http_clients import upstream
+from _proxy.ollama_backends import OllamaBackendPool
+
+
+class FakeOllamaResponse:
+    """An Ollama reply streaming the given NDJSON chunks, optionally failing after them"""
+
+    def __init__(self, chunks, status_code=200, text="", error=None):
+        self.chunks = chunks
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = text
+        self.error = error
+        self.closed = False
+
+    def iter_lines(self):
+        for chunk in self.chunks:
+            yield json.dumps(chunk).encode()
+            yield b""
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def generate_chunks(*words):
+    return [{"response": word, "done": False} for word in words] + [{"response": "", "done": True}]
+
+
+def chat_chunks(*words):
+    return [{"message": {"role": "assistant", "content": word}, "done": False} for word in words] + [
+        {"message": {"role": "assistant", "content": ""}, "done": True}]
+
+
+def events(body):
+    """(event name, data) for every server-sent event; unnamed events are "message" events"""
+    parsed = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        parsed.append((lines.get("event", "message"), json.loads(lines["data"])))
+    return parsed
+
+
+@pytest.fixture
+def ollama(fresh_router, monkeypatch):
+    """A single-backend Ollama pool whose next streamed reply the test sets in replies"""
+    pool = OllamaBackendPool(["http://gpu-1:11434"], failure_threshold=1)
+    monkeypatch.setattr(ollama_backends, "ollama_pool", pool)
+    replies, requests = [], []
+
+    def post(url, **kwargs):
+        requests.append((url, kwargs))
+        return replies.pop(0)
+
+    monkeypatch.setattr(upstream, "post", post)
+    return pool, replies, requests
+
+
+def stream(path, body):
+    response = replicate_py.app.test_client().post(path, json=body)
+    result = response.status_code, response.headers, response.get_data(as_text=True)
+    response.close()
+    return result
+
+
+def test_ollama_route_relays_each_chunk_as_it_arrives(ollama):
+    pool, replies, requests = ollama
+    replies.append(FakeOllamaResponse(generate_chunks("Hel", "lo")))
+    status, headers, body = stream('/api/ollama?stream=1', {"input": {"query": "hi"}})
+    assert status == 200
+    assert headers["Content-Type"].startswith("text/event-stream")
+    assert headers["X-Accel-Buffering"] == "no"
+    assert [data["output"] for _, data in events(body)] == ["Hel", "lo", ""]
+    assert events(body)[-1][1]["status"] == "succeeded"
+    url, kwargs = requests[0]
+    assert url == "http://gpu-1:11434/api/generate"
+    assert kwargs["stream"] is True and kwargs["json"]["stream"] is True
+    # The backend is free again and known to have the model loaded
+    backend = pool.stats()["http://gpu-1:11434"]
+    assert backend["outstanding"] == 0 and backend["loaded_models"] == ["llama3"]
+
+
+def test_chat_streams_when_the_body_asks_for_it(ollama):
+    _, replies, _ = ollama
+    replies.append(FakeOllamaResponse(chat_chunks("Hi", " there")))
+    status, _, body = stream('/api/chat', {"messages": [{"role": "user", "content": "hi"}], "stream": True})
+    assert status == 200
+    chunks = [data for _, data in events(body)]
+    assert [chunk["message"]["content"] for chunk in chunks] == ["Hi", " there", ""]
+    assert [chunk["done"] for chunk in chunks] == [False, False, True]
+
+
+def test_ollama_error_chunk_ends_the_stream_with_an_error_event(ollama):
+    _, replies, _ = ollama
+    replies.append(FakeOllamaResponse([{"response": "Hel", "done": False}, {"error": "model crashed"}, {"response": "never sent"}]))
+    _, _, body = stream('/api/ollama?stream=1', {"input": {"query": "hi"}})
+    assert events(body) == [("message", {"id": "ollama-response", "status": "processing", "output": "Hel", "done": False}),
+                            ("error", {"error": "model crashed"})]
+
+
+def test_refused_stream_is_answered_with_a_json_error(ollama):
+    pool, replies, _ = ollama
+    replies.append(FakeOllamaResponse([], status_code=404, text="model 'llama3' not found"))
+    status, headers, body = stream('/api/chat?stream=1', {"messages": [{"content": "hi"}]})
+    assert status == 404
+    assert headers["Content-Type"] == "application/json"
+    assert "model 'llama3' not found" in json.loads(body)["error"]
+    # A 404 says the backend is healthy, not that the model is loaded
+    backend = pool.stats()["http://gpu-1:11434"]
+    assert backend["healthy"] and backend["outstanding"] == 0 and backend["loaded_models"] == []
+
+
+def test_broken_stream_reports_the_error_and_counts_against_the_backend(ollama, fresh_router):
+    pool, replies, _ = ollama
+    replies.append(FakeOllamaResponse(generate_chunks("Hel")[:1], error=ConnectionError("connection reset")))
+    _, _, body = stream('/api/ollama?stream=1', {"input": {"query": "hi"}})
+    assert events(body)[0][1]["output"] == "Hel"
+    name, data = events(body)[-1]
+    assert name == "error" and "connection reset" in data["error"]
+    assert not pool.stats()["http://gpu-1:11434"]["healthy"]
+    assert fresh_router.breakers["ollama"].stats()["consecutive_failures"] == 1
+
+
+def test_non_streaming_requests_are_unchanged(ollama):
+    _, replies, requests = ollama
+    reply = FakeOllamaResponse([])
+    reply.json = lambda: {"response": "Hello", "done": True}
+    replies.append(reply)
+    response = replicate_py.app.test_client().post('/api/ollama', json={"input": {"query": "hi", "temperature": 0.3}})
+    assert response.get_json() == {"id": "ollama-response", "status": "succeeded", "output": "Hello"}
+    assert requests[0][1]["json"]["stream"] is False
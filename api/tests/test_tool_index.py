@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from _proxy.tool_selection import ToolIndex, ToolSelector, tool_terms
+
+
+def tool(name, description="", **parameters):
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": {"type": "object", "properties": {key: {"type": "string", "description": value} for key, value in parameters.items()}}
+        }
+    }
+
+
+TOOLS = [
+    tool("get_balance", "Get the token balance of a wallet", address="Wallet address"),
+    tool("sendTransaction", "Send ETH to an address", to="Recipient address", amount="Amount in ETH"),
+    tool("get_gas_price", "Current gas price in gwei"),
+    tool("swap_tokens", "Swap one token for another on a DEX", token_in="Token to sell", token_out="Token to buy"),
+]
+
+
+def test_tool_terms():
+    assert tool_terms("getBalance") == ["balance"]
+    assert tool_terms("get_gas_price") == ["gas", "price"]
+    assert tool_terms("What are my balances?") == ["balance"]
+    assert tool_terms("HTTPRequest address") == ["http", "request", "address"]
+    assert tool_terms(None) == []
+
+
+def test_ranks_the_relevant_tool_first():
+    index = ToolIndex(TOOLS)
+    assert index.top_k("what is the balance of my wallet", 1) == [0]
+    assert index.top_k("how much is gas right now", 1) == [2]
+    assert index.top_k("swap my tokens", 1) == [3]
+
+
+def test_results_keep_payload_order():
+    index = ToolIndex(TOOLS)
+    selected = index.top_k("send tokens to an address", 3)
+    assert selected == sorted(selected)
+    assert 1 in selected
+
+
+def test_no_match_and_limits():
+    index = ToolIndex(TOOLS)
+    assert index.top_k("tell me a joke", 3) == []
+    assert index.top_k("", 3) == []
+    assert len(index.top_k("token address balance gas", 2)) == 2
+
+
+def test_malformed_and_empty_tool_sets():
+    index = ToolIndex([{"type": "function"}, "not a tool", tool("get_balance")])
+    assert index.top_k("balance", 5) == [2]
+    assert ToolIndex([]).top_k("balance", 5) == []
+
+
+def test_selector_keeps_small_tool_sets_whole():
+    selector = ToolSelector(top_k=1, min_tools=10, cache_size=4, baseline_rate=0)
+    tools_json = json.dumps(TOOLS)
+    assert selector.select("balance", tools_json) == (tools_json, None)
+
+
+def test_selector_sends_only_the_top_tools():
+    selector = ToolSelector(top_k=1, min_tools=2, cache_size=4, baseline_rate=0)
+    tools_json, selection = selector.select("what is my wallet balance", json.dumps(TOOLS))
+    assert [t["function"]["name"] for t in json.loads(tools_json)] == ["get_balance"]
+    assert selection == {"mode": "preselected", "sent": 1, "total": 4}
+
+
+def test_selector_sends_everything_when_nothing_matches():
+    selector = ToolSelector(top_k=1, min_tools=2, cache_size=4, baseline_rate=0)
+    tools_json = json.dumps(TOOLS)
+    assert selector.select("tell me a joke", tools_json) == (tools_json, {"mode": "all", "sent": 4, "total": 4})
+
+
+@pytest.mark.parametrize("top_k", [-1, "3", 1.5, True])
+def test_selector_rejects_invalid_top_k(top_k):
+    selector = ToolSelector(top_k=1, min_tools=2, cache_size=4, baseline_rate=0)
+    with pytest.raises(ValueError):
+        selector.select("balance", json.dumps(TOOLS), top_k)
+
+
+def test_selector_passes_invalid_tools_json_through():
+    selector = ToolSelector(top_k=1, min_tools=2, cache_size=4, baseline_rate=0)
+    assert selector.select("balance", "not json") == ("not json", None)
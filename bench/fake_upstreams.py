@@ -0,0 +1,295 @@
+"""
+Local stand-ins for the upstreams api/replicate_py.py talks to, for benchmarking
+without live services:
+
+- Replicate predictions API (POST /v1/predictions, GET /v1/predictions/<id>),
+  including the null-output cold start
+- Ollama /api/generate and /api/chat, plain and NDJSON-streamed, with tool
+  calls when /api/chat is sent tools, and /api/tags for health probes
+- Gemini GenerativeService over plain-text gRPC (GenerateContent,
+  StreamGenerateContent and CountTokens), answering with a call to the first
+  declared tool
+
+Every fake takes a latency (mean and jitter), a failure rate and a seed, so runs
+are repeatable. Point the proxy at them with:
+
+    REPLICATE_API_URL=http://127.0.0.1:8101/v1/predictions
+    OLLAMA_URL=http://127.0.0.1:8102
+    GEMINI_API_ENDPOINT=127.0.0.1:8103
+"""
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import grpc
+from google.ai import generativelanguage as glm
+
+
+class FakeBehaviour:
+    """Latency and failure settings shared by one fake upstream"""
+
+    def __init__(self, latency=0.05, jitter=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def delay(self):
+        with self._lock:
+            spread = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        time.sleep(max(self.latency + spread, 0.0))
+
+    def fails(self):
+        return self.chance(self.failure_rate)
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    behaviour = FakeBehaviour()
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeReplicateHandler(JsonHandler):
+    """
+    With Prefer: wait the prediction is returned finished, or with a null output
+    for a cold_start_rate fraction of requests. Without it the prediction starts
+    and succeeds once `latency` has passed, for the async job mode poller.
+    """
+
+    cold_start_rate = 0.0
+    output = ["[{\"name\": \"get_balance\", \"arguments\": {\"address\": \"0xabc\"}}]"]
+    predictions = {}  # id -> (ready_at, prediction)
+    ids = itertools.count(1)
+
+    def do_POST(self):
+        self.read_json()
+        if self.behaviour.fails():
+            self.behaviour.delay()
+            return self.send_json({"detail": "Injected failure"}, status=500)
+
+        prediction_id = f"fake-{next(self.ids)}"
+        prediction = {"id": prediction_id, "status": "succeeded", "output": self.output}
+        if 'wait' not in self.headers.get('Prefer', ''):
+            self.predictions[prediction_id] = (time.monotonic() + self.behaviour.latency, prediction)
+            return self.send_json({**prediction, "status": "starting", "output": None}, status=201)
+
+        self.behaviour.delay()
+        if self.behaviour.chance(self.cold_start_rate):
+            return self.send_json({**prediction, "status": "starting", "output": None}, status=201)
+        self.send_json(prediction, status=201)
+
+    def do_GET(self):
+        prediction_id = self.path.rstrip('/').rsplit('/', 1)[-1]
+        entry = self.predictions.get(prediction_id)
+        if entry is None:
+            return self.send_json({"detail": "Not found"}, status=404)
+        ready_at, prediction = entry
+        if time.monotonic() < ready_at:
+            return self.send_json({**prediction, "status": "processing", "output": None})
+        self.predictions.pop(prediction_id, None)
+        self.send_json(prediction)
+
+
+class FakeOllamaHandler(JsonHandler):
+    """Streams stream_chunks NDJSON chunks spread over `latency` when "stream" is true"""
+
+    stream_chunks = 8
+
+    def do_POST(self):
+        if self.path not in ('/api/generate', '/api/chat'):
+            return self.send_json({"error": "not found"}, status=404)
+        request_data = self.read_json()
+        if self.behaviour.fails():
+            self.behaviour.delay()
+            return self.send_json({"error": "Injected failure"}, status=500)
+
+        words = [f"word{i} " for i in range(self.stream_chunks)]
+        if not request_data.get('stream'):
+            self.behaviour.delay()
+            body = self.chunk(''.join(words), done=True)
+            if request_data.get('tools'):
+                name = request_data['tools'][0].get('function', {}).get('name')
+                body["message"]["tool_calls"] = [{"function": {"name": name, "arguments": {}}}]
+            return self.send_json(body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for word in words:
+            time.sleep(self.behaviour.latency / self.stream_chunks)
+            self.write_chunk(self.chunk(word, done=False))
+        self.write_chunk(self.chunk('', done=True))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        if self.path != '/api/tags':
+            return self.send_json({"error": "not found"}, status=404)
+        self.send_json({"models": [{"name": "llama3"}]})
+
+    def chunk(self, text, done):
+        if self.path == '/api/chat':
+            return {"message": {"role": "assistant", "content": text}, "done": done}
+        return {"response": text, "done": done}
+
+    def write_chunk(self, body):
+        line = (json.dumps(body) + "\n").encode('utf-8')
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+
+
+class FakeGeminiService:
+    """GenerativeService over gRPC: a call to the first declared tool, then a short text part"""
+
+    SERVICE = 'google.ai.generativelanguage.v1beta.GenerativeService'
+
+    def __init__(self, behaviour, empty_rate=0.0):
+        self.behaviour = behaviour
+        self.empty_rate = empty_rate
+
+    def _parts(self, request):
+        if self.behaviour.chance(self.empty_rate):
+            return []
+        declarations = [fd for tool in request.tools for fd in tool.function_declarations]
+        parts = []
+        if declarations:
+            parts.append(glm.Part(function_call=glm.FunctionCall(name=declarations[0].name, args={})))
+        parts.append(glm.Part(text="Fake Gemini answer"))
+        return parts
+
+    def _response(self, parts):
+        return glm.GenerateContentResponse(candidates=[
+            glm.Candidate(content=glm.Content(role="model", parts=parts), finish_reason=glm.Candidate.FinishReason.STOP)
+        ])
+
+    def generate_content(self, request, context):
+        self.behaviour.delay()
+        if self.behaviour.fails():
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Injected failure")
+        return self._response(self._parts(request))
+
+    def stream_generate_content(self, request, context):
+        self.behaviour.delay()
+        if self.behaviour.fails():
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Injected failure")
+        for part in self._parts(request):
+            yield self._response([part])
+
+    def count_tokens(self, request, context):
+        if self.behaviour.fails():
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Injected failure")
+        return glm.CountTokensResponse(total_tokens=1)
+
+    def handler(self):
+        return grpc.method_handlers_generic_handler(self.SERVICE, {
+            'CountTokens': grpc.unary_unary_rpc_method_handler(
+                self.count_tokens,
+                request_deserializer=glm.CountTokensRequest.deserialize,
+                response_serializer=glm.CountTokensResponse.serialize
+            ),
+            'GenerateContent': grpc.unary_unary_rpc_method_handler(
+                self.generate_content,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize
+            ),
+            'StreamGenerateContent': grpc.unary_stream_rpc_method_handler(
+                self.stream_generate_content,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize
+            )
+        })
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The proxy dropping pooled keep-alive connections is expected, not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_http(handler_class, port, behaviour, **attributes):
+    handler = type(handler_class.__name__, (handler_class,), {"behaviour": behaviour, **attributes})
+    server = QuietHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_gemini(port, behaviour, empty_rate=0.0, workers=32):
+    server = grpc.server(ThreadPoolExecutor(max_workers=workers))
+    server.add_generic_rpc_handlers((FakeGeminiService(behaviour, empty_rate).handler(),))
+    bound_port = server.add_insecure_port(f'127.0.0.1:{port}')
+    server.start()
+    return server, bound_port
+
+
+def start_all(replicate_port=0, ollama_port=0, gemini_port=0, latency=0.05, jitter=0.0,
+              failure_rate=0.0, cold_start_rate=0.0, empty_rate=0.0, seed=0):
+    """Start all three fakes in this process, returning their addresses and server objects"""
+    replicate = start_http(
+        FakeReplicateHandler, replicate_port, FakeBehaviour(latency, jitter, failure_rate, seed),
+        cold_start_rate=cold_start_rate, predictions={}
+    )
+    ollama = start_http(FakeOllamaHandler, ollama_port, FakeBehaviour(latency, jitter, failure_rate, seed + 1))
+    gemini, bound_gemini_port = start_gemini(gemini_port, FakeBehaviour(latency, jitter, failure_rate, seed + 2), empty_rate)
+    addresses = {
+        "REPLICATE_API_URL": f"http://127.0.0.1:{replicate.server_port}/v1/predictions",
+        "OLLAMA_URL": f"http://127.0.0.1:{ollama.server_port}",
+        "GEMINI_API_ENDPOINT": f"127.0.0.1:{bound_gemini_port}"
+    }
+    return addresses, (replicate, ollama, gemini)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicate-port', type=int, default=8101)
+    parser.add_argument('--ollama-port', type=int, default=8102)
+    parser.add_argument('--gemini-port', type=int, default=8103)
+    parser.add_argument('--latency', type=float, default=0.05, help="Mean upstream latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Uniform +/- spread around the latency")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument('--cold-start-rate', type=float, default=0.0, help="Fraction of Replicate waits returning a null output")
+    parser.add_argument('--empty-rate', type=float, default=0.0, help="Fraction of Gemini responses with no parts")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    addresses, _ = start_all(
+        args.replicate_port, args.ollama_port, args.gemini_port, args.latency, args.jitter,
+        args.failure_rate, args.cold_start_rate, args.empty_rate, args.seed
+    )
+    # One line of JSON so a parent process can read the addresses
+    print(json.dumps(addresses), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
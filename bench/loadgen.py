@@ -0,0 +1,418 @@
+"""
+Load generator for api/replicate_py.py.
+
+Starts the fake upstreams (bench/fake_upstreams.py) and the proxy as subprocesses,
+drives each route with a fixed number of requests at a fixed concurrency, and
+reports p50/p95/p99 latency, requests/sec, errors and the proxy's resident memory.
+Results are written to bench/results/<commit>-<mode>.json; pass --compare with an
+earlier result to see the deltas and flag regressions.
+
+    python bench/loadgen.py
+    python bench/loadgen.py --mode async --routes chat,gemini_functions --requests 500
+    python bench/loadgen.py --compare bench/results/abc1234-flask.json --fail-on-regression
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+API_DIR = os.path.join(REPO_DIR, 'api')
+
+# Runs the proxy the way __main__ does, minus Flask's debug reloader, which would
+# fork a second process and make the memory readings meaningless, and the access log
+PROXY_LAUNCHER = """
+import logging, os, sys
+sys.path.insert(0, {api_dir!r})
+logging.getLogger('werkzeug').setLevel(logging.WARNING)  # No per-request access log
+import replicate_py as proxy
+port = int(os.environ['PORT'])
+if proxy.SERVER_MODE == 'async':
+    from aiohttp import web
+    web.run_app(proxy.create_async_app(), host='127.0.0.1', port=port, print=None)
+else:
+    proxy.app.run(host='127.0.0.1', port=port, threaded=True)
+"""
+
+TOOLS = json.dumps([
+    {"type": "function", "function": {
+        "name": "get_balance",
+        "description": "Get the ETH balance of a wallet address",
+        "parameters": {"type": "object", "properties": {"address": {"type": "string", "description": "Wallet address"}}, "required": ["address"]}
+    }},
+    {"type": "function", "function": {
+        "name": "send_transaction",
+        "description": "Send ETH to another address",
+        "parameters": {"type": "object", "properties": {"to": {"type": "string"}, "value": {"type": "string"}}, "required": ["to", "value"]}
+    }},
+    {"type": "function", "function": {
+        "name": "swap_tokens",
+        "description": "Swap one token for another on a DEX",
+        "parameters": {"type": "object", "properties": {"from_token": {"type": "string"}, "to_token": {"type": "string"}, "amount": {"type": "string"}}}
+    }}
+])
+
+REPLICATE_HEADERS = {"X-Replicate-API-Token": "bench-token"}
+GEMINI_HEADERS = {"X-Gemini-API-Key": "bench-key"}
+
+
+def replicate(session, base, i, state):
+    return session.post(f"{base}/api/replicate", json={"version": "bench", "input": {"prompt": f"bench {i}"}}, headers=REPLICATE_HEADERS)
+
+
+def replicate_structured(session, base, i, state):
+    return session.post(f"{base}/api/replicate?structured=1", json={"version": "bench", "input": {"prompt": f"bench {i}"}}, headers=REPLICATE_HEADERS)
+
+
+def replicate_async(session, base, i, state):
+    return session.post(f"{base}/api/replicate?async=1", json={"version": "bench", "input": {"prompt": f"bench {i}"}}, headers=REPLICATE_HEADERS)
+
+
+def replicate_status_setup(session, base):
+    job = replicate_async(session, base, 0, None).json()
+    return {"job_id": job["id"]}
+
+
+def replicate_status(session, base, i, state):
+    return session.get(f"{base}/api/replicate/{state['job_id']}", headers=REPLICATE_HEADERS)
+
+
+def gemini_functions(session, base, i, state):
+    return session.post(f"{base}/api/gemini_functions", json={"query": f"What is the balance of wallet {i}?", "tools": TOOLS}, headers=GEMINI_HEADERS)
+
+
+def gemini_functions_stream(session, base, i, state):
+    return session.post(f"{base}/api/gemini_functions?stream=1", json={"query": f"What is the balance of wallet {i}?", "tools": TOOLS}, headers=GEMINI_HEADERS)
+
+
+def gemini_functions_batch(session, base, i, state):
+    queries = [f"What is the balance of wallet {i}-{n}?" for n in range(8)]
+    return session.post(f"{base}/api/gemini_functions/batch", json={"queries": queries, "tools": TOOLS}, headers=GEMINI_HEADERS)
+
+
+def gemini_health(session, base, i, state):
+    return session.get(f"{base}/api/gemini_health", headers=GEMINI_HEADERS)
+
+
+def chat(session, base, i, state):
+    return session.post(f"{base}/api/chat", json={"messages": [{"role": "user", "content": f"Hello {i}"}]})
+
+
+def chat_stream(session, base, i, state):
+    return session.post(f"{base}/api/chat?stream=1", json={"messages": [{"role": "user", "content": f"Hello {i}"}]})
+
+
+def ollama(session, base, i, state):
+    return session.post(f"{base}/api/ollama", json={"input": {"query": f"Prompt {i}"}})
+
+
+def ollama_stream(session, base, i, state):
+    return session.post(f"{base}/api/ollama?stream=1", json={"input": {"query": f"Prompt {i}"}})
+
+
+def upstream_stats(session, base, i, state):
+    return session.get(f"{base}/api/upstream_stats")
+
+
+def cache_stats(session, base, i, state):
+    return session.get(f"{base}/api/cache_stats")
+
+
+def prometheus_metrics(session, base, i, state):
+    return session.get(f"{base}/metrics")
+
+
+# name -> (setup, request); bodies differ per request so coalescing and caching don't skew results
+SCENARIOS = {
+    "replicate": (None, replicate),
+    "replicate_structured": (None, replicate_structured),
+    "replicate_async": (None, replicate_async),
+    "replicate_status": (replicate_status_setup, replicate_status),
+    "gemini_functions": (None, gemini_functions),
+    "gemini_functions_stream": (None, gemini_functions_stream),
+    "gemini_functions_batch": (None, gemini_functions_batch),
+    "gemini_health": (None, gemini_health),
+    "chat": (None, chat),
+    "chat_stream": (None, chat_stream),
+    "ollama": (None, ollama),
+    "ollama_stream": (None, ollama_stream),
+    "upstream_stats": (None, upstream_stats),
+    "cache_stats": (None, cache_stats),
+    "metrics": (None, prometheus_metrics)
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid):
+    """Resident memory of pid in MB, or None where /proc is unavailable"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler:
+    """Tracks the peak RSS of a process between reset() calls"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            current = rss_mb(self.pid)
+            if current is not None and (self.peak is None or current > self.peak):
+                self.peak = current
+
+    def start(self):
+        if self.pid is not None:
+            self._thread.start()
+        return self
+
+    def reset(self):
+        self.peak = rss_mb(self.pid) if self.pid is not None else None
+
+    def stop(self):
+        self._stop.set()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def run_scenario(base, name, requests_count, concurrency, warmup, sampler):
+    setup, send = SCENARIOS[name]
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    state = setup(requests.Session(), base) if setup else None
+    for i in range(warmup):
+        send(session(), base, -i - 1, state).content
+
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal errors
+        while True:
+            i = next(counter)
+            if i >= requests_count:
+                return
+            start = time.perf_counter()
+            try:
+                response = send(session(), base, i, state)
+                response.content  # Streamed responses are timed until the last event
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += failed
+
+    sampler.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / wall, 1) if wall else None,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+        "rss_peak_mb": sampler.peak,
+        "rss_end_mb": rss_mb(sampler.pid) if sampler.pid is not None else None
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', 'api'], cwd=REPO_DIR).returncode != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def start_fakes(args):
+    command = [
+        sys.executable, os.path.join(BENCH_DIR, 'fake_upstreams.py'),
+        '--replicate-port', '0', '--ollama-port', '0', '--gemini-port', '0',
+        '--latency', str(args.latency), '--jitter', str(args.jitter),
+        '--failure-rate', str(args.failure_rate), '--cold-start-rate', str(args.cold_start_rate),
+        '--empty-rate', str(args.empty_rate), '--seed', str(args.seed)
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    addresses = json.loads(process.stdout.readline())
+    return process, addresses
+
+
+def start_proxy(args, addresses):
+    port = free_port()
+    env = dict(os.environ, **addresses, SERVER_MODE=args.mode, PORT=str(port), LOG_LEVEL=args.log_level)
+    # Every scenario uses one bench key, which the per-key rate limit would throttle; export RATE_LIMIT_RPS to measure it
+    env.setdefault('RATE_LIMIT_RPS', '0')
+    process = subprocess.Popen([sys.executable, '-c', PROXY_LAUNCHER.format(api_dir=API_DIR)], env=env)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Proxy exited during startup with code {process.returncode}")
+        try:
+            if requests.get(f"{base}/api/cache_stats", timeout=1).ok:
+                return process, base
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Proxy did not start within 30s")
+
+
+def compare(results, baseline, threshold):
+    """Print per-route deltas against a baseline and return the routes that regressed"""
+    regressions = []
+    print(f"\nCompared with {baseline['commit']} ({baseline['mode']} mode), threshold {threshold:.0%}:")
+    print(f"{'route':<26}{'p50 ms':>18}{'p95 ms':>18}{'p99 ms':>18}{'req/s':>18}")
+    for name, current in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if not previous:
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "rps"):
+            if current[key] is None or not previous[key]:
+                cells.append(f"{'-':>18}")
+                continue
+            change = current[key] / previous[key] - 1
+            cells.append(f"{current[key]:>9} ({change:+.0%})".rjust(18))
+        worse_latency = current["p95_ms"] and previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + threshold)
+        worse_throughput = current["rps"] and previous["rps"] and current["rps"] < previous["rps"] * (1 - threshold)
+        flag = "  REGRESSION" if worse_latency or worse_throughput else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:<26}{''.join(cells)}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('flask', 'async'), default='flask', help="Proxy SERVER_MODE")
+    parser.add_argument('--routes', default=','.join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed requests before each scenario")
+    parser.add_argument('--latency', type=float, default=0.05, help="Mean fake upstream latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--cold-start-rate', type=float, default=0.0)
+    parser.add_argument('--empty-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--target', help="Benchmark an already running proxy at this URL instead of starting one")
+    parser.add_argument('--pid', type=int, help="PID of the --target proxy, for memory readings")
+    parser.add_argument('--log-level', default='WARNING', help="LOG_LEVEL for the started proxy")
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results'), help="Directory for the results JSON")
+    parser.add_argument('--compare', help="Earlier results JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Relative p95/req/s change counted as a regression")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    routes = [name.strip() for name in args.routes.split(',') if name.strip()]
+    unknown = [name for name in routes if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown routes: {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+
+    processes = []
+    try:
+        if args.target:
+            base, pid = args.target.rstrip('/'), args.pid
+        else:
+            fakes, addresses = start_fakes(args)
+            processes.append(fakes)
+            proxy, base = start_proxy(args, addresses)
+            processes.append(proxy)
+            pid = proxy.pid
+
+        sampler = MemorySampler(pid).start()
+        results = {
+            "commit": git_commit(),
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "mode": args.mode,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: getattr(args, key) for key in (
+                "requests", "concurrency", "warmup", "latency", "jitter",
+                "failure_rate", "cold_start_rate", "empty_rate", "seed"
+            )},
+            "rss_start_mb": rss_mb(pid) if pid is not None else None,
+            "scenarios": {}
+        }
+
+        print(f"{'route':<26}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'rss MB':>9}")
+        for name in routes:
+            stats = run_scenario(base, name, args.requests, args.concurrency, args.warmup, sampler)
+            results["scenarios"][name] = stats
+            print(f"{name:<26}{stats['rps']:>9}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['errors']:>8}{str(stats['rss_peak_mb']):>9}")
+        sampler.stop()
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{results['commit']}-{args.mode}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("Warning: baseline was recorded with a different configuration; deltas may not be meaningful")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions and args.fail_on_regression:
+            print(f"Regressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Startup benchmark for api/replicate_py.py.
+
+Measures what a cold start costs: the time to import the proxy module in a fresh
+interpreter (with provider SDKs loaded lazily, and with PRELOAD_PROVIDER_SDKS=1), and
+for each server the time from launch until it answers, then the latency of the first
+/api/chat and the first and second /api/gemini_functions requests against the fake
+upstreams. The first Gemini request includes loading the SDK when it is lazy. Servers
+run with the health prober on, which must not load the SDK by itself.
+Results are written to bench/results/<commit>-startup.json.
+
+    python bench/startup.py
+    python bench/startup.py --servers dev,gunicorn --runs 5
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+from loadgen import (
+    API_DIR, BENCH_DIR, GEMINI_HEADERS, PROXY_LAUNCHER, TOOLS,
+    free_port, git_commit, rss_mb, start_fakes
+)
+
+IMPORT_PROBE = """
+import sys, time
+sys.path.insert(0, {api_dir!r})
+start = time.perf_counter()
+import replicate_py
+print(time.perf_counter() - start, len(sys.modules))
+"""
+
+
+def server_command(server):
+    """Command line for a server under test; dev and async use loadgen's launcher"""
+    if server == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', '-c', os.path.join(API_DIR, 'gunicorn.conf.py')]
+    return [sys.executable, '-c', PROXY_LAUNCHER.format(api_dir=API_DIR)]
+
+
+def tree_rss_mb(pid):
+    """Resident memory of pid and its child processes (gunicorn workers) in MB"""
+    total = rss_mb(pid)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            for child in children.read().split():
+                total += rss_mb(int(child)) or 0
+    except (OSError, TypeError):
+        pass
+    return round(total, 1) if total is not None else None
+
+
+def server_env(server, addresses, port, preload):
+    # The prober runs as in production, with a server key to probe Gemini with once the SDK is loaded
+    env = dict(os.environ, **addresses, PORT=str(port), LOG_LEVEL='WARNING', RATE_LIMIT_RPS='0', HEALTH_PROBE_INTERVAL='1', GEMINI_API_KEY='bench-key')
+    env['SERVER_MODE'] = 'async' if server == 'async' else 'flask'
+    if preload:
+        env['PRELOAD_PROVIDER_SDKS'] = '1'
+    return env
+
+
+def measure_import(preload, runs):
+    env = dict(os.environ, LOG_LEVEL='WARNING')
+    if preload:
+        env['PRELOAD_PROVIDER_SDKS'] = '1'
+    seconds, modules = [], None
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE.format(api_dir=API_DIR)], env=env, text=True)
+        elapsed, modules = output.split()[-2:]
+        seconds.append(float(elapsed))
+    return {"median_ms": round(statistics.median(seconds) * 1000, 1), "min_ms": round(min(seconds) * 1000, 1), "modules": int(modules)}
+
+
+def median(values):
+    return round(statistics.median(values), 1) if None not in values else None
+
+
+def timed_request(send):
+    start = time.perf_counter()
+    response = send()
+    response.content
+    if response.status_code >= 400:
+        raise RuntimeError(f"Request failed with status {response.status_code}: {response.text[:200]}")
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def measure_server(server, addresses, preload, timeout=30):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    session = requests.Session()
+    process = subprocess.Popen(server_command(server), env=server_env(server, addresses, port, preload),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"{server} exited during startup with code {process.returncode}")
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError(f"{server} did not answer within {timeout}s")
+            try:
+                if session.get(f"{base}/api/cache_stats", timeout=1).ok:
+                    break
+            except requests.RequestException:
+                time.sleep(0.01)
+        ready = time.perf_counter() - started
+
+        def gemini(i):
+            return session.post(f"{base}/api/gemini_functions", json={"query": f"Balance of wallet {i}?", "tools": TOOLS}, headers=GEMINI_HEADERS)
+
+        result = {
+            "ready_ms": round(ready * 1000, 1),
+            "first_chat_ms": timed_request(lambda: session.post(f"{base}/api/chat", json={"messages": [{"role": "user", "content": "Hello"}]})),
+            "first_gemini_ms": timed_request(lambda: gemini(1)),
+            "second_gemini_ms": timed_request(lambda: gemini(2)),
+            "rss_mb": tree_rss_mb(process.pid)
+        }
+        result["first_request_ms"] = round(result["ready_ms"] + result["first_chat_ms"], 1)
+        return result
+    finally:
+        session.close()
+        # SIGINT is a quick shutdown for gunicorn; a graceful one can wait out idle keep-alive connections
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', default='dev,async,gunicorn', help="Comma-separated servers to start: dev, async, gunicorn")
+    parser.add_argument('--runs', type=int, default=3, help="Repetitions per measurement; medians are reported")
+    parser.add_argument('--latency', type=float, default=0.01, help="Mean fake upstream latency in seconds")
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results'), help="Directory for the results JSON")
+    parser.set_defaults(jitter=0.0, failure_rate=0.0, cold_start_rate=0.0, empty_rate=0.0, seed=0)
+    args = parser.parse_args()
+
+    servers = [name.strip() for name in args.servers.split(',') if name.strip()]
+    unknown = [name for name in servers if name not in ('dev', 'async', 'gunicorn')]
+    if unknown:
+        parser.error(f"Unknown servers: {', '.join(unknown)}")
+    if 'gunicorn' in servers and importlib.util.find_spec('gunicorn') is None:
+        print("gunicorn is not installed, skipping it")
+        servers.remove('gunicorn')
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"runs": args.runs, "latency": args.latency},
+        "import": {},
+        "servers": {}
+    }
+
+    print(f"{'import':<24}{'median ms':>11}{'min ms':>9}{'modules':>9}")
+    for name, preload in (("lazy", False), ("preload_sdks", True)):
+        stats = measure_import(preload, args.runs)
+        results["import"][name] = stats
+        print(f"{name:<24}{stats['median_ms']:>11}{stats['min_ms']:>9}{stats['modules']:>9}")
+
+    fakes, addresses = start_fakes(args)
+    keys = ("ready_ms", "first_request_ms", "first_gemini_ms", "second_gemini_ms", "rss_mb")
+    try:
+        print(f"\n{'server':<24}{'ready ms':>10}{'1st req ms':>12}{'1st gemini':>12}{'2nd gemini':>12}{'rss MB':>8}")
+        for server in servers:
+            for preload in (False, True):
+                name = f"{server}{'+preload_sdks' if preload else ''}"
+                runs = [measure_server(server, addresses, preload) for _ in range(args.runs)]
+                stats = {key: median([run[key] for run in runs]) for key in keys}
+                results["servers"][name] = stats
+                print(f"{name:<24}{stats['ready_ms']:>10}{stats['first_request_ms']:>12}{stats['first_gemini_ms']:>12}{stats['second_gemini_ms']:>12}{str(stats['rss_mb']):>8}")
+    finally:
+        fakes.terminate()
+        fakes.wait(timeout=10)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{results['commit']}-startup.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {path}")
+
+
+if __name__ == '__main__':
+    main()